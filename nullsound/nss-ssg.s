@@ -41,6 +41,7 @@
         .lclequ MACRO_DATA,(state_ssg_macro_data-state_mirrored_ssg)
         .lclequ MACRO_POS,(state_ssg_macro_pos-state_mirrored_ssg)
         .lclequ MACRO_LOAD,(state_ssg_macro_load-state_mirrored_ssg)
+        .lclequ MACRO_RUN,(state_ssg_macro_run-state_mirrored_ssg)
         .lclequ REG_VOL, (state_ssg_reg_vol-state_mirrored_ssg)
         .lclequ OUT_VOL, (state_ssg_out_vol-state_mirrored_ssg)
 
@@ -114,6 +115,7 @@ state_ssg_arpeggio:             .blkb   1       ; arpeggio (semitone shift)
 state_ssg_macro_data:           .blkb   2       ; address of the start of the macro program
 state_ssg_macro_pos:            .blkb   2       ; address of the current position in the macro program
 state_ssg_macro_load:           .blkb   2       ; function to load the SSG registers modified by the macro program
+state_ssg_macro_run:            .blkb   1       ; remaining evaluations of the current run-length macro step
 state_ssg_out_vol:              .blkb   1       ; ym2610 volume for SSG channel after the FX pipeline
 
 ;;; ... }
@@ -197,6 +199,22 @@ eval_macro_step::
         ld      l, MACRO_POS(ix)
         ld      h, MACRO_POS+1(ix)
 
+        ;; a run-length step (0xfe, count, step...) is evaluated
+        ;; count times before moving to the next step
+        ld      a, (hl)
+        inc     hl
+        cp      a, #0xfe
+        jp      nz, _upd_macro
+        ld      a, MACRO_RUN(ix)
+        or      a
+        jp      nz, _run_macro_step
+        ;; first evaluation of the step, start a new run
+        ld      a, (hl)
+_run_macro_step:
+        dec     a
+        ld      MACRO_RUN(ix), a
+        inc     hl
+
         ;; update mirrored state with macro values
         ld      a, (hl)
         inc     hl
@@ -217,6 +235,10 @@ _end_upd_macro:
         or      (hl)
         inc     hl
         ld      PIPELINE(ix), a
+        ;; stay on the current step until its run is over
+        ld      a, MACRO_RUN(ix)
+        or      a
+        ret     nz
         ;; did we reached the end of macro
         ld      a, (hl)
         cp      a, #0xff
@@ -731,6 +753,7 @@ ssg_macro::
         ld      MACRO_DATA+1(ix), h
         ld      MACRO_POS(ix), l
         ld      MACRO_POS+1(ix), h
+        ld      MACRO_RUN(ix), #0
 
         ;; reconfigure pipeline to start evaluating macro
         ld      a, PIPELINE(ix)
@@ -878,6 +901,7 @@ _ssg_cfg_note_prepare_ym2610:
         ld      MACRO_POS(ix), a
         ld      a, MACRO_DATA+1(ix)
         ld      MACRO_POS+1(ix), a
+        ld      MACRO_RUN(ix), #0
 _ssg_cfg_start_new_note:
         ld      a, PIPELINE(ix)
         or      #(STATE_PLAYING|STATE_EVAL_MACRO|STATE_LOAD_NOTE)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026 Damien Ciabrini
+# This file is part of ngdevkit
+#
+# ngdevkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# ngdevkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ngdevkit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""adpcmbench.py - throughput and fidelity benchmark for the ADPCM codecs.
+
+Run the YM2610 ADPCM-A and ADPCM-B codecs from adpcmtool on synthetic
+signals, report their encode/decode throughput, peak memory and
+round-trip SNR, and optionally compare the results with a previous run.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import sys
+import time
+import tracemalloc
+from math import log10, pi, sin
+from adpcmtool import ym2610_adpcma, ym2610_adpcmb
+
+
+VERBOSE = False
+
+
+def error(s):
+    sys.exit('error: ' + s)
+
+
+def dbg(s):
+    if VERBOSE:
+        print(s, file=sys.stderr)
+
+
+#
+# Synthetic input signals, generated as signed 16-bits samples
+#
+
+def signal_sweep(n, rate):
+    # logarithmic sine sweep from 20Hz to Nyquist
+    f0, f1 = 20.0, rate / 2
+    out = []
+    phase = 0.0
+    for i in range(n):
+        f = f0 * (f1 / f0) ** (i / n)
+        phase += 2 * pi * f / rate
+        out.append(int(24000 * sin(phase)))
+    return out
+
+
+def signal_noise(n, rate):
+    rng = random.Random(0)
+    return [rng.randint(-16384, 16383) for _ in range(n)]
+
+
+def signal_silence(n, rate):
+    return [0] * n
+
+
+def signal_transients(n, rate):
+    # decaying clicks every 1/8 second, on top of silence
+    out = []
+    period = max(1, rate // 8)
+    for i in range(n):
+        t = i % period
+        out.append(int(30000 * (0.999 ** t) * (1 if (t // 4) % 2 == 0 else -1)))
+    return out
+
+
+SIGNALS = {'sweep': signal_sweep,
+           'noise': signal_noise,
+           'silence': signal_silence,
+           'transients': signal_transients}
+
+CODECS = {'a': (ym2610_adpcma, 18500),
+          'b': (ym2610_adpcmb, 44100)}
+
+
+def to_u8(pcm16s):
+    return bytes(((s >> 8) + 128) for s in pcm16s)
+
+
+def snr(reference, decoded):
+    # SNR is meaningless for a silent input or a lossless round-trip
+    signal = sum(s * s for s in reference)
+    noise = sum((s - d) ** 2 for s, d in zip(reference, decoded))
+    if signal == 0 or noise == 0:
+        return None
+    return 10 * log10(signal / noise)
+
+
+def best_time(fun, repeat):
+    # keep the fastest run, the others are mostly scheduling noise
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fun()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def run_case(codec_type, signal, length, width, kernel, repeat):
+    codec_class, rate = CODECS[codec_type]
+    # kernel is 'batch', 'reference' or the width of the trellis encoder
+    batch = kernel != 'reference'
+    trellis = kernel if isinstance(kernel, int) else 0
+    pcm16s = SIGNALS[signal](length, rate)
+    if width == 8:
+        pcms = to_u8(pcm16s)
+        encode = lambda c: c.encode_u8(pcms, batch, True, trellis)
+        # 8-bits input is upscaled to 16-bits by the codec
+        reference = [(s - 128) << 8 for s in pcms]
+    else:
+        pcms = pcm16s
+        encode = lambda c: c.encode_s16(pcms, batch, True, trellis)
+        reference = pcm16s
+
+    codec = codec_class()
+    # warm up the codec's lookup tables outside of the measurements
+    codec.encode([0] * 512, batch)
+
+    adpcm, encode_time = best_time(lambda: encode(codec), repeat)
+    decoded, decode_time = best_time(lambda: codec.decode(adpcm, batch, packed=True), repeat)
+
+    # peak memory is measured in a separate pass, as tracing
+    # allocations slows down the codecs significantly
+    tracemalloc.start()
+    encoded = encode(codec)
+    _, encode_peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    codec.decode(encoded, batch, packed=True)
+    _, decode_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'codec': codec_type,
+            'signal': signal,
+            'length': length,
+            'width': width,
+            'kernel': 'trellis%d' % trellis if trellis else kernel,
+            'encode_sps': length / encode_time if encode_time else None,
+            'decode_sps': len(decoded) / decode_time if decode_time else None,
+            'encode_peak': encode_peak,
+            'decode_peak': decode_peak,
+            'snr': snr(reference, decoded[:length]),
+            'output': hashlib.sha256(adpcm).hexdigest()}
+
+
+def case_id(r):
+    return '%s/%s/%d/%d/%s' % (r['codec'], r['signal'], r['length'], r['width'], r['kernel'])
+
+
+def fmt_snr(v):
+    return 'n/a' if v is None else '%.2f' % v
+
+
+def print_results(results, baseline, threshold, fd):
+    print('%-40s %12s %12s %10s %10s %8s' %
+          ('case', 'enc smp/s', 'dec smp/s', 'enc peak', 'dec peak', 'SNR dB'), file=fd)
+    regressions = 0
+    for r in results:
+        print('%-40s %12.0f %12.0f %10d %10d %8s' %
+              (case_id(r), r['encode_sps'] or 0, r['decode_sps'] or 0,
+               r['encode_peak'], r['decode_peak'], fmt_snr(r['snr'])), file=fd)
+        b = baseline.get(case_id(r))
+        if not b:
+            continue
+        notes = []
+        for k in ('encode_sps', 'decode_sps'):
+            if b[k] and r[k] and r[k] < b[k] * (1 - threshold):
+                notes.append('%s %+.1f%%' % (k, 100 * (r[k] / b[k] - 1)))
+        for k in ('encode_peak', 'decode_peak'):
+            if b[k] and r[k] > b[k] * (1 + threshold):
+                notes.append('%s %+.1f%%' % (k, 100 * (r[k] / b[k] - 1)))
+        if b['output'] != r['output']:
+            notes.append('output changed (SNR %s -> %s)' % (fmt_snr(b['snr']), fmt_snr(r['snr'])))
+        if notes:
+            regressions += 1
+            print('    REGRESSION: %s' % ', '.join(notes), file=fd)
+    return regressions
+
+
+def main():
+    global VERBOSE
+    parser = argparse.ArgumentParser(
+        description='Throughput and fidelity benchmark for the YM2610 ADPCM codecs')
+
+    parser.add_argument('-c', '--codecs', default='ab',
+                        help="codecs to benchmark: 'a', 'b' or 'ab' (default)")
+    parser.add_argument('-s', '--signals', default=','.join(SIGNALS.keys()),
+                        help='comma-separated list of signals (default: %(default)s)')
+    parser.add_argument('-l', '--lengths', default='10000,100000,1000000',
+                        help='comma-separated list of lengths in samples (default: %(default)s)')
+    parser.add_argument('-w', '--widths', default='8,16',
+                        help='comma-separated list of input sample widths (default: %(default)s)')
+    parser.add_argument('--reference', action='store_true', default=False,
+                        help='also benchmark the per-sample reference codecs')
+    parser.add_argument('-T', '--trellis', type=int, default=0, metavar='WIDTH',
+                        help='also benchmark the trellis encoder with the given width')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of timed runs per case, the fastest is kept (default: %(default)s)')
+
+    parser.add_argument('-o', '--output',
+                        help='save results as JSON, for comparison in a later run')
+    parser.add_argument('-b', '--baseline',
+                        help='JSON results of a previous run to compare against')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='relative slowdown or memory increase reported '
+                        'as a regression (default: %(default)s)')
+
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        default=False, help='print details of processing')
+
+    arguments = parser.parse_args()
+    VERBOSE = arguments.verbose
+
+    signals = arguments.signals.split(',')
+    if not all(s in SIGNALS for s in signals):
+        error('unknown signal, valid signals are: %s' % ', '.join(SIGNALS.keys()))
+    if not all(c in CODECS for c in arguments.codecs):
+        error('unknown codec, valid codecs are: a, b')
+    lengths = [int(x) for x in arguments.lengths.split(',')]
+    widths = [int(x) for x in arguments.widths.split(',')]
+    if not all(w in (8, 16) for w in widths):
+        error('only 8-bits and 16-bits sample widths are supported')
+    if arguments.repeat < 1:
+        error('the number of runs must be at least 1')
+    kernels = ['batch']
+    if arguments.reference:
+        kernels.append('reference')
+    if arguments.trellis > 0:
+        kernels.append(arguments.trellis)
+
+    baseline = {}
+    if arguments.baseline:
+        with open(arguments.baseline, 'r') as f:
+            baseline = {case_id(r): r for r in json.load(f)['results']}
+
+    results = []
+    for codec in arguments.codecs:
+        for signal in signals:
+            for length in lengths:
+                for width in widths:
+                    for kernel in kernels:
+                        r = run_case(codec, signal, length, width, kernel,
+                                     arguments.repeat)
+                        dbg('  %s done' % case_id(r))
+                        results.append(r)
+
+    regressions = print_results(results, baseline, arguments.threshold, sys.stdout)
+
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump({'python': sys.version.split()[0],
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'results': results}, f, indent=2)
+
+    if regressions:
+        print('%d regression(s) compared to %s' % (regressions, arguments.baseline))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,11 +23,36 @@ Inspired by freem's adpcma encoder tool
 import struct
 import sys
 import argparse
+import glob
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import time
 import wave
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from bisect import bisect_right
+from heapq import nsmallest
+from math import gcd, pi, sin, sqrt
+from operator import itemgetter, mul
 
 
 VERBOSE = False
 
+# Number of PCM frames read at once from the input WAV file
+# when encoding in streaming mode
+STREAM_BLOCK_FRAMES = 65536
+
+# Number of PCM samples in a chunk of input for the trellis encoder.
+# Chunks are encoded in parallel, so this also changes the encoder's output
+TRELLIS_CHUNK = 16384
+
+# Number of PCM samples around a chunk that the trellis encoder also
+# processes, to settle its codec state before and after the chunk
+TRELLIS_OVERLAP = 1024
+
 
 def error(str):
     sys.exit("error: "+str)
@@ -68,10 +93,47 @@ class ym2610_adpcma(object):
         -1, -1, -1, -1, 2, 5, 7, 9,
     ]
 
+    # Precomputed codec transitions, indexed by (step_index << 4 | adpcm4):
+    # the signed quantized diff to add to the previous decoded sample,
+    # and the step index to use for the next ADPCM sample.
+    # Built on first use by the batch kernels.
+    trans_diff = None
+    trans_step = None
+
+    # Precomputed quantizer, indexed by (step_index << 13 | diff+4096):
+    # the ADPCM nibble (sign + magnitude) that _encode_sample would
+    # produce for a given diff. Diffs are saturated to 13 bits.
+    quantizer = None
+
     def __init__(self):
         # set initial adpcma codec state
         self.reset()
 
+    @classmethod
+    def _build_tables(cls):
+        if cls.trans_diff is not None:
+            return
+        trans_diff = []
+        trans_step = bytearray()
+        quantizer = bytearray()
+        for index, size in enumerate(cls.step_size):
+            for adpcm4 in range(16):
+                magnitude = adpcm4 & 7
+                quantized_diff = ((2*magnitude + 1) * size) >> 3
+                trans_diff.append(-quantized_diff if adpcm4 & 8 else quantized_diff)
+                trans_step.append(max(0, min(index + cls.step_adj[magnitude], 48)))
+            # smallest diff that yields each magnitude, as in _encode_sample:
+            # m3.stepsize + m2.stepsize/2 + m1.stepsize/4
+            thresholds = [((m >> 2) & 1) * size +
+                          ((m >> 1) & 1) * (size >> 1) +
+                          (m & 1) * (size >> 2) for m in range(1, 8)]
+            magnitudes = [bisect_right(thresholds, d) for d in range(4097)]
+            quantizer.extend(0b1000 | magnitudes[-d] for d in range(-4096, 0))
+            quantizer.extend(magnitudes[d] for d in range(4096))
+        cls.trans_diff = trans_diff
+        cls.trans_step = bytes(trans_step)
+        cls.quantizer = bytes(quantizer)
+
     def reset(self):
         # index in the adaptive step size
         self.state_step_index = 0
@@ -141,34 +203,183 @@ class ym2610_adpcma(object):
 
         return decoded_sample12
 
-    def encode_u8(self, pcm8s):
+    def _encode_batch(self, pcm12s, out):
+        # same as _encode_sample, but for a whole buffer of samples, with
+        # all the quantization and state updates done via lookup tables
+        self._build_tables()
+        quantizer = self.quantizer
+        trans_diff = self.trans_diff
+        trans_step = self.trans_step
+        step_index = self.state_step_index
+        sample12 = self.state_sample12
+        append = out.append
+        for s in pcm12s:
+            d = s - sample12 + 4096
+            if not 0 <= d < 8192:
+                d = 0 if d < 0 else 8191
+            adpcm4 = quantizer[(step_index << 13) | d]
+            t = (step_index << 4) | adpcm4
+            sample12 += trans_diff[t]
+            if sample12 > 2047:
+                sample12 = 2047
+            elif sample12 < -2048:
+                sample12 = -2048
+            step_index = trans_step[t]
+            append(adpcm4)
+        self.state_step_index = step_index
+        self.state_sample12 = sample12
+        return out
+
+    def _decode_batch(self, adpcm4s, out):
+        # same as _decode_sample, but for a whole buffer of ADPCM samples
+        self._build_tables()
+        trans_diff = self.trans_diff
+        trans_step = self.trans_step
+        step_index = self.state_step_index
+        sample12 = self.state_sample12
+        append = out.append
+        for a in adpcm4s:
+            t = (step_index << 4) | (a & 15)
+            sample12 += trans_diff[t]
+            if sample12 > 2047:
+                sample12 = 2047
+            elif sample12 < -2048:
+                sample12 = -2048
+            step_index = trans_step[t]
+            append(sample12)
+        self.state_step_index = step_index
+        self.state_sample12 = sample12
+        return out
+
+    def _state_key(self):
+        # current codec state, as a single int
+        return (self.state_step_index << 12) | (self.state_sample12 + 2048)
+
+    def _set_state_key(self, key):
+        self.state_step_index = key >> 12
+        self.state_sample12 = (key & 4095) - 2048
+
+    def _path_keys(self, adpcm4s):
+        # codec states after each ADPCM sample, when decoding adpcm4s
+        # from the current state. The codec state is left unchanged
+        self._build_tables()
+        trans_diff = self.trans_diff
+        trans_step = self.trans_step
+        step_index = self.state_step_index
+        sample12 = self.state_sample12
+        keys = []
+        for a in adpcm4s:
+            t = (step_index << 4) | a
+            sample12 = max(-2048, min(sample12 + trans_diff[t], 2047))
+            step_index = trans_step[t]
+            keys.append((step_index << 12) | (sample12 + 2048))
+        return keys
+
+    def _encode_trellis(self, pcm12s, out, width, path=None):
+        # lookahead encoder: rather than picking the closest ADPCM sample
+        # at each step, keep the `width` encodings of the input with the
+        # lowest squared error so far, and pick the best one at the end.
+        # Encodings that lead to the same codec state are merged, as only
+        # the cheapest of them can be part of the best encoding.
+        # If path is given (codec states of another encoding of pcm12s),
+        # stop as soon as an encoding joins that path. Return the number
+        # of ADPCM samples appended to out.
+        self._build_tables()
+        trans_diff = self.trans_diff
+        trans_step = self.trans_step
+        beam = [(0, self.state_step_index, self.state_sample12, None)]
+        best = None
+        for i, s in enumerate(pcm12s):
+            candidates = {}
+            for cost, step_index, sample12, history in beam:
+                base = step_index << 4
+                for adpcm4 in range(16):
+                    t = base | adpcm4
+                    decoded = sample12 + trans_diff[t]
+                    if decoded > 2047:
+                        decoded = 2047
+                    elif decoded < -2048:
+                        decoded = -2048
+                    e = decoded - s
+                    c = cost + e * e
+                    key = (trans_step[t] << 12) | (decoded + 2048)
+                    prev = candidates.get(key)
+                    if prev is None or c < prev[0]:
+                        candidates[key] = (c, trans_step[t], decoded, (adpcm4, history))
+            if path is not None and path[i] in candidates:
+                best = candidates[path[i]]
+                break
+            beam = nsmallest(width, candidates.values(), key=itemgetter(0))
+        if best is None:
+            best = beam[0]
+        _, self.state_step_index, self.state_sample12, history = best
+        adpcms = bytearray()
+        while history:
+            adpcms.append(history[0])
+            history = history[1]
+        adpcms.reverse()
+        out.extend(adpcms)
+        return len(adpcms)
+
+    def pcm_from_u8(self, pcm8s):
         # ADPCM-A expects 12-bits input samples
-        pcm12s = [(s-128) << 4 for s in pcm8s]
-        return self.encode(pcm12s)
+        return [(s-128) << 4 for s in pcm8s]
 
-    def encode_s8(self, pcm8s):
+    def pcm_from_s8(self, pcm8s):
         # ADPCM-A expects 12-bits input samples
-        pcm12s = [s << 4 for s in pcm8s]
-        return self.encode(pcm12s)
+        return [s << 4 for s in pcm8s]
 
-    def encode_s16(self, pcm16s):
+    def pcm_from_s16(self, pcm16s):
         # ADPCM-A expects 12-bits input samples
-        pcm12s = [s >> 4 for s in pcm16s]
-        return self.encode(pcm12s)
-
-    def encode(self, pcm12s):
+        return [s >> 4 for s in pcm16s]
+
+    def encode_u8(self, pcm8s, batch=True, packed=False, trellis=0, pool=None):
+        return self.encode(self.pcm_from_u8(pcm8s), batch, packed, trellis, pool)
+
+    def encode_s8(self, pcm8s, batch=True, packed=False, trellis=0, pool=None):
+        return self.encode(self.pcm_from_s8(pcm8s), batch, packed, trellis, pool)
+
+    def encode_s16(self, pcm16s, batch=True, packed=False, trellis=0, pool=None):
+        return self.encode(self.pcm_from_s16(pcm16s), batch, packed, trellis, pool)
+
+    def encode_block(self, pcm12s, batch=True, out=None, trellis=0, pool=None):
+        # encode a chunk of a longer input: the codec state is carried
+        # over from the previous chunk, and no padding is added.
+        # ADPCM samples are appended to out (a list by default)
+        out = [] if out is None else out
+        if trellis:
+            return encode_trellis(self, pcm12s, trellis, pool, out)
+        if batch:
+            return self._encode_batch(pcm12s, out)
+        out.extend(self._encode_sample(s) for s in pcm12s)
+        return out
+
+    def encode(self, pcm12s, batch=True, packed=False, trellis=0, pool=None):
         self.reset()
         # YM2610 only plays back multiples of 256 bytes
         # (512 adpcm samples). If the input is not aligned, add some padding
         ceil = ((len(pcm12s)+511)//512)*512;
         padding = [0] * (ceil - len(pcm12s))
-        adpcms = [self._encode_sample(s) for s in pcm12s+padding]
-        return adpcms
-
-    def decode(self, adpcm4s):
+        # when packed output is requested, ADPCM samples are stored
+        # in a bytearray and packed at once at the end
+        adpcms = bytearray() if packed else []
+        if trellis:
+            # the padding is part of the last chunk of the trellis encoder
+            self.encode_block(list(pcm12s) + padding, batch, adpcms, trellis, pool)
+        else:
+            self.encode_block(pcm12s, batch, adpcms)
+            self.encode_block(padding, batch, adpcms)
+        return pack_adpcm_nibbles(adpcms) if packed else adpcms
+
+    def decode(self, adpcm4s, batch=True, packed=False):
         self.reset()
+        if packed:
+            adpcm4s = unpack_adpcm_nibbles(adpcm4s)
         # ADPCM-A decodes 12-bits samples, so upscale the output to wav format
-        pcm12s = [self._decode_sample(s) for s in adpcm4s]
+        if batch:
+            pcm12s = self._decode_batch(adpcm4s, [])
+        else:
+            pcm12s = [self._decode_sample(s) for s in adpcm4s]
         pcm16s = [s << 4 for s in pcm12s]
         return pcm16s
 
@@ -192,10 +403,41 @@ class ym2610_adpcmb(object):
         57, 57, 57, 57, 77, 102, 128, 153,
     ]
 
+    # Precomputed codec transitions, indexed by (step_size << 3 | magnitude):
+    # the unsigned quantized diff to apply to the previous decoded sample,
+    # and the step size to use for the next ADPCM sample.
+    # Built on first use by the batch kernels.
+    trans_diff = None
+    trans_step = None
+
+    # Precomputed quantizer threshold, indexed by step_size: the smallest
+    # diff magnitude that saturates to the max 3-bit magnitude (7). Below
+    # that threshold, the magnitude fits in a small int division.
+    quant_limit = None
+
     def __init__(self):
         # set initial ADPCM-B codec state
         self.reset()
 
+    @classmethod
+    def _build_tables(cls):
+        if cls.trans_diff is not None:
+            return
+        trans_diff = array('H', bytes(2 * 8 * 24577))
+        trans_step = array('H', bytes(2 * 8 * 24577))
+        quant_limit = array('H', bytes(2 * 24577))
+        for step_size in range(127, 24577):
+            for magnitude in range(8):
+                t = (step_size << 3) | magnitude
+                trans_diff[t] = ((2*magnitude + 1) * step_size) >> 3
+                new_step_size = (step_size * cls.step_table[magnitude]) >> 6
+                trans_step[t] = max(127, min(new_step_size, 24576))
+            # (diff << 16) // (step_size << 14) >= 7  <=>  4*diff >= 7*step_size
+            quant_limit[step_size] = (7 * step_size + 3) >> 2
+        cls.trans_diff = trans_diff
+        cls.trans_step = trans_step
+        cls.quant_limit = quant_limit
+
     def reset(self):
         # index in the adaptive step size
         self.state_step_size = 127
@@ -254,35 +496,542 @@ class ym2610_adpcmb(object):
 
         return decoded_sample16
 
-    def encode_u8(self, pcm8s):
+    def _encode_batch(self, pcm16s, out):
+        # same as _encode_sample, but for a whole buffer of samples.
+        # The magnitude is derived from a precomputed saturation threshold
+        # and a division on small ints, rather than the 32-bits ratio
+        # of the reference encoder.
+        self._build_tables()
+        quant_limit = self.quant_limit
+        trans_diff = self.trans_diff
+        trans_step = self.trans_step
+        step_size = self.state_step_size
+        sample16 = self.state_sample16
+        append = out.append
+        for s in pcm16s:
+            diff = s - sample16
+            if diff < 0:
+                diff = -diff
+                magnitude = 7 if diff >= quant_limit[step_size] else (diff << 2) // step_size
+                t = (step_size << 3) | magnitude
+                sample16 -= trans_diff[t]
+                if sample16 < -32768:
+                    sample16 = -32768
+                append(0b1000 | magnitude)
+            else:
+                magnitude = 7 if diff >= quant_limit[step_size] else (diff << 2) // step_size
+                t = (step_size << 3) | magnitude
+                sample16 += trans_diff[t]
+                if sample16 > 32767:
+                    sample16 = 32767
+                append(magnitude)
+            step_size = trans_step[t]
+        self.state_step_size = step_size
+        self.state_sample16 = sample16
+        return out
+
+    def _decode_batch(self, adpcm4s, out):
+        # same as _decode_sample, but for a whole buffer of ADPCM samples
+        self._build_tables()
+        trans_diff = self.trans_diff
+        trans_step = self.trans_step
+        step_size = self.state_step_size
+        sample16 = self.state_sample16
+        append = out.append
+        for a in adpcm4s:
+            t = (step_size << 3) | (a & 7)
+            if a & 8:
+                sample16 -= trans_diff[t]
+                if sample16 < -32768:
+                    sample16 = -32768
+            else:
+                sample16 += trans_diff[t]
+                if sample16 > 32767:
+                    sample16 = 32767
+            step_size = trans_step[t]
+            append(sample16)
+        self.state_step_size = step_size
+        self.state_sample16 = sample16
+        return out
+
+    def _state_key(self):
+        # current codec state, as a single int
+        return (self.state_step_size << 16) | (self.state_sample16 + 32768)
+
+    def _set_state_key(self, key):
+        self.state_step_size = key >> 16
+        self.state_sample16 = (key & 65535) - 32768
+
+    def _path_keys(self, adpcm4s):
+        # codec states after each ADPCM sample, when decoding adpcm4s
+        # from the current state. The codec state is left unchanged
+        self._build_tables()
+        trans_diff = self.trans_diff
+        trans_step = self.trans_step
+        step_size = self.state_step_size
+        sample16 = self.state_sample16
+        keys = []
+        for a in adpcm4s:
+            t = (step_size << 3) | (a & 7)
+            if a & 8:
+                sample16 = max(-32768, sample16 - trans_diff[t])
+            else:
+                sample16 = min(sample16 + trans_diff[t], 32767)
+            step_size = trans_step[t]
+            keys.append((step_size << 16) | (sample16 + 32768))
+        return keys
+
+    def _encode_trellis(self, pcm16s, out, width, path=None):
+        # lookahead encoder, see ym2610_adpcma._encode_trellis
+        self._build_tables()
+        trans_diff = self.trans_diff
+        trans_step = self.trans_step
+        beam = [(0, self.state_step_size, self.state_sample16, None)]
+        best = None
+        for i, s in enumerate(pcm16s):
+            candidates = {}
+            for cost, step_size, sample16, history in beam:
+                base = step_size << 3
+                for magnitude in range(8):
+                    t = base | magnitude
+                    next_step = trans_step[t]
+                    for adpcm4, decoded in ((magnitude, sample16 + trans_diff[t]),
+                                            (0b1000 | magnitude, sample16 - trans_diff[t])):
+                        if decoded > 32767:
+                            decoded = 32767
+                        elif decoded < -32768:
+                            decoded = -32768
+                        e = decoded - s
+                        c = cost + e * e
+                        key = (next_step << 16) | (decoded + 32768)
+                        prev = candidates.get(key)
+                        if prev is None or c < prev[0]:
+                            candidates[key] = (c, next_step, decoded, (adpcm4, history))
+            if path is not None and path[i] in candidates:
+                best = candidates[path[i]]
+                break
+            beam = nsmallest(width, candidates.values(), key=itemgetter(0))
+        if best is None:
+            best = beam[0]
+        _, self.state_step_size, self.state_sample16, history = best
+        adpcms = bytearray()
+        while history:
+            adpcms.append(history[0])
+            history = history[1]
+        adpcms.reverse()
+        out.extend(adpcms)
+        return len(adpcms)
+
+    def pcm_from_u8(self, pcm8s):
         # ADPCM-B expects 16-bits input samples
-        pcm16s = [(s-128) << 8 for s in pcm8s]
-        return self.encode(pcm16s)
+        return [(s-128) << 8 for s in pcm8s]
 
-    def encode_s8(self, pcm8s):
+    def pcm_from_s8(self, pcm8s):
         # ADPCM-B expects 16-bits input samples
-        pcm16s = [s << 8 for s in pcm8s]
-        return self.encode(pcm16s)
+        return [s << 8 for s in pcm8s]
+
+    def pcm_from_s16(self, pcm16s):
+        return pcm16s
+
+    def encode_u8(self, pcm8s, batch=True, packed=False, trellis=0, pool=None):
+        return self.encode(self.pcm_from_u8(pcm8s), batch, packed, trellis, pool)
+
+    def encode_s8(self, pcm8s, batch=True, packed=False, trellis=0, pool=None):
+        return self.encode(self.pcm_from_s8(pcm8s), batch, packed, trellis, pool)
+
+    def encode_s16(self, pcm16s, batch=True, packed=False, trellis=0, pool=None):
+        return self.encode(self.pcm_from_s16(pcm16s), batch, packed, trellis, pool)
 
-    def encode_s16(self, pcm16s):
-        return self.encode(pcm16s)
+    def encode_block(self, pcm16s, batch=True, out=None, trellis=0, pool=None):
+        # encode a chunk of a longer input: the codec state is carried
+        # over from the previous chunk, and no padding is added.
+        # ADPCM samples are appended to out (a list by default)
+        out = [] if out is None else out
+        if trellis:
+            return encode_trellis(self, pcm16s, trellis, pool, out)
+        if batch:
+            return self._encode_batch(pcm16s, out)
+        out.extend(self._encode_sample(s) for s in pcm16s)
+        return out
 
-    def encode(self, pcm16s):
+    def encode(self, pcm16s, batch=True, packed=False, trellis=0, pool=None):
         self.reset()
         # YM2610 only plays back multiples of 256 bytes
         # (512 adpcm samples). If the input is not aligned, add some padding
         ceil = ((len(pcm16s)+511)//512)*512;
         padding = [0] * (ceil - len(pcm16s))
-        adpcms = [self._encode_sample(s) for s in list(pcm16s)+padding]
-        return adpcms
-
-    def decode(self, adpcm4s):
+        # when packed output is requested, ADPCM samples are stored
+        # in a bytearray and packed at once at the end
+        adpcms = bytearray() if packed else []
+        if trellis:
+            # the padding is part of the last chunk of the trellis encoder
+            self.encode_block(list(pcm16s) + padding, batch, adpcms, trellis, pool)
+        else:
+            self.encode_block(pcm16s, batch, adpcms)
+            self.encode_block(padding, batch, adpcms)
+        return pack_adpcm_nibbles(adpcms) if packed else adpcms
+
+    def decode(self, adpcm4s, batch=True, packed=False):
         self.reset()
+        if packed:
+            adpcm4s = unpack_adpcm_nibbles(adpcm4s)
+        if batch:
+            return self._decode_batch(adpcm4s, [])
         pcm16s = [self._decode_sample(s) for s in adpcm4s]
         return pcm16s
 
 
-def encode(input, output, codec):
+def trellis_job(codec_type, key, pcms, start, end, width):
+    # trellis encoding of a chunk of input and its surrounding overlap,
+    # run in a worker process. Return the codec state at the start
+    # of the chunk, and the chunk's ADPCM samples
+    codec = ym2610_adpcma() if codec_type == 'a' else ym2610_adpcmb()
+    codec._set_state_key(key)
+    adpcms = bytearray()
+    codec._encode_trellis(pcms, adpcms, width)
+    if start:
+        codec._set_state_key(key)
+        key = codec._path_keys(adpcms[:start])[-1]
+    return key, adpcms[start:end]
+
+
+def encode_trellis(codec, pcms, width, pool=None, out=None):
+    """Encode PCM samples with the lookahead encoder of a codec, from its
+    current state. The input is split into chunks that are encoded in
+    parallel in the worker processes of pool (if set), and the chunks are
+    stitched back together afterwards."""
+    out = [] if out is None else out
+    codec_type = 'a' if isinstance(codec, ym2610_adpcma) else 'b'
+    chunks = [pcms[i:i+TRELLIS_CHUNK] for i in range(0, len(pcms), TRELLIS_CHUNK)]
+
+    # a chunk can't be encoded before the codec state at the end of the
+    # previous chunk is known. Instead, start encoding a bit before the
+    # chunk, from a state guessed by the fast greedy encoder, and stop a
+    # bit after the chunk. With enough overlap, the encodings of two
+    # consecutive chunks usually settle in the same codec state at the
+    # boundary between the chunks
+    start = codec._state_key()
+    jobs_args = []
+    greedy_pos = 0
+    for i in range(len(chunks)):
+        overlap = min(i * TRELLIS_CHUNK, TRELLIS_OVERLAP)
+        pos = i * TRELLIS_CHUNK - overlap
+        codec._encode_batch(pcms[greedy_pos:pos], bytearray())
+        greedy_pos = pos
+        jobs_args.append((codec_type, codec._state_key(),
+                          pcms[pos:(i + 1) * TRELLIS_CHUNK + TRELLIS_OVERLAP],
+                          overlap, overlap + TRELLIS_CHUNK, width))
+    codec._set_state_key(start)
+
+    if pool and len(chunks) > 1:
+        encoded = list(pool.map(trellis_job, *zip(*jobs_args)))
+    else:
+        encoded = [trellis_job(*args) for args in jobs_args]
+
+    # when a chunk was encoded from the wrong initial state, re-encode its
+    # start from the actual state, until the encoding joins the path of
+    # the chunk's encoding. The two encodings share the same codec state
+    # from there on, so the rest of the chunk's encoding can be reused.
+    for i, (c, (key, adpcms)) in enumerate(zip(chunks, encoded)):
+        if codec._state_key() != key:
+            saved = codec._state_key()
+            codec._set_state_key(key)
+            path = codec._path_keys(adpcms)
+            codec._set_state_key(saved)
+            joined = codec._encode_trellis(c, out, width, path)
+            dbg("Trellis chunk %d: re-encoded %d/%d samples from the actual codec state" %
+                (i, joined, len(c)))
+            adpcms = adpcms[joined:]
+        codec._decode_batch(adpcms, [])
+        out.extend(adpcms)
+    return out
+
+
+# Polyphase windowed-sinc resampler, to convert a stream of 16-bits
+# PCM samples from one sample rate to another. The conversion ratio
+# out_rate/in_rate is reduced to up/down, and every output sample is
+# computed from the `taps` nearest input samples with one of the `up`
+# sub-filters (phases) of a Kaiser-windowed sinc low-pass filter.
+# Input can be fed in blocks of arbitrary length, the resampler keeps
+# track of the input history it needs across blocks.
+#
+class resampler(object):
+    def __init__(self, in_rate, out_rate, taps=16, beta=8.0):
+        g = gcd(in_rate, out_rate)
+        self.up = out_rate // g
+        self.down = in_rate // g
+        self.taps = taps
+        self.half = taps // 2
+        # low-pass at the lowest Nyquist frequency of the two rates
+        cutoff = min(1.0, out_rate / in_rate)
+
+        def bessel_i0(x):
+            res, term, k = 1.0, 1.0, 1
+            while term > 1e-12 * res:
+                term *= (x / (2 * k)) ** 2
+                res += term
+                k += 1
+            return res
+
+        def kernel(d):
+            # windowed sinc, d is the distance in input samples
+            if abs(d) >= self.half:
+                return 0.0
+            s = cutoff if d == 0 else sin(pi * cutoff * d) / (pi * d)
+            return s * bessel_i0(beta * sqrt(1 - (d / self.half) ** 2)) / bessel_i0(beta)
+
+        # phase p filters an output sample located p/up input samples
+        # after an input sample. Coefficients are normalized for unity gain
+        self.phases = []
+        for p in range(self.up):
+            row = [kernel(p / self.up - j) for j in range(-self.half + 1, self.half + 1)]
+            gain = sum(row)
+            self.phases.append([c / gain for c in row])
+        self.reset()
+
+    def reset(self):
+        # input history, including the samples before the start of
+        # the stream (zeros), and absolute index of its first sample
+        self.buf = [0] * (self.half - 1)
+        self.buf_start = -(self.half - 1)
+        # position of the next output sample, in units of 1/up input samples
+        self.pos = 0
+        self.nin = 0
+        self.nout = 0
+
+    def _run(self, end):
+        # generate all the output samples whose input window is available
+        up, down, half, taps = self.up, self.down, self.half, self.taps
+        phases, buf = self.phases, self.buf
+        buf_end = self.buf_start + len(buf)
+        pos = self.pos
+        out = []
+        append = out.append
+        while pos < end:
+            base = pos // up
+            if base + half >= buf_end:
+                break
+            i = base - half + 1 - self.buf_start
+            v = round(sum(map(mul, phases[pos - base * up], buf[i:i + taps])))
+            append(32767 if v > 32767 else -32768 if v < -32768 else v)
+            pos += down
+        self.pos = pos
+        # forget the input samples that are no longer needed
+        keep = pos // up - half + 1 - self.buf_start
+        if keep > 0:
+            del buf[:keep]
+            self.buf_start += keep
+        self.nout += len(out)
+        return out
+
+    def process(self, pcm16s):
+        """Resample a block of input samples, return the available output samples"""
+        self.buf.extend(pcm16s)
+        self.nin += len(pcm16s)
+        return self._run(float('inf'))
+
+    def flush(self):
+        """Return the remaining output samples at the end of the stream"""
+        self.buf.extend([0] * self.half)
+        return self._run(self.nin * self.up)
+
+
+# Reduce 16-bits samples to 12-bits for ADPCM-A, with a triangular
+# probability density function (TPDF) dither of +/- 1 LSB to
+# decorrelate the quantization error from the signal. The noise
+# generator is seeded so that the output is reproducible.
+class tpdf_dither(object):
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+
+    def process(self, pcm16s):
+        r = self.rng.random
+        out = []
+        append = out.append
+        for s in pcm16s:
+            v = int((s + 8 + (r() - r()) * 16) // 16)
+            append(2047 if v > 2047 else -2048 if v < -2048 else v)
+        return out
+
+
+# Lookup tables to move ADPCM nibbles in and out of a packed byte
+SHL4_TABLE = bytes(((b << 4) & 0xff) for b in range(256))
+SHR4_TABLE = bytes((b >> 4) for b in range(256))
+LOW4_TABLE = bytes((b & 0xf) for b in range(256))
+
+
+def pack_adpcm_nibbles(adpcms):
+    """Pack a sequence of 4-bits ADPCM samples into bytes (2 samples per byte)"""
+    # high and low nibbles don't overlap, so the packing can be done as
+    # a bitwise OR of the two halves converted to big integers.
+    # This avoids building any per-sample Python object.
+    nibbles = bytes(adpcms)
+    if len(nibbles) & 1:
+        nibbles += b"\0"
+    hi = nibbles[0::2].translate(SHL4_TABLE)
+    lo = nibbles[1::2]
+    if not hi:
+        return b""
+    packed = int.from_bytes(hi, 'big') | int.from_bytes(lo, 'big')
+    return packed.to_bytes(len(hi), 'big')
+
+
+def unpack_adpcm_nibbles(data):
+    """Unpack bytes into a bytearray of 4-bits ADPCM samples (2 samples per byte)"""
+    adpcms = bytearray(2 * len(data))
+    adpcms[0::2] = data.translate(SHR4_TABLE)
+    adpcms[1::2] = data.translate(LOW4_TABLE)
+    return adpcms
+
+
+# Content-addressed cache of PCM to ADPCM conversions, shared by all
+# the tools that encode PCM data (adpcmtool, vromtool, furtool).
+# An entry is keyed by a hash of the PCM payload, the codec type and
+# the format of the input samples, and it holds the packed ADPCM data.
+# Least recently used entries are evicted when the cache grows
+# past its maximum size.
+#
+# The cache is configured via the environment:
+#   NGDEVKIT_ADPCM_CACHE_DIR: location of the cache
+#     (default: $XDG_CACHE_HOME/ngdevkit/adpcm)
+#   NGDEVKIT_ADPCM_CACHE_SIZE: maximum size of the cache in bytes,
+#     0 disables the cache (default: 256MiB)
+#
+class adpcm_cache(object):
+    # bump this when a change in the codecs modifies their output
+    version = 1
+    # kind of data and file suffix of the cache entries
+    description = "ADPCM"
+    suffix = ".adpcm"
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def hasher(self, codec, fmt):
+        codec_type = b'a' if isinstance(codec, ym2610_adpcma) else b'b'
+        return hashlib.sha256(b"ngdevkit-adpcm-%d-%s-%s:" %
+                              (self.version, codec_type, fmt.encode()))
+
+    def key(self, codec, fmt, data):
+        h = self.hasher(codec, fmt)
+        h.update(data)
+        return h.hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], key + self.suffix)
+
+    def get(self, key):
+        try:
+            with open(self.entry(key), 'rb') as f:
+                data = f.read()
+            # keep track of the last use for LRU eviction
+            os.utime(self.entry(key))
+            return data
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        self._store(key, lambda f: f.write(data))
+
+    def put_file(self, key, path):
+        with open(path, 'rb') as src:
+            self._store(key, lambda f: shutil.copyfileobj(src, f))
+
+    def _store(self, key, write):
+        # write the entry atomically, as several tools may
+        # be accessing the cache concurrently
+        entry = self.entry(key)
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry), suffix=".tmp")
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp, entry)
+        except OSError as e:
+            dbg("Could not save entry in %s cache: %s" % (self.description, e))
+            return
+        self.evict()
+
+    def entries(self):
+        for f in glob.glob(os.path.join(self.path, '*', '*' + self.suffix)):
+            try:
+                st = os.stat(f)
+                yield st.st_mtime, st.st_size, f
+            except OSError:
+                pass
+
+    def evict(self):
+        entries = sorted(self.entries())
+        size = sum(e[1] for e in entries)
+        for _, esize, f in entries:
+            if size <= self.max_size:
+                break
+            dbg("Evicting %s from %s cache" % (f, self.description))
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+            size -= esize
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+CACHE = None
+
+
+def conversion_cache():
+    """ADPCM conversion cache configured from the environment, or None if disabled"""
+    global CACHE
+    if CACHE is None:
+        max_size = int(os.environ.get('NGDEVKIT_ADPCM_CACHE_SIZE', 256*1024*1024))
+        cache_home = os.environ.get('XDG_CACHE_HOME',
+                                    os.path.join(os.path.expanduser('~'), '.cache'))
+        path = os.environ.get('NGDEVKIT_ADPCM_CACHE_DIR',
+                              os.path.join(cache_home, 'ngdevkit', 'adpcm'))
+        CACHE = adpcm_cache(path, max_size) if max_size > 0 else False
+    return CACHE
+
+
+def disable_cache():
+    global CACHE
+    CACHE = False
+    # make sure worker processes don't use the cache either
+    os.environ['NGDEVKIT_ADPCM_CACHE_SIZE'] = '0'
+
+
+def pcm_array(typecode, data):
+    """Compact array of PCM samples from raw little endian data"""
+    samples = array(typecode)
+    samples.frombytes(data[:len(data) - len(data) % samples.itemsize])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples
+
+
+def encode_pcm_data(codec, data, fmt, batch=True, trellis=0, pool=None):
+    """Encode raw PCM data into packed ADPCM data, via the conversion cache.
+    fmt is the type of PCM samples in data: 'u8', 's8' or 's16' (little endian)"""
+    cache = conversion_cache()
+    if cache:
+        key = cache.key(codec, fmt + ("-t%d" % trellis if trellis else ""), data)
+        adpcm = cache.get(key)
+        if adpcm is not None:
+            dbg("Reusing ADPCM conversion from cache (%s)" % key)
+            return adpcm
+    if fmt == 's16':
+        adpcm = codec.encode_s16(pcm_array('h', data), batch, True, trellis, pool)
+    elif fmt == 's8':
+        adpcm = codec.encode_s8(pcm_array('b', data), batch, True, trellis, pool)
+    else:
+        adpcm = codec.encode_u8(bytes(data), batch, True, trellis, pool)
+    if cache:
+        cache.put(key, adpcm)
+    return adpcm
+
+
+def encode(input, output, codec, batch=True, trellis=0, pool=None):
     dbg("Trying to encode input file %s" % input)
 
     try:
@@ -312,27 +1061,137 @@ def encode(input, output, codec):
         w.close()
 
     insize = len(rawdata)
-    dbg("Input is %s bytes long, or %d PCM samples" % (insize, insize/w.getsampwidth()))
-    # encode input samples into ADPCM-A or ADPCM-B 4-bits samples
-    if w.getsampwidth() == 1:
-        samples = struct.unpack('<%dB' % (insize), rawdata)
-        adpcms = codec.encode_u8(list(samples))
-    else:
-        samples = struct.unpack('<%dh' % (insize>>1), rawdata)
-        adpcms = codec.encode_s16(list(samples))
-    # pack the resulting adpcm samples into bytes (2 samples per byte)
-    adpcms_packed = [(adpcms[i] << 4 | adpcms[i+1]) for i in range(0, len(adpcms), 2)]
+    nsamples = insize//w.getsampwidth()
+    dbg("Input is %s bytes long, or %d PCM samples" % (insize, nsamples))
+    # encode input samples into packed ADPCM-A or ADPCM-B 4-bits samples
+    fmt = 'u8' if w.getsampwidth() == 1 else 's16'
+    adpcms_packed = encode_pcm_data(codec, rawdata, fmt, batch, trellis, pool)
     outsize = len(adpcms_packed)
-    paddingsize = (len(adpcms)-len(samples)) >> 1
+    paddingsize = outsize - ((nsamples+1) >> 1)
     dbg("Encoded ADPCM output is %d bytes long, Including %d bytes "
         "of padding for YM2610 boundaries" % (outsize, paddingsize))
 
     dbg("Saving ADPCM output to file %s" % output)
     with open(output, 'wb') as o:
-        o.write(bytes(adpcms_packed))
+        o.write(adpcms_packed)
+
 
+def encode_stream(input, output, codec, batch=True, resample=None, dither=False,
+                  trellis=0, pool=None):
+    dbg("Trying to encode input file %s in streaming mode" % input)
 
-def decode(input, output, codec, samplerate):
+    try:
+        w = wave.open(input, 'rb')
+        # input sanity checks
+        if w.getnchannels() > 1:
+            error("Only mono WAV file is supported")
+        if w.getsampwidth() not in [1, 2]:
+            error("Only 8bits or 16bits per sample is supported")
+        if w.getcomptype() != 'NONE':
+            error("Only uncompressed WAV file is supported")
+        wavrate = w.getframerate()
+        if isinstance(codec, ym2610_adpcma) and int(wavrate) != 18500 and not resample:
+            dbg("Input framerate %s differs from 18500, playback will sound different" % wavrate)
+    except FileNotFoundError:
+        error("%s does not exist" % input)
+    except wave.Error as e:
+        error("Streaming mode only supports WAV input: %s" % e)
+    except Exception as e:
+        error("Unexpected error while reading %s: %s" % (input, e))
+
+    # optional processing stages that run before the encoder, on 16-bits
+    # samples: resampling, and dithered conversion to 12-bits for ADPCM-A
+    fmt = 'u8' if w.getsampwidth() == 1 else 's16'
+    stages = []
+    if resample and resample != wavrate:
+        dbg("Resampling input from %d Hz to %d Hz" % (wavrate, resample))
+        stages.append(resampler(wavrate, resample))
+        fmt += "-r%d" % resample
+    if dither and isinstance(codec, ym2610_adpcma):
+        dbg("Dithering input to 12-bits samples")
+        stages.append(tpdf_dither())
+        fmt += "-d"
+        # the dither stage already outputs 12-bits samples
+        to_pcm = lambda pcm12s: pcm12s
+    else:
+        to_pcm = codec.pcm_from_s16
+    if trellis:
+        # trellis chunks don't line up with the ones of the non-streaming
+        # encoder, so the output differs slightly from the latter
+        fmt += "-t%d-s" % trellis
+
+    sampwidth = w.getsampwidth()
+    if sampwidth == 1:
+        # work on 16-bits samples, this doesn't change the codec's output
+        typecode = 'B'
+        to_pcm16 = lambda pcm8s: [(s-128) << 8 for s in pcm8s]
+    else:
+        typecode = 'h'
+        to_pcm16 = lambda pcm16s: pcm16s
+
+    def process(samples, final=False):
+        for s in stages:
+            samples = s.process(samples)
+            if final and isinstance(s, resampler):
+                samples += s.flush()
+        return to_pcm(samples)
+
+    # look up the conversion cache, the PCM payload is hashed
+    # in a first pass over the input file
+    cache = conversion_cache()
+    if cache:
+        h = cache.hasher(codec, fmt)
+        while rawdata := w.readframes(STREAM_BLOCK_FRAMES):
+            h.update(rawdata)
+        key = h.hexdigest()
+        w.rewind()
+        adpcm = cache.get(key)
+        if adpcm is not None:
+            dbg("Reusing ADPCM conversion from cache (%s)" % key)
+            with open(output, 'wb') as o:
+                o.write(adpcm)
+            w.close()
+            return
+
+    # the codec state is carried over from one block to the next,
+    # and an odd trailing ADPCM sample is kept until the next block
+    # so that the output is packed exactly as in non-streaming mode
+    codec.reset()
+    nsamples = 0
+    pending = b""
+    dbg("Saving ADPCM output to file %s" % output)
+    with open(output, 'wb') as o:
+        while True:
+            rawdata = w.readframes(STREAM_BLOCK_FRAMES)
+            if not rawdata:
+                break
+            samples = process(to_pcm16(pcm_array(typecode, rawdata)))
+            nsamples += len(samples)
+            adpcms = codec.encode_block(samples, batch, bytearray(pending), trellis, pool)
+            pending = adpcms[-1:] if len(adpcms) & 1 else b""
+            o.write(pack_adpcm_nibbles(adpcms[:len(adpcms) & ~1]))
+        # remaining samples from the processing stages
+        if stages:
+            samples = process([], final=True)
+            nsamples += len(samples)
+            adpcms = codec.encode_block(samples, batch, bytearray(pending), trellis, pool)
+            pending = adpcms[-1:] if len(adpcms) & 1 else b""
+            o.write(pack_adpcm_nibbles(adpcms[:len(adpcms) & ~1]))
+        # YM2610 only plays back multiples of 256 bytes
+        # (512 adpcm samples). If the input is not aligned, add some padding
+        ceil = ((nsamples+511)//512)*512
+        padding = [0] * (ceil - nsamples)
+        o.write(pack_adpcm_nibbles(codec.encode_block(padding, batch, bytearray(pending),
+                                                      trellis, pool)))
+    w.close()
+    if cache:
+        cache.put_file(key, output)
+
+    dbg("Encoded ADPCM output is %d bytes long, Including %d bytes "
+        "of padding for YM2610 boundaries" % (ceil >> 1, len(padding) >> 1))
+
+
+def decode(input, output, codec, samplerate, batch=True):
     dbg("Trying to decode ADPCM input file %s" % input)
 
     try:
@@ -344,14 +1203,10 @@ def decode(input, output, codec, samplerate):
         error("Unexpected error while reading %s: %s" % (input, e))
 
     insize = len(rawdata)
-    adpcm4s = []
-    for d in rawdata:
-        adpcm4s.append(d >> 4)
-        adpcm4s.append(d & 0b1111)
-    dbg("Input is %s bytes long, or %d ADPCM samples" % (insize, len(adpcm4s)))
+    dbg("Input is %s bytes long, or %d ADPCM samples" % (insize, 2*insize))
 
     # decode ADPCM samples to signed 16-bits output
-    pcm16s = codec.decode(adpcm4s)
+    pcm16s = codec.decode(rawdata, batch, packed=True)
     raw16s = struct.pack('<%dh' % len(pcm16s), *pcm16s)
 
     dbg("Saving WAV output to file %s" % output)
@@ -364,6 +1219,89 @@ def decode(input, output, codec, samplerate):
     w.close()
 
 
+def convert(action, input, output, codec, samplerate, stream, batch,
+            resample=False, dither=False, trellis=0, jobs=1):
+    if action != 'encode':
+        decode(input, output, codec, samplerate, batch)
+        return
+    # a single pool of workers for all the chunks of the trellis encoder
+    pool = ProcessPoolExecutor(max_workers=jobs) if trellis and jobs > 1 else None
+    try:
+        if stream or resample or dither:
+            # resampling and dithering run in the streaming encoder
+            encode_stream(input, output, codec, batch,
+                          samplerate if resample else None, dither, trellis, pool)
+        else:
+            encode(input, output, codec, batch, trellis, pool)
+    finally:
+        if pool:
+            pool.shutdown()
+
+
+def convert_job(action, input, output, codec_type, samplerate, stream, batch,
+                resample, dither, trellis):
+    # entry point of a batch conversion job, run in a worker process.
+    # files are already processed in parallel, so the trellis
+    # encoder runs in the worker process
+    codec = ym2610_adpcma() if codec_type == 'a' else ym2610_adpcmb()
+    start = time.perf_counter()
+    convert(action, input, output, codec, samplerate, stream, batch, resample, dither,
+            trellis)
+    return time.perf_counter() - start
+
+
+def batch_inputs(paths, action, codec_type):
+    # directories are expanded into the files they contain that
+    # can be processed by the current action
+    if action == 'encode':
+        exts = ['.wav']
+    else:
+        exts = ['.adpcma' if codec_type == 'a' else '.adpcmb']
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            found = [f for f in glob.glob(os.path.join(p, '*'))
+                     if os.path.isfile(f) and os.path.splitext(f)[1].lower() in exts]
+            dbg("Found %d files to process in directory %s" % (len(found), p))
+            files.extend(sorted(found))
+        else:
+            files.append(p)
+    return files
+
+
+def batch_output(pattern, input):
+    # name of the output file, based on the name of the input file
+    name = os.path.splitext(os.path.basename(input))[0]
+    return pattern.format(name=name, dir=os.path.dirname(input) or '.')
+
+
+def convert_batch(files, pattern, action, codec_type, samplerate, stream, batch,
+                  resample, dither, trellis, jobs):
+    # convert all files in parallel, and report timing or failure
+    # for each file without aborting the whole batch
+    failures = 0
+    total_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for f in files:
+            output = batch_output(pattern, f)
+            futures.append((f, output,
+                            pool.submit(convert_job, action, f, output, codec_type,
+                                        samplerate, stream, batch, resample, dither,
+                                        trellis)))
+        for f, output, future in futures:
+            try:
+                elapsed = future.result()
+                print("%s -> %s: %.3fs" % (f, output, elapsed))
+            except (Exception, SystemExit) as e:
+                # error() exits with a message, report it as a failure
+                failures += 1
+                print("%s -> %s: FAILED (%s)" % (f, output, e), file=sys.stderr)
+    print("%d file(s) processed in %.3fs, %d failure(s)" %
+          (len(files), time.perf_counter() - total_start, failures))
+    return failures
+
+
 def main():
     global VERBOSE
     parser = argparse.ArgumentParser(
@@ -384,14 +1322,50 @@ def main():
                        help='encode a input WAV file into ADPCM')
     pmode.add_argument('-d', '--decode', action='store_true',
                        help='decode raw ADPCM input into a WAV file')
-
-    parser.add_argument('FILE', help='file to process')
-    parser.add_argument('-o', '--output', required=True,
-                        help='name of output file')
+    pmode.add_argument('--clear-cache', action='store_true',
+                       help='remove all entries from the ADPCM conversion cache')
+
+    parser.add_argument('FILE', nargs='*',
+                        help='file to process. With several files or directories, '
+                        'all files are processed in batch mode')
+    parser.add_argument('-o', '--output',
+                        help='name of output file. In batch mode, pattern of output '
+                        'files, where {name} is substituted by the basename of the '
+                        'input file and {dir} by its directory')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of files processed in parallel in batch mode, '
+                        'or of chunks of input processed in parallel by the '
+                        'trellis encoder (default: 1)')
 
     parser.add_argument('-r', '--rate',
                         type=int,
-                        help='set sample rate of decoded ADPCM-B')
+                        help='set sample rate of decoded ADPCM-B, or target '
+                        'sample rate of the resampled input')
+
+    parser.add_argument('-R', '--resample', action='store_true', default=False,
+                        help='resample the input WAV file to the target sample '
+                        'rate before encoding (default: 18500 for ADPCM-A)')
+
+    parser.add_argument('-D', '--dither', action='store_true', default=False,
+                        help='dither 16-bits input to 12-bits before ADPCM-A encoding')
+
+    parser.add_argument('-T', '--trellis', type=int, default=0, metavar='WIDTH',
+                        help='encode with a lookahead encoder that keeps the WIDTH '
+                        'best candidate encodings at each sample. Slower, but '
+                        'lowers the encoding error (default: 0, disabled)')
+
+    parser.add_argument('-s', '--stream', action='store_true', default=False,
+                        help='encode the input WAV file block by block, '
+                        'with constant memory usage')
+
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        default=True,
+                        help='do not use the ADPCM conversion cache')
+
+    parser.add_argument('--reference', dest='batch', action='store_false',
+                        default=True,
+                        help='use the slower, per-sample reference codec')
 
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                         default=False, help='print details of processing')
@@ -399,6 +1373,24 @@ def main():
     arguments = parser.parse_args()
     VERBOSE = arguments.verbose
 
+    if not arguments.cache:
+        disable_cache()
+
+    if arguments.clear_cache:
+        cache = conversion_cache()
+        if cache:
+            dbg("Clearing ADPCM conversion cache %s" % cache.path)
+            cache.clear()
+        sys.exit(0)
+
+    if arguments.trellis < 0:
+        error("trellis width must be a positive number")
+
+    if not arguments.FILE:
+        error("no input file specified")
+    if not arguments.output:
+        error("no output file specified")
+
     codec = ym2610_adpcma() if arguments.codec == 'a' else ym2610_adpcmb()
 
     if arguments.rate == None:
@@ -406,10 +1398,22 @@ def main():
     else:
         samplerate = arguments.rate
 
-    if arguments.encode:
-        encode(arguments.FILE, arguments.output, codec)
+    action = 'encode' if arguments.encode else 'decode'
+
+    batch_mode = len(arguments.FILE) > 1 or os.path.isdir(arguments.FILE[0])
+    if batch_mode:
+        if '{name}' not in arguments.output:
+            error("output must be a pattern containing '{name}' in batch mode")
+        files = batch_inputs(arguments.FILE, action, arguments.codec)
+        failures = convert_batch(files, arguments.output, action, arguments.codec,
+                                 samplerate, arguments.stream, arguments.batch,
+                                 arguments.resample, arguments.dither,
+                                 arguments.trellis, max(1, arguments.jobs))
+        sys.exit(1 if failures else 0)
     else:
-        decode(arguments.FILE, arguments.output, codec, samplerate)
+        convert(action, arguments.FILE[0], arguments.output, codec, samplerate,
+                arguments.stream, arguments.batch, arguments.resample, arguments.dither,
+                arguments.trellis, max(1, arguments.jobs))
 
 
 if __name__ == '__main__':
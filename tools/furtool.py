@@ -19,15 +19,20 @@
 
 import argparse
 import base64
+import hashlib
+import io
+import mmap
 import os
+import pickle
 import re
 import sys
 import zlib
+from concurrent.futures import ProcessPoolExecutor
 from math import log
-from dataclasses import dataclass, field
-from struct import pack, unpack, unpack_from
-from adpcmtool import ym2610_adpcma, ym2610_adpcmb
-from copy import deepcopy
+from dataclasses import dataclass, field, is_dataclass, replace
+from struct import Struct, unpack
+from adpcmtool import ym2610_adpcma, ym2610_adpcmb, encode_pcm_data, adpcm_cache
+from copy import copy, deepcopy
 from functools import reduce
 from operator import ior
 
@@ -47,9 +52,20 @@ def dbg(s):
         print(s, file=sys.stderr)
 
 
+# precompiled decoders for the fields of a Furnace module
+U1 = Struct("B")
+U2 = Struct("<H")
+U4 = Struct("<I")
+UF4 = Struct("<f")
+S4 = Struct("<i")
+
+
 class binstream(object):
+    # data is parsed in place through a memoryview: reading a block
+    # of data returns a view on the underlying buffer, not a copy
     def __init__(self, data=b""):
-        self.data = bytearray(data)
+        self.data = data if isinstance(data, (bytes, bytearray, mmap.mmap)) else bytes(data)
+        self.view = memoryview(self.data)
         self.pos = 0
 
     def bytes(self):
@@ -59,7 +75,7 @@ class binstream(object):
         return self.pos == len(self.data)
 
     def read(self, n):
-        res = self.data[self.pos:self.pos + n]
+        res = self.view[self.pos:self.pos + n]
         self.pos += n
         return res
 
@@ -67,53 +83,54 @@ class binstream(object):
         self.pos = pos
 
     def u1(self):
-        res = unpack_from("B", self.data, self.pos)[0]
+        res = self.data[self.pos]
         self.pos += 1
         return res
 
     def u2(self):
-        res = unpack_from("<H", self.data, self.pos)[0]
+        res = U2.unpack_from(self.data, self.pos)[0]
         self.pos += 2
         return res
 
     def u4(self):
-        res = unpack_from("<I", self.data, self.pos)[0]
+        res = U4.unpack_from(self.data, self.pos)[0]
         self.pos += 4
         return res
 
     def uf4(self):
-        res = unpack_from("<f", self.data, self.pos)[0]
+        res = UF4.unpack_from(self.data, self.pos)[0]
         self.pos += 4
         return res
 
     def s4(self):
-        res = unpack_from("<i", self.data, self.pos)[0]
+        res = S4.unpack_from(self.data, self.pos)[0]
         self.pos += 4
         return res
 
     def ustr(self):
-        res = []
-        b = self.u1()
-        while b != 0:
-            res.append(b)
-            b = self.u1()
-        return bytearray(res).decode("utf-8")
+        end = self.data.find(b"\0", self.pos)
+        res = str(self.view[self.pos:end], "utf-8")
+        self.pos = end + 1
+        return res
 
     def write(self, data):
+        # a buffer can't be resized while a memoryview exports it,
+        # so release the view and recreate it after the write
+        self.view.release()
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
         self.data.extend(data)
+        self.view = memoryview(self.data)
         self.pos += len(data)
 
     def e1(self, data):
-        self.data.extend(pack("B", data))
-        self.pos += 1
+        self.write(U1.pack(data))
 
     def e2(self, data):
-        self.data.extend(pack("<H", data))
-        self.pos += 2
+        self.write(U2.pack(data))
 
     def e4(self, data):
-        self.data.extend(pack("<I", data))
-        self.pos += 4
+        self.write(U4.pack(data))
 
 
 def ubit(data, msb, lsb):
@@ -280,9 +297,11 @@ def read_element_sng2(mod, bs):
     assert (element_end_pos - element_init_pos) == element_size
 
 
-def read_module(bs):
-    global HALF_SSG_VOL
-    mod = fur_module()
+def read_module_directory(bs, mod):
+    """Parse the module header and return its element directory, as a
+    dict of element pointers indexed by element type. Old modules have
+    no element directory, their song data is parsed along with the
+    header, and None is returned."""
     assert bs.read(16) == b"-Furnace module-"  # magic
     version = bs.u2()
     bs.u2() # reserved
@@ -291,7 +310,8 @@ def read_module(bs):
 
     # with version > 240, parsing differs significantly
     if version <= 240:
-        return read_module_pre240(bs, mod)
+        read_module_pre240(bs, mod)
+        return None
 
     assert bs.read(4) == b"INF2"
     block_size = bs.read(4) # TODO assert correct size below
@@ -352,6 +372,22 @@ def read_module(bs):
         elements[el_type] = elements_pos
         el_type = bs.u1()
 
+    # INS2 elements: pointers to instruments get parsed later
+    mod.instruments = elements[0x04]
+
+    # WAVE element: skip, we don't use it
+
+    # SMP2 elements: pointers to samples get parsed later
+    mod.samples = elements[0x06]
+
+    # PATN elements: pointers to patterns get parsed later
+    mod.patterns = elements[0x07]
+
+    return elements
+
+
+def read_module_song(bs, mod, elements):
+    global HALF_SSG_VOL
     # FLAG element: check whether the master SSG and ADPCM/FM volumes match
     # otherwise consider the module relies on Furnace defaults (currently half volume)
     if 0x02 in elements:
@@ -369,34 +405,110 @@ def read_module(bs):
     read_element_sng2(mod, bs)
     bs.seek(saved_pos)
 
-    # INS2 elements: pointers to instruments get parsed later
-    mod.instruments = elements[0x04]
-
-    # WAVE element: skip, we don't use it
-
-    # SMP2 elements: pointers to samples get parsed later
-    mod.samples = elements[0x06]
-
-    # PATN elements: pointers to patterns get parsed later
-    mod.patterns = elements[0x07]
-
     # CFLAG element: TODO, right now we do not parse compatibility flags
 
     # CMNT element: TODO, right now we do not parse comments
 
     # GROV element: TODO, right now we do not parse groove patterns
 
+
+def read_module(bs):
+    mod = fur_module()
+    elements = read_module_directory(bs, mod)
+    if elements is not None:
+        read_module_song(bs, mod, elements)
     return mod
 
 
+class fur_elements(object):
+    """Sequence of elements of a module, each parsed on first access
+    with reader(bs, index)."""
+
+    def __init__(self, bs, ptrs, reader):
+        self.bs = bs
+        self.ptrs = ptrs
+        self.reader = reader
+        self.items = [None] * len(ptrs)
+
+    def __len__(self):
+        return len(self.ptrs)
+
+    def __getitem__(self, i):
+        item = self.items[i]
+        if item is None:
+            # an element can be accessed while another one is parsed
+            # (e.g. an instrument's sample), so keep the stream position
+            saved_pos = self.bs.pos
+            self.bs.seek(self.ptrs[i])
+            item = self.items[i] = self.reader(self.bs, i)
+            self.bs.seek(saved_pos)
+        return item
+
+    def __setitem__(self, i, item):
+        self.items[i] = item
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class fur_module_index(object):
+    """Furnace module whose elements are parsed on demand.
+
+    Opening a module only parses its header and its element directory.
+    The song data, samples, instruments and patterns are parsed from the
+    module buffer when they are first accessed."""
+
+    def __init__(self, modname):
+        self.prefix = module_id_from_path(modname)
+        self.bs = load_module(modname)
+        self.mod = fur_module()
+        self.elements = read_module_directory(self.bs, self.mod)
+        # old modules have their song data parsed along with the header
+        self._song_parsed = self.elements is None
+        self._samples = None
+        self._instruments = None
+
+    @property
+    def song(self):
+        # SNG2 and FLAG elements: orders, speeds and chip volumes
+        if not self._song_parsed:
+            saved_pos = self.bs.pos
+            read_module_song(self.bs, self.mod, self.elements)
+            self.bs.seek(saved_pos)
+            self._song_parsed = True
+        return self.mod
+
+    @property
+    def samples(self):
+        if self._samples is None:
+            self._samples = fur_elements(
+                self.bs, self.mod.samples,
+                lambda bs, i: read_sample(self.prefix, bs, i))
+        return self._samples
+
+    @property
+    def instruments(self):
+        if self._instruments is None:
+            # SSG macros depend on the chip volumes of the song
+            m = self.song
+            self._instruments = fur_elements(
+                self.bs, m.instruments,
+                lambda bs, i: read_instrument(m, i, bs, self.samples))
+        return self._instruments
+
+    def patterns(self, reader):
+        """Patterns of the module, parsed with reader(mod, bs)"""
+        m = self.song
+        return fur_elements(self.bs, m.patterns, lambda bs, i: reader(m, bs))
+
+
 def check_chip_flags(ptr, bs):
     global HALF_SSG_VOL
     saved_pos = bs.pos
     bs.seek(ptr)
     assert bs.read(4) == b"FLAG"
     size = bs.u4()
-    data = bs.read(size)
-    datastr=bytearray(data).decode("utf-8")
+    datastr = str(bs.read(size), "utf-8")
     flags = {}
     for d in datastr.split("\n")[:-1]: # last item is "\0"
         k, v = d.split("=")
@@ -479,6 +591,24 @@ class ssg_macro:
     autoenv: bool = False
 
 
+@dataclass
+class fur_pattern:
+    """Notes and effects for one channel of a particular pattern in the song"""
+    channel: int = 0
+    index: int = 0
+    fxcols: int = 1
+    rows: list = field(default_factory=list, repr=False)
+
+
+@dataclass
+class fur_row:
+    """A single note with common attributes and effects"""
+    note: int = -1
+    ins: int = -1
+    vol: int = -1
+    fx: list[int, int] = field(default_factory=list)
+
+
 @dataclass
 class adpcm_a_instrument:
     load: object = field(repr=False)
@@ -575,7 +705,7 @@ def read_macro_data(length, bs):
         speed = bs.u1()
         header_end = bs.pos
         assert header_end - header_start == header_len
-        data = [bs.u1() for i in range(length)]
+        data = list(bs.read(length))
         macros[code]=data
     assert bs.pos == max_pos
     return macros, macro_loop
@@ -812,7 +942,7 @@ def read_instrument(m, nth, bs, smp):
             assert bs.u1()==0, "sample map unsupported"
         else:
             warning("unexpected feature in sample %02x%s: %s" % \
-                    (nth, (" (%s)"%name if name else ""), feat.decode()))
+                    (nth, (" (%s)"%name if name else ""), str(feat, "utf-8")))
             bs.read(length)
     # for ADPCM sample, populate sample data
     if itype in [37, 38]:
@@ -872,7 +1002,10 @@ def read_sample(prefix, bs, sample_idx):
     bs.u2()  # unused flags
     loop_start, loop_end = bs.s4(), bs.s4()
     bs.read(16)  # unused rom allocation
-    data = bs.read(data_bytes) + bytearray(data_padding)
+    # sample data is a view on the module's buffer, unless it needs padding
+    data = bs.read(data_bytes)
+    if data_padding:
+        data = bytes(data) + bytes(data_padding)
     # generate a ASM name for the instrument
     insname = "%s_%02x_%s"%(prefix, sample_idx, re.sub(r"\W|^(?=\d)", "_", name).lower())
     ins = {5: adpcm_a_sample,
@@ -888,21 +1021,63 @@ def read_sample(prefix, bs, sample_idx):
 def convert_sample(pcm_sample, totype):
     codec = {37: ym2610_adpcma,
              38: ym2610_adpcmb}[totype]()
-    if isinstance(pcm_sample, pcm8_sample):
-        # NOTE: PCM8 seems to always be signed in Furnace
-        pcm8s = unpack('<%db' % (len(pcm_sample.data)), pcm_sample.data)
-        adpcms=codec.encode_s8(pcm8s)
-    else:
-        pcm16s = unpack('<%dh' % (len(pcm_sample.data)>>1), pcm_sample.data)
-        adpcms=codec.encode_s16(pcm16s)
-    adpcms_packed = [(adpcms[i] << 4 | adpcms[i+1]) for i in range(0, len(adpcms), 2)]
+    # NOTE: PCM8 seems to always be signed in Furnace
+    fmt = 's8' if isinstance(pcm_sample, pcm8_sample) else 's16'
+    adpcms_packed = encode_pcm_data(codec, pcm_sample.data, fmt)
     # convert sample to the right class
     converted = {37: adpcm_a_sample,
-                 38: adpcm_b_sample}[totype](pcm_sample.name, bytes(adpcms_packed))
+                 38: adpcm_b_sample}[totype](pcm_sample.name, adpcms_packed)
     converted.frequency = pcm_sample.frequency
     return converted
 
 
+def instrument_sample(bs):
+    """Type of an instrument and the sample it uses, without parsing it"""
+    assert bs.read(4) == b"INS2"
+    endblock = bs.pos + bs.u4()
+    bs.u2()  # format version
+    itype = bs.u2()
+    sample = 0
+    while bs.pos < endblock:
+        feat = bs.read(2)
+        length = bs.u2()
+        feat_end = bs.pos + length
+        if feat == b"SM":
+            sample = bs.u2()
+        bs.seek(feat_end)
+    return itype, sample
+
+
+def convert_samples(smp, ins_ptrs, bs, jobs):
+    """Convert all the PCM samples of a module to ADPCM in a process pool.
+    A sample is converted to ADPCM-B if an ADPCM-B instrument uses it,
+    and to ADPCM-A otherwise, as the instruments would when loading it."""
+    saved_pos = bs.pos
+    totypes = {}
+    for p in ins_ptrs:
+        bs.seek(p)
+        itype, sample = instrument_sample(bs)
+        if itype == 38:
+            totypes[sample] = 38
+        elif itype == 37:
+            totypes.setdefault(sample, 37)
+    bs.seek(saved_pos)
+    pcms = [(i, totypes.get(i, 37)) for i, s in enumerate(smp)
+            if type(s) in [pcm8_sample, pcm16_sample]]
+    if not pcms:
+        return
+    for i, totype in pcms:
+        warning("sample '%s' is encoded in PCM, converting to ADPCM-%s"%\
+                (smp[i].name, "A" if totype==37 else "B"))
+    # sample data may be a view on the module buffer, send a copy to the workers
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        converted = pool.map(convert_sample,
+                             [replace(smp[i], data=bytes(smp[i].data)) for i, _ in pcms],
+                             [totype for _, totype in pcms])
+        for (i, _), c in zip(pcms, converted):
+            smp[i] = c
+
+
 def module_id_from_path(p):
     f = os.path.splitext(os.path.basename(p))[0]
     return re.sub(r"\W|^(?=\d)", "_", f).lower()
@@ -922,7 +1097,8 @@ def check_for_unused_samples(smp, bs):
         if type(s) in [pcm8_sample, pcm16_sample]:
             smp[i] = convert_sample(s, 37)
 
-def asm_fm_instrument(ins, fd):
+def fm_instrument_regs(ins):
+    """Register values of a FM instrument, in the order nullsound loads them"""
     dtmul = tuple(ebit(ins.ops[i].detune, 6, 4) | ebit(ins.ops[i].multiply, 3, 0) for i in range(4))
     tl = tuple(ebit(ins.ops[i].total_level, 6, 0) for i in range(4))
     ksar = tuple(ebit(ins.ops[i].key_scale, 7, 6) | ebit(ins.ops[i].attack_rate, 4, 0) for i in range(4))
@@ -932,6 +1108,11 @@ def asm_fm_instrument(ins, fd):
     ssgeg = tuple(ebit(ins.ops[i].ssg_eg, 3, 0) for i in range(4))
     fbalgo = (ebit(ins.feedback, 5, 3) | ebit(ins.algorithm, 2, 0),)
     amsfms = (ebit(0b11, 7, 6) | ebit(ins.am_sense, 5, 4) | ebit(ins.fm_sense, 2, 0),)
+    return dtmul, tl, ksar, amdr, sr, slrr, ssgeg, fbalgo, amsfms
+
+
+def asm_fm_instrument(ins, fd):
+    dtmul, tl, ksar, amdr, sr, slrr, ssgeg, fbalgo, amsfms = fm_instrument_regs(ins)
     print("%s:" % ins.name, file=fd)
     print("        ;;       OP1 - OP3 - OP2 - OP4", file=fd)
     print("        .db     0x%02x, 0x%02x, 0x%02x, 0x%02x   ; DT | MUL" % dtmul, file=fd)
@@ -947,34 +1128,62 @@ def asm_fm_instrument(ins, fd):
     print("", file=fd)
 
 
+def compact_macro_steps(steps, bits, loop):
+    # group identical consecutive ticks into run-length steps
+    # (0xfe, count, step...), which nullsound evaluates count times.
+    # a run never spans the loop tick, as the loop label must point
+    # to the start of a step
+    runs = []
+    for tick, (step, b) in enumerate(zip(steps, bits)):
+        if runs and tick != loop and runs[-1][1] == step and \
+           runs[-1][2] == b and runs[-1][3] < 255:
+            runs[-1][3] += 1
+        else:
+            runs.append([tick, step, b, 1])
+    compact = []
+    for tick, step, b, count in runs:
+        # only keep the run when it is smaller than the repeated steps
+        if count * (len(step)+1) > len(step)+1+2:
+            compact.append((tick, count, [0xfe, count]+step, b))
+        else:
+            compact.extend([(tick+i, 1, step, b) for i in range(count)])
+    return compact
+
+
 def asm_ssg_macro(mac, fd):
     def next_sentinel(pos):
         while(mac.prog[pos]!=255): pos+=2
         return pos
     prev = 0
     cur = next_sentinel(0)
-    lines = []
+    steps = []
     # split macro into list of steps
     while cur != prev:
-        line = mac.prog[prev:cur+1]
-        lines.append(", ".join(["0x%02x"%x for x in line]))
+        steps.append(mac.prog[prev:cur+1])
         prev = cur+1
         cur = next_sentinel(prev)
-    # there should be a load value for each line
-    assert len(lines) == len(mac.bits)
+    # there should be a load value for each step
+    assert len(steps) == len(mac.bits)
+    compact = compact_macro_steps(steps, mac.bits, mac.loop)
+    size = sum([len(x)+1 for x in steps])
+    compact_size = sum([len(x[2])+1 for x in compact])
+    dbg("MACRO %s: %d ticks, %d bytes -> %d bytes (%d saved)"%(
+        mac.name, len(steps), size, compact_size, size-compact_size))
+    lines = [", ".join(["0x%02x"%x for x in c[2]]) for c in compact]
     # macro actions
     print("%s:" % mac.name, file=fd)
     longest = max([len(x) for x in lines]) + len(", 0x..")
-    step = 0
     print("        ;; macro load function", file=fd)
     print("        .dw     %s" % mac.load_name, file=fd)
     print("        ;; macro actions", file=fd)
-    for l, b in zip(lines, mac.bits):
+    for l, (step, count, _, b) in zip(lines, compact):
         fmtstep = ("%s, 0x%02x"%(l,b)).ljust(longest)
         if step==mac.loop:
             print("%s:" % mac.loop_name, file=fd)
-        print("        .db     %s   ; tick %d"%(fmtstep, step), file=fd)
-        step += 1
+        if count == 1:
+            print("        .db     %s   ; tick %d"%(fmtstep, step), file=fd)
+        else:
+            print("        .db     %s   ; ticks %d-%d"%(fmtstep, step, step+count-1), file=fd)
     print("        .db     %s   ; end"%"0xff".ljust(longest), file=fd)
     if mac.loop != 255:
         print("        .dw     %s   ; loop"%mac.loop_name.ljust(longest), file=fd)
@@ -1105,10 +1314,6 @@ def generate_instruments(mod, sample_map_name, ins_name, bank, ins, fd):
     print("        ;; offset of ADPCM samples in ROMs", file=fd)
     print('        .include "%s"' % sample_map_name, file=fd)
     print("", file=fd)
-    inspp = {fm_instrument: asm_fm_instrument,
-             ssg_macro: asm_ssg_macro,
-             adpcm_a_instrument: asm_adpcm_a_instrument,
-             adpcm_b_instrument: asm_adpcm_b_instrument}
     if ins:
         print("%s::" % ins_name, file=fd)
         for i in ins:
@@ -1117,40 +1322,336 @@ def generate_instruments(mod, sample_map_name, ins_name, bank, ins, fd):
         print(";; no instruments defined in this song", file=fd)
     print("", file=fd)
     for i in ins:
-        inspp[type(i)](i, fd)
+        asm_instrument(i, fd)
 
 
-def generate_sample_map(mod, smp, fd):
+def asm_instrument(ins, fd):
+    inspp = {fm_instrument: asm_fm_instrument,
+             ssg_macro: asm_ssg_macro,
+             adpcm_a_instrument: asm_adpcm_a_instrument,
+             adpcm_b_instrument: asm_adpcm_b_instrument}
+    inspp[type(ins)](ins, fd)
+
+
+def renamed_instrument(ins, name):
+    # copy of an instrument, with all its ASM labels derived from name
+    ins = copy(ins)
+    ins.name = name
+    if isinstance(ins, ssg_macro):
+        ins.load_name = name + "_load_func"
+        ins.loop_name = name + "_loop"
+    return ins
+
+
+def shared_instrument_key(ins):
+    # instruments are identical when they generate the same ASM
+    # once their labels are renamed, i.e. the same bytes in ROM.
+    # ADPCM instruments reference the labels of their sample, which are
+    # prefixed by the module's name, so samples are compared by content
+    ins = renamed_instrument(ins, "_")
+    if isinstance(ins, (adpcm_a_instrument, adpcm_b_instrument)):
+        smp = copy(ins.sample)
+        smp.name = "sample_%s" % hashlib.sha256(smp.data).hexdigest()
+        ins._sample = smp
+    asm = io.StringIO()
+    asm_instrument(ins, asm)
+    return type(ins), asm.getvalue()
+
+
+def generate_shared_instruments(songs, sample_map_name, fd):
+    """Instrument tables of several songs, where identical instruments
+    are only emitted once per Z80 memory area. songs is a list of
+    (instrument table name, bank, instruments), each song keeps its own
+    table, so instrument indices in NSS streams are unchanged."""
+    print(";;; NSS instruments and macros, shared between songs", file=fd)
+    print(";;; generated by furtool.py (ngdevkit)", file=fd)
+    print("", file=fd)
+    print("        ;; offset of ADPCM samples in ROMs", file=fd)
+    print('        .include "%s"' % sample_map_name, file=fd)
+    print("", file=fd)
+    banks = sorted(set(bank for _, bank, _ in songs), key=lambda b: -1 if b is None else b)
+    for bank in banks:
+        prefix = "shared" if bank is None else "shared_bank%d" % bank
+        unique = {}
+        tables = []
+        total = 0
+        for table_name, song_bank, ins in songs:
+            if song_bank != bank:
+                continue
+            labels = []
+            for i in ins:
+                key = shared_instrument_key(i)
+                if key not in unique:
+                    kind = "macro" if isinstance(i, ssg_macro) else "instr"
+                    unique[key] = renamed_instrument(i, "%s_%s_%02x" % (prefix, kind, len(unique)))
+                labels.append(unique[key].name)
+            tables.append((table_name, labels))
+            total += len(ins)
+        dbg("%s: %d instruments, %d after deduplication" %
+            ("CODE" if bank is None else "BANK%d" % bank, total, len(unique)))
+        if bank != None:
+            print("        .area   BANK%d"%bank, file=fd)
+        else:
+            print("        .area   CODE", file=fd)
+        print("", file=fd)
+        for table_name, labels in tables:
+            print("%s::" % table_name, file=fd)
+            for l in labels:
+                print("        .dw     %s" % l, file=fd)
+            if not labels:
+                print(";; no instruments defined in this song", file=fd)
+            print("", file=fd)
+        for i in unique.values():
+            asm_instrument(i, fd)
+
+
+def generate_sample_map(mod, smp, fd, sample_data=None):
+    """Sample map of a module. If sample_data is set, samples are stored
+    in that binary file, and the map only references them by offset and
+    hash. Otherwise samples are stored in the map as base64."""
     print("# ADPCM sample map - generated by furtool.py (ngdevkit)", file=fd)
     print("# ---", file=fd)
     print("# Song title: %s" % mod.name, file=fd)
     print("# Song author: %s" % mod.author, file=fd)
     print("#", file=fd)
     stype = {adpcm_a_sample: "adpcm_a", adpcm_b_sample: "adpcm_b"}
+    if sample_data:
+        data_fd = open(sample_data, "wb")
+        offsets = {}
     for s in smp:
         print("- %s:" % stype[type(s)], file=fd)
         print("    name: %s" % s.name, file=fd)
-        print("    # length: %d" % len(s.data), file=fd)
-        print("    uri: data:;base64,%s" % base64.b64encode(s.data).decode(), file=fd)
+        if sample_data:
+            # identical samples are only stored once
+            digest = hashlib.sha256(s.data).hexdigest()
+            if digest not in offsets:
+                offsets[digest] = data_fd.tell()
+                data_fd.write(s.data)
+            print("    uri: file://%s" % sample_data, file=fd)
+            print("    offset: %d" % offsets[digest], file=fd)
+            print("    length: %d" % len(s.data), file=fd)
+            print("    sha256: %s" % digest, file=fd)
+        else:
+            print("    # length: %d" % len(s.data), file=fd)
+            print("    uri: data:;base64,%s" % base64.b64encode(s.data).decode(), file=fd)
+    if sample_data:
+        data_fd.close()
+
+
+# Size of the chunks of compressed module read at once
+ZLIB_CHUNK = 65536
 
 
 def load_module(modname):
     with open(modname, "rb") as f:
-        furbin = f.read()
+        header = f.read(2)
+        f.seek(0)
+        # Furnace modules are usually zlib-compressed, check the zlib header
+        # (deflate method, valid checksum) rather than trying to decompress
+        if len(header) == 2 and (header[0] & 0x0f) == 8 and \
+           ((header[0] << 8) | header[1]) % 31 == 0:
+            # decompress chunk by chunk, so that the compressed module
+            # is never entirely in memory next to the decompressed one
+            d = zlib.decompressobj()
+            furbin = bytearray()
+            for chunk in iter(lambda: f.read(ZLIB_CHUNK), b""):
+                furbin += d.decompress(chunk)
+            furbin += d.flush()
+            return binstream(furbin)
+        # uncompressed modules are parsed straight from the file
         try:
-            furbin = zlib.decompress(furbin)
-        except:
-            pass
-        return binstream(furbin)
+            return binstream(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except ValueError:
+            # empty file, which can't be mapped
+            return binstream(f.read())
+
+
+# On-disk cache of parsed Furnace modules, shared by all the tools that
+# read modules (furtool, nsstool, vromtool). An entry is keyed by a hash
+# of the .fur file, its name and the tools' sources, and it holds the song,
+# samples, instruments and patterns of the module, with PCM samples
+# already converted to ADPCM.
+#
+# The cache is configured via the environment:
+#   NGDEVKIT_FUR_CACHE_DIR: location of the cache
+#     (default: $XDG_CACHE_HOME/ngdevkit/fur)
+#   NGDEVKIT_FUR_CACHE_SIZE: maximum size of the cache in bytes,
+#     0 disables the cache (default: 64MiB)
+#
+class module_cache(adpcm_cache):
+    description = "Furnace module"
+    suffix = ".module"
+    # the parsed module depends on the code of the tools that produced it
+    tool_sources = ["furtool.py", "nsstool.py", "adpcmtool.py"]
+    tools_hash = None
+
+    @classmethod
+    def tools_digest(cls):
+        if cls.tools_hash is None:
+            h = hashlib.sha256()
+            tooldir = os.path.dirname(os.path.abspath(__file__))
+            for src in cls.tool_sources:
+                with open(os.path.join(tooldir, src), "rb") as f:
+                    h.update(f.read())
+            cls.tools_hash = h.digest()
+        return cls.tools_hash
+
+    def key(self, modname):
+        h = hashlib.sha256(self.tools_digest())
+        # sample labels are prefixed with the module's name
+        h.update(module_id_from_path(modname).encode() + b":")
+        with open(modname, "rb") as f:
+            for chunk in iter(lambda: f.read(ZLIB_CHUNK), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+
+@dataclass
+class fur_parsed_module:
+    song: fur_module
+    samples: list
+    instruments: list
+    patterns: dict
+    # SSG volume tweaks, set as a side effect of parsing
+    half_ssg_vol: bool = False
+    ssg_used: bool = False
+
+
+MODULE_CACHE = None
+
+
+def parsed_module_cache():
+    """Parsed-module cache configured from the environment, or None if disabled"""
+    global MODULE_CACHE
+    if MODULE_CACHE is None:
+        max_size = int(os.environ.get("NGDEVKIT_FUR_CACHE_SIZE", 64*1024*1024))
+        cache_home = os.environ.get("XDG_CACHE_HOME",
+                                    os.path.join(os.path.expanduser("~"), ".cache"))
+        path = os.environ.get("NGDEVKIT_FUR_CACHE_DIR",
+                              os.path.join(cache_home, "ngdevkit", "fur"))
+        MODULE_CACHE = module_cache(path, max_size) if max_size > 0 else False
+    return MODULE_CACHE
+
+
+def parse_whole_module(modname, jobs=1):
+    # patterns are decoded by nsstool, which imports this module
+    from nsstool import read_all_patterns
+    module = fur_module_index(modname)
+    m = module.song
+    smp = module.samples
+    if jobs > 1:
+        convert_samples(smp, m.instruments, module.bs, jobs)
+    ins = list(module.instruments)
+    check_for_unused_samples(smp, module.bs)
+    p = read_all_patterns(m, module.bs)
+    # detach the parsed module from the module buffer, and resolve
+    # the deferred sample loads so that instruments can be saved
+    smp = list(smp)
+    for s in smp:
+        s.data = bytes(s.data)
+    for i in ins:
+        if type(i) in [adpcm_a_instrument, adpcm_b_instrument]:
+            i.sample
+            i.load = None
+    return fur_parsed_module(m, smp, ins, p, HALF_SSG_VOL, SSG_USED)
+
+
+def plain_data(obj, memo):
+    """Convert a parsed module into builtin types only, so that it can be
+    saved in the cache independently of the module the classes live in"""
+    if is_dataclass(obj):
+        if id(obj) in memo:
+            # object shared with another part of the module (e.g. samples)
+            return {"__ref__": memo[id(obj)]}
+        memo[id(obj)] = len(memo)
+        return {"__class__": type(obj).__name__,
+                "fields": {k: plain_data(v, memo) for k, v in vars(obj).items()}}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(plain_data(x, memo) for x in obj)
+    elif isinstance(obj, dict):
+        return {k: plain_data(v, memo) for k, v in obj.items()}
+    return obj
+
+
+def from_plain_data(data, classes, objs):
+    """Rebuild a parsed module converted with plain_data()"""
+    if isinstance(data, dict):
+        if "__ref__" in data:
+            return objs[data["__ref__"]]
+        if "__class__" in data:
+            cls = classes[data["__class__"]]
+            obj = cls.__new__(cls)
+            objs.append(obj)
+            obj.__dict__.update({k: from_plain_data(v, classes, objs)
+                                 for k, v in data["fields"].items()})
+            return obj
+        return {k: from_plain_data(v, classes, objs) for k, v in data.items()}
+    elif isinstance(data, (list, tuple)):
+        return type(data)(from_plain_data(x, classes, objs) for x in data)
+    return data
+
+
+def parsed_module_classes():
+    classes = [fur_parsed_module, fur_module, fm_operator, fm_instrument,
+               ssg_macro, adpcm_a_instrument, adpcm_b_instrument,
+               adpcm_a_sample, adpcm_b_sample, pcm8_sample, pcm16_sample,
+               fur_pattern, fur_row]
+    return {c.__name__: c for c in classes}
+
+
+def cached_module(cache, key):
+    """Parsed module from the parsed-module cache, or None if not cached"""
+    global HALF_SSG_VOL, SSG_USED
+    data = cache.get(key)
+    if data is None:
+        return None
+    try:
+        parsed = from_plain_data(pickle.loads(data), parsed_module_classes(), [])
+    except Exception as e:
+        dbg("Could not load parsed module from cache: %s" % e)
+        return None
+    dbg("Reusing parsed module from cache (%s)" % key)
+    HALF_SSG_VOL = parsed.half_ssg_vol
+    SSG_USED = parsed.ssg_used
+    return parsed
+
+
+def parsed_module(modname, jobs=1):
+    """Fully parsed module, loaded from the parsed-module cache when possible.
+    Return None if the cache is disabled."""
+    cache = parsed_module_cache()
+    if not cache:
+        return None
+    key = cache.key(modname)
+    parsed = cached_module(cache, key)
+    if parsed is None:
+        parsed = parse_whole_module(modname, jobs)
+        cache.put(key, pickle.dumps(plain_data(parsed, {}), pickle.HIGHEST_PROTOCOL))
+    return parsed
 
 
 def samples_from_module(modname):
-    bs = load_module(modname)
-    m = read_module(bs)
-    smp = read_samples(module_id_from_path(modname), m.samples, bs)
-    ins = read_instruments(m, m.instruments, smp, bs)
-    check_for_unused_samples(smp, bs)
-    return smp
+    # only reuse an existing cache entry, parsing the whole module
+    # to populate the cache is more work than extracting the samples
+    cache = parsed_module_cache()
+    parsed = cache and cached_module(cache, cache.key(modname))
+    if parsed:
+        return parsed.samples
+    module = fur_module_index(modname)
+    smp = module.samples
+    # PCM samples are converted to ADPCM based on the instruments that
+    # use them, so instruments only need to be parsed in that case
+    if any(type(s) in [pcm8_sample, pcm16_sample] for s in smp):
+        list(module.instruments)
+        check_for_unused_samples(smp, module.bs)
+    return list(smp)
+
+
+def instruments_from_module(modname):
+    parsed = parsed_module(modname)
+    if parsed:
+        return parsed.instruments
+    return list(fur_module_index(modname).instruments)
 
 
 def main():
@@ -1179,6 +1680,13 @@ def main():
     parser.add_argument("-m", "--map",
                         help="Name of the ADPCM sample map file to include")
 
+    parser.add_argument("-d", "--sample-data", metavar="FILE",
+                        help="with --samples, store the sample data in a binary "
+                        "file rather than in the sample map")
+
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of PCM samples converted to ADPCM in parallel")
+
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true",
                         default=False, help="print details of processing")
 
@@ -1186,11 +1694,17 @@ def main():
     VERBOSE = arguments.verbose
 
     # load all samples data in memory from the map file
-    bs = load_module(arguments.FILE)
-    m = read_module(bs)
-    smp = read_samples(module_id_from_path(arguments.FILE), m.samples, bs)
-    ins = read_instruments(m, m.instruments, smp, bs)
-    check_for_unused_samples(smp, bs)
+    parsed = parsed_module(arguments.FILE, arguments.jobs)
+    if parsed:
+        m, smp, ins = parsed.song, parsed.samples, parsed.instruments
+    else:
+        module = fur_module_index(arguments.FILE)
+        m = module.song
+        smp = module.samples
+        if arguments.jobs > 1:
+            convert_samples(smp, m.instruments, module.bs, arguments.jobs)
+        ins = list(module.instruments)
+        check_for_unused_samples(smp, module.bs)
 
     if arguments.output:
         outfd = open(arguments.output, "w")
@@ -1216,7 +1730,7 @@ def main():
             print("Volume of SSG channel is halved in Furnace, SSG macros were tweaked to compensate.\n"
                   "To fix that, please set the SSG volume to 256 in Furnace in the 'Chip Manager' window.")
     elif arguments.action == "samples":
-        generate_sample_map(m, smp, outfd)
+        generate_sample_map(m, smp, outfd, arguments.sample_data)
     else:
         error("Unknown action: %s" % arguments.action)
 
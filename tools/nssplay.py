@@ -0,0 +1,1458 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026 Damien Ciabrini
+# This file is part of ngdevkit
+#
+# ngdevkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# ngdevkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with ngdevkit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""nssplay.py - play compiled NSS streams and log YM2610 register writes."""
+
+import argparse
+import sys
+from dataclasses import dataclass, field
+from furtool import fur_module_index, parsed_module, samples_from_module, fm_instrument_regs
+from furtool import adpcm_a_instrument, adpcm_b_instrument
+import nsstool
+from nsstool import read_all_patterns, compile_compact_nss, nss_to_blob
+from nsstool import nss_stream_cursor, stream_name, ctx_op_name, channel_name
+from vromtool import allocate_samples
+
+VERBOSE = False
+
+
+def error(s):
+    sys.exit("ERROR: " + s)
+
+
+def dbg(s):
+    if VERBOSE:
+        print(s, file=sys.stderr)
+
+
+# pipeline state bits (nullsound/pipeline.inc)
+STATE_PLAYING = 0x01
+STATE_EVAL_MACRO = 0x02
+STATE_LOAD_NOTE = 0x04
+STATE_LOAD_VOL = 0x08
+STATE_LOAD_REGS = 0x10
+STATE_LOAD_PAN = 0x20
+STATE_NOTE_STARTED = 0x80
+# SSG and ADPCM-A specific meaning of some pipeline bits
+STATE_LOAD_WAVEFORM = 0x20
+STATE_START_NOTE = 0x04
+
+# FX bits (nullsound/struct-fx.inc)
+FX_TRIGGER = 0x01
+FX_SLIDE = 0x02
+FX_VIBRATO = 0x04
+FX_ARPEGGIO = 0x08
+FX_LEGATO = 0x10
+FX_QUICK_LEGATO = 0x20
+
+TRIGGER_DELAY = 0x01
+TRIGGER_CUT = 0x02
+TRIGGER_RETRIGGER = 0x04
+TRIGGER_LOAD_NOTE = 0x10
+TRIGGER_LOAD_VOL = 0x20
+
+SLIDE_DIRECTION = 0x01
+SLIDE_PORTAMENTO = 0x02
+SLIDE_KEEP_RUNNING = 0x04
+
+# timer flags (nullsound/timer.s)
+TIMER_FLAGS_EXT_FM2 = 0x40
+
+# YM2610 register of FM channels, and output operators for each algorithm
+FM_YM2610_CHANNELS = [1, 2, 5, 6]
+FM_OUT_OPS = [0x8, 0x8, 0x8, 0x8, 0xc, 0xe, 0xe, 0xf]
+
+# extended FM2 operators, in the order nullsound stores them (OP1, OP3, OP2, OP4)
+FM2_OP_FNUM2_REGS = [0xad, 0xac, 0xae, 0xa6]
+FM2_OP_TL_REGS = [0x42, 0x46, 0x4a, 0x4e]
+FM2_OP_MASKS = [0x10, 0x40, 0x20, 0x80]
+# offset of OP1..OP4 in that order
+FM2_OP_OFFSETS = [0, 2, 1, 3]
+
+# 1/4 sine wave used by the vibrato (nullsound/fx-vibrato.s)
+VIBRATO_SINE = [0x0000, 0x0190, 0x0310, 0x04a0, 0x0610, 0x0780, 0x08e0, 0x0a20,
+                0x0b50, 0x0c50, 0x0d40, 0x0e10, 0x0ec0, 0x0f40, 0x0fb0, 0x0fe0,
+                0x1000, 0x0fe0, 0x0fb0, 0x0f40, 0x0ec0, 0x0e10, 0x0d40, 0x0c50,
+                0x0b50, 0x0a20, 0x08e0, 0x0780, 0x0610, 0x04a0, 0x0310, 0x0190]
+VIBRATO_SINE += [0x8000 | x for x in VIBRATO_SINE]
+
+# note to octave and semitone (0xOS). Like in nullsound, the table is
+# aligned on 128 bytes and followed by the sine table, so out-of-range
+# notes yield the same garbage as in the driver
+OCTAVE_SEMITONE = [(n // 12) << 4 | n % 12 for n in range(96)] + [0] * 32
+OCTAVE_SEMITONE += [b for x in VIBRATO_SINE for b in (x & 0xff, x >> 8)]
+
+
+def rotl8(v, n):
+    return ((v << n) | (v >> (8 - n))) & 0xff
+
+
+def signed8(v):
+    return v - 256 if v & 0x80 else v
+
+
+def scale_int24(dist, factor):
+    """Scale a 24bit distance by a 16bit factor in [0..1[, like nullsound"""
+    mul = dist * (factor >> 8) + ((dist * (factor & 0xff)) >> 8)
+    return (mul >> 8) & 0xffffff
+
+
+#
+# Pitch tables (nullsound/tables/build-pitch-tables.py)
+#
+
+@dataclass
+class pitch_tables:
+    ssg_tunes: list
+    ssg_dists: list
+    ssg_deltas: list
+    fm_fnums: list
+    fm_dists: list
+    fm_deltas: list
+
+
+def delta_table(freq_fun):
+    return [int((freq_fun(i / 128) - freq_fun(0)) / (freq_fun(1) - freq_fun(0)) * 65536)
+            for i in range(128)]
+
+
+def build_pitch_tables(clock):
+    """Fixed-point tune and F-num tables used by nullsound to compute
+    the YM2610 pitch of a note, for a given YM2610 clock"""
+    mvs = clock == 24000000 / 3
+    semitones = [i - 45 for i in range(7 * 12)]
+
+    def tune_f(s):
+        return clock / (64 * 440 * 2 ** (s / 12))
+
+    def fnum_f(s):
+        block = int(s + 57) // 12
+        return 440 * 2 ** (s / 12) * 9440540 * 16 * 2 / clock / 2 ** block
+
+    tunes = [int(tune_f(s) * 4096) for s in semitones]
+    tunes.append(int(tune_f(semitones[-1] + 1) * 4096))
+    for i, tweak in ([(16, 3), (52, 1), (78, 3)] if mvs else [(23, 3), (35, 3)]):
+        tunes[i] -= tweak
+    dists = [tunes[i] - tunes[i + 1] for i in range(len(semitones))]
+    tunes.pop()
+    # tables are indexed by octave and semitone (0xOS), octave 0 is
+    # unreachable and mirrors octave 1
+    def by_octave_semitone(values):
+        rows = [values[0:12]] + [values[i:i + 12] for i in range(0, len(values), 12)]
+        return [x for r in rows for x in r + [0] * 4]
+
+    fnums = [int(fnum_f(s) * 4096) for s in semitones[0:12]]
+    fnums.append(int(fnum_f(semitones[0]) * 4096) * 2)
+    fine_tuning = [1, 4, 0, 0, 0, 2, 1, 1, 0, 2, 3, 2, 2] if mvs else \
+        [0, 1, 0, 0, 0, 0, 0, 1, 2, 0, 0, 2, 3]
+    fnums = [f + t for f, t in zip(fnums, fine_tuning)]
+    fm_dists = [fnums[i + 1] - fnums[i] for i in range(12)]
+    fnums.pop()
+
+    return pitch_tables(ssg_tunes=by_octave_semitone(tunes),
+                        ssg_dists=by_octave_semitone(dists),
+                        ssg_deltas=delta_table(tune_f),
+                        fm_fnums=fnums + [0] * 4,
+                        fm_dists=fm_dists + [0] * 4,
+                        fm_deltas=delta_table(fnum_f))
+
+
+#
+# Mirrored state of the channels
+#
+
+@dataclass
+class fx_state:
+    """Note or volume of a channel, and the FX that update it"""
+    cfg: int = 0
+    data16: int = 0
+    fx: int = 0
+    slide_cfg: int = 0
+    slide_inc16: int = 0
+    slide_end: int = 0
+    slide_max: int = 0
+    vibrato_speed: int = 0
+    vibrato_depth: int = 0
+    vibrato_pos: int = 0
+    vibrato_pos16: int = 0
+
+
+@dataclass
+class channel_state:
+    """State common to all channel pipelines"""
+    pipeline: int = 0
+    note: fx_state = field(default_factory=fx_state)
+    vol: fx_state = field(default_factory=fx_state)
+    detune: int = 0
+    arpeggio_speed: int = 1
+    arpeggio_count: int = 0
+    arpeggio_2nd: int = 0
+    arpeggio_3rd: int = 0
+    arpeggio_pos: int = 0
+    arpeggio_pos8: int = 0
+    legato_delay: int = 0
+    legato_transpose: int = 0
+    trigger_action: int = 0
+    trigger_note: int = 0
+    trigger_vol: int = 0
+    trigger_arg: int = 0
+    trigger_cur: int = 0
+
+    def __post_init__(self):
+        self.note.slide_max = 0x5f
+
+
+@dataclass
+class fm_state(channel_state):
+    instrument: int = 0xff
+    # output level of operators, stored as OP1, OP3, OP2, OP4
+    levels: list = field(default_factory=lambda: [0] * 4)
+    out_ops: int = 0
+    ops_enabled: int = 0
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.vol.slide_max = 0x7f
+
+
+@dataclass
+class ssg_state(channel_state):
+    # envelope shape, fine, coarse, volume, waveform, arpeggio
+    props: list = field(default_factory=lambda: [0] * 6)
+    macro: list = None
+    macro_keys: list = None
+    macro_loop: int = None
+    macro_pos: int = None
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.vol.slide_max = 0xf
+
+
+@dataclass
+class adpcm_a_state(channel_state):
+    instr_vol: int = 0xff
+    out_vol: int = 0
+    pan: int = 0xc0
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.vol.slide_max = 0x1f
+
+
+@dataclass
+class adpcm_b_state(channel_state):
+    instrument: int = 0xff
+    start_cmd: int = 0x80
+    base_octave: int = 0
+    delta_ns: list = field(default_factory=lambda: [0] * 17)
+    pan: int = 0
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.vol.slide_max = 0xff
+        self.vol.cfg = 0xff
+
+
+def macro_steps(mac):
+    """Steps of a SSG macro, as lists of (offset, value) properties updates
+    paired with the pipeline bits to set once the step is evaluated"""
+    steps, step = [], []
+    prog = mac.prog[:-1]
+    i = 0
+    while i < len(prog):
+        if prog[i] == 255:
+            steps.append(step)
+            step = []
+            i += 1
+        else:
+            step.append((prog[i], prog[i + 1]))
+            i += 2
+    return list(zip(steps, mac.bits))
+
+
+def fm_instrument_data(ins):
+    """The bytes of a FM instrument, as nullsound reads them"""
+    dtmul, tl, ksar, amdr, sr, slrr, ssgeg, fbalgo, amsfms = fm_instrument_regs(ins)
+    return list(dtmul + tl + ksar + amdr + sr + slrr + ssgeg + fbalgo + amsfms + tl)
+
+
+#
+# FX (nullsound/fx-*.s)
+#
+
+def slide_init_source(ctx):
+    if not ctx.fx & FX_SLIDE:
+        ctx.data16 = ctx.cfg << 8
+
+
+def slide_init_increment(ctx, speed, shift):
+    ctx.slide_inc16 = ((speed << 8) >> shift) & 0xffff
+
+
+def slide_init_target(ctx, cfg, depth):
+    ctx.slide_cfg &= ~SLIDE_DIRECTION
+    end = (cfg + depth) & 0xff
+    if depth & 0x80:
+        ctx.slide_cfg |= SLIDE_DIRECTION
+        end = (end - 1) & 0xff
+    ctx.slide_end = end
+
+
+def slide_init(ctx, cfg, speed, shift):
+    ctx.slide_cfg = cfg
+    slide_init_increment(ctx, speed, shift)
+    slide_init_source(ctx)
+    ctx.slide_end = 0xffff if cfg & SLIDE_DIRECTION else ctx.slide_max
+    ctx.fx |= FX_SLIDE
+
+
+def slide_update(s, ctx, value):
+    """A new note or volume while a slide is running"""
+    if ctx.slide_cfg & SLIDE_PORTAMENTO:
+        slide_init_target(ctx, ctx.cfg, (value - ctx.cfg) & 0xff)
+    else:
+        s.pipeline &= ~STATE_NOTE_STARTED
+        ctx.cfg = value
+        ctx.data16 = value << 8
+
+
+def eval_slide_step(ctx):
+    if ctx.slide_cfg & SLIDE_DIRECTION:
+        new = ctx.data16 - ctx.slide_inc16
+        cur = (0xff00 if new < 0 else 0) | ((new & 0xffff) >> 8)
+        new &= 0xffff
+        res = (ctx.slide_end - cur) & 0xffff
+    else:
+        new = (ctx.data16 + ctx.slide_inc16) & 0xffff
+        res = ((new >> 8) - ctx.slide_end) & 0xffff
+    if not res & 0x8000:
+        # the slide reached its end
+        end = ctx.slide_end & 0xff
+        if ctx.slide_cfg & SLIDE_DIRECTION:
+            end = (end + 1) & 0xff
+        ctx.cfg = end
+        new = end << 8
+        if not ctx.slide_cfg & SLIDE_KEEP_RUNNING:
+            ctx.fx &= ~FX_SLIDE
+    ctx.data16 = new
+
+
+def eval_vibrato_step(ctx):
+    ctx.vibrato_pos = (ctx.vibrato_pos + ctx.vibrato_speed) & 63
+    w = VIBRATO_SINE[ctx.vibrato_pos]
+    sine = w & 0x7fff
+    # 8bit multiplication of the sine by the depth, like the driver
+    hl, e = 0, 0
+    for bit in (4, 3, 2, 1, 0):
+        if ctx.vibrato_depth >> bit & 1:
+            hl = (hl + sine) & 0xffff
+        if bit:
+            hl <<= 1
+            if bit == 1:
+                e = hl >> 16
+            hl &= 0xffff
+    res = (e << 8) | (hl >> 8)
+    if w & 0x8000:
+        res = -res & 0xffff
+    ctx.vibrato_pos16 = res
+
+
+def eval_arpeggio_step(s):
+    s.arpeggio_count -= 1
+    if s.arpeggio_count > 0:
+        return
+    s.arpeggio_count = s.arpeggio_speed
+    s.arpeggio_pos -= 1
+    if s.arpeggio_pos < 0:
+        s.arpeggio_pos += 3
+    s.arpeggio_pos8 = {2: s.arpeggio_2nd, 1: s.arpeggio_3rd}.get(s.arpeggio_pos, 0)
+
+
+def eval_legato_step(s):
+    if s.legato_delay:
+        s.legato_delay -= 1
+        return
+    hi = ((s.note.data16 >> 8) + s.legato_transpose) & 0xff
+    s.note.data16 = hi << 8 | (s.note.data16 & 0xff)
+    s.pipeline |= STATE_LOAD_NOTE
+    s.legato_transpose = 0
+    s.note.fx &= ~(FX_LEGATO | FX_QUICK_LEGATO)
+
+
+def eval_fx(s):
+    """Run the volume and note FX of a pipeline, and flag the registers
+    that need to be reloaded"""
+    if s.vol.fx & FX_SLIDE:
+        eval_slide_step(s.vol)
+        s.pipeline |= STATE_LOAD_VOL
+    if s.note.fx & FX_SLIDE:
+        eval_slide_step(s.note)
+        s.pipeline |= STATE_LOAD_NOTE
+    if s.note.fx & FX_VIBRATO:
+        eval_vibrato_step(s.note)
+        s.pipeline |= STATE_LOAD_NOTE
+    if s.note.fx & FX_ARPEGGIO:
+        eval_arpeggio_step(s)
+        s.pipeline |= STATE_LOAD_NOTE
+    if s.note.fx & FX_QUICK_LEGATO:
+        eval_legato_step(s)
+        s.pipeline |= STATE_LOAD_NOTE
+
+
+def fixed_point_note(s, transpose=0):
+    pos16 = (s.note.data16 + s.detune + ((s.arpeggio_pos8 + transpose) << 8)) & 0xffff
+    if s.note.fx & FX_VIBRATO:
+        pos16 = (pos16 + s.note.vibrato_pos16) & 0xffff
+    return pos16
+
+
+class nss_player:
+    """Run compiled NSS streams tick by tick like nullsound, and log the
+    register writes it sends to the YM2610"""
+
+    def __init__(self, ins, samples, clock, frequency, speeds, log):
+        self.ins = ins
+        self.samples = samples
+        self.clock = clock
+        self.tables = build_pitch_tables(clock)
+        self.log = log
+        self.time = 0.0
+        self.tick = 0
+        self.stopped = False
+        self.loop = False
+        self.macros = {}
+        # timer and row state (nullsound/timer.s, nullsound/stream.s)
+        self.timer_flags = 0
+        # the timer runs at the module's frequency until the first tempo opcode
+        self.timer_tb = round(256 - 4000000 / (1152 * frequency))
+        self.ticks = list(speeds)
+        self.pos = 0
+        self.next_row()
+        self.count = self.per_row
+        # channels
+        self.fm = [fm_state() for _ in range(4)]
+        self.fm2_ops = [fm_state() for _ in range(4)]
+        self.fm_pan = [0xc0] * 4
+        self.fm2_fb = 0x40
+        self.ssg = [ssg_state() for _ in range(3)]
+        self.ssg_enabled = 0x3f
+        self.adpcm_a = [adpcm_a_state() for _ in range(6)]
+        self.adpcm_b = adpcm_b_state()
+        self.fm_ctx_set_current(0)
+        self.ssg_channel = 0
+        self.a_channel = 0
+        self.ix = self.fm[0]
+
+    def tick_period(self):
+        return 2304 * (256 - self.timer_tb) / self.clock
+
+    def next_row(self):
+        self.pos = self.pos + 1 if self.pos + 1 < len(self.ticks) else 0
+        self.per_row = self.ticks[self.pos]
+
+    def write(self, port, reg, val):
+        self.log(self.time, self.tick, port, reg, val)
+
+    def write_a(self, reg, val):
+        self.write("a", reg, val)
+
+    def write_b(self, reg, val):
+        self.write("b", reg, val)
+
+    def write_fm(self, reg, val):
+        self.write(self.fm_port, reg, val)
+
+    def update(self, cursors):
+        """Process the streams due on this tick, then run all the pipelines"""
+        if self.count >= self.per_row:
+            for c, cursor in cursors:
+                cursor.wait -= 1
+                if cursor.wait == 0:
+                    self.run_stream(c, cursor)
+                    if self.stopped:
+                        return
+            self.count = 0
+            self.next_row()
+        self.run_fm_pipeline()
+        self.run_ssg_pipeline()
+        self.run_adpcm_a_pipeline()
+        self.run_adpcm_b_pipeline()
+
+    def run_stream(self, channel, cursor):
+        self.run_op(ctx_op_name(channel))
+        while True:
+            op, yields = cursor.next_op()
+            if cursor.looped and not self.loop:
+                self.stopped = True
+                return
+            self.run_op(type(op).__name__, op)
+            if self.stopped or yields:
+                return
+
+    def run_op(self, name, op=None):
+        handler = getattr(self, "op_" + name, None)
+        if handler is None:
+            error("unsupported NSS opcode %s" % name)
+        handler(op)
+
+    def play(self, cursors, max_ticks=None, max_seconds=None, loop=False):
+        self.loop = loop
+        while True:
+            if max_ticks is not None and self.tick >= max_ticks:
+                break
+            if max_seconds is not None and self.time >= max_seconds:
+                break
+            self.update(cursors)
+            if self.stopped:
+                break
+            self.time += self.tick_period()
+            self.tick += 1
+            self.count += 1
+        dbg("Played %d ticks (%.3fs)" % (self.tick, self.time))
+
+    #
+    # Stream control flow and timer opcodes
+    #
+
+    def op_nop(self, op):
+        pass
+
+    op_jmp = op_call = op_call_tbl = op_call_entry = op_nss_ret = op_nop
+    op_wait_n = op_wait_last = op_nop
+
+    def op_nss_end(self, op):
+        self.stopped = True
+
+    def op_tempo(self, op):
+        self.write_a(0x27, self.timer_flags | 0x30)
+        self.write_a(0x26, op.val)
+        self.write_a(0x25, 0)
+        self.write_a(0x24, 0)
+        self.count = 0
+        self.write_a(0x27, self.timer_flags | 0x3a)
+        self.timer_tb = op.val
+
+    def op_speed(self, op):
+        self.ticks[-1] = op.ticks
+        self.per_row = self.ticks[self.pos]
+
+    def op_groove(self, op):
+        self.ticks[0] = op.ticks
+        self.per_row = self.ticks[self.pos]
+
+    def op_set_2ch(self, op):
+        self.timer_flags |= TIMER_FLAGS_EXT_FM2
+
+    #
+    # Generic FX opcodes, on the current channel
+    #
+
+    def fx_vol_slide(self, s, direction, increment):
+        slide_init(s.vol, direction | SLIDE_KEEP_RUNNING, increment, 2)
+
+    def fx_vol_slide_off(self, s):
+        s.pipeline |= STATE_LOAD_VOL
+        s.vol.fx &= ~FX_SLIDE
+
+    def fx_vibrato(self, s, speed_depth):
+        if not s.note.fx & FX_VIBRATO:
+            s.note.vibrato_pos = 0
+        s.note.fx |= FX_VIBRATO
+        s.note.vibrato_speed = speed_depth >> 4
+        s.note.vibrato_depth = (speed_depth & 0xf) + 1
+
+    def fx_vibrato_off(self, s):
+        s.note.fx &= ~FX_VIBRATO
+        s.pipeline |= STATE_LOAD_NOTE
+
+    def fx_note_porta(self, s, speed):
+        ctx = s.note
+        ctx.slide_cfg = SLIDE_PORTAMENTO
+        slide_init_increment(ctx, speed, 5)
+        slide_init_source(ctx)
+        ctx.fx |= FX_SLIDE
+
+    def fx_legato(self, s):
+        s.note.fx |= FX_LEGATO
+
+    def fx_legato_off(self, s):
+        s.note.fx &= ~FX_LEGATO
+
+    def fx_delay(self, s, delay):
+        s.trigger_cur = delay + 1
+        s.trigger_action = TRIGGER_DELAY
+        s.vol.fx |= FX_TRIGGER
+
+    def op_vol_slide_u(self, op):
+        self.fx_vol_slide(self.ix, 0, op.increment)
+
+    def op_vol_slide_d(self, op):
+        self.fx_vol_slide(self.ix, SLIDE_DIRECTION, op.increment)
+
+    def op_vol_slide_off(self, op):
+        self.fx_vol_slide_off(self.ix)
+
+    def op_note_pitch_slide_u(self, op):
+        slide_init(self.ix.note, 0, op.speed, 5)
+
+    def op_note_pitch_slide_d(self, op):
+        slide_init(self.ix.note, SLIDE_DIRECTION, op.speed, 5)
+
+    def note_slide(self, direction, speed_depth):
+        ctx = self.ix.note
+        ctx.slide_cfg = direction | SLIDE_PORTAMENTO
+        depth = speed_depth & 0xf
+        if direction:
+            depth = -depth & 0xff
+        slide_init_source(ctx)
+        slide_init_target(ctx, ctx.cfg, depth)
+        slide_init_increment(ctx, speed_depth >> 4, 3)
+        ctx.fx |= FX_SLIDE
+
+    def op_note_slide_u(self, op):
+        self.note_slide(0, op.speed_depth)
+
+    def op_note_slide_d(self, op):
+        self.note_slide(SLIDE_DIRECTION, op.speed_depth)
+
+    def op_note_porta(self, op):
+        self.fx_note_porta(self.ix, op.speed)
+
+    def op_note_slide_off(self, op):
+        self.ix.pipeline |= STATE_LOAD_NOTE
+        self.ix.note.fx &= ~FX_SLIDE
+
+    op_note_pitch_slide_off = op_note_slide_off
+
+    def op_vibrato(self, op):
+        self.fx_vibrato(self.ix, op.speed_depth)
+
+    def op_vibrato_off(self, op):
+        self.fx_vibrato_off(self.ix)
+
+    def op_arpeggio(self, op):
+        s = self.ix
+        s.arpeggio_2nd = op.first_second >> 4
+        s.arpeggio_3rd = op.first_second & 0xf
+        if not s.note.fx & FX_ARPEGGIO:
+            s.arpeggio_count = s.arpeggio_speed
+            s.arpeggio_pos = 0
+            s.arpeggio_pos8 = 0
+            s.note.fx |= FX_ARPEGGIO
+
+    def op_arpeggio_speed(self, op):
+        self.ix.arpeggio_speed = op.speed
+
+    def op_arpeggio_off(self, op):
+        s = self.ix
+        s.note.fx &= ~FX_ARPEGGIO
+        s.arpeggio_pos8 = 0
+        s.pipeline |= STATE_LOAD_NOTE
+
+    def quick_legato(self, delay_transpose):
+        s = self.ix
+        s.legato_transpose = delay_transpose & 0xf
+        s.legato_delay = delay_transpose >> 4
+        s.note.fx |= FX_LEGATO | FX_QUICK_LEGATO
+
+    def op_quick_legato_u(self, op):
+        self.quick_legato(op.delay_transpose)
+
+    def op_quick_legato_d(self, op):
+        # nullsound does not negate the transpose for downward legato
+        self.quick_legato(op.delay_transpose)
+
+    def op_legato(self, op):
+        self.fx_legato(self.ix)
+
+    def op_legato_off(self, op):
+        self.fx_legato_off(self.ix)
+
+    #
+    # Common note, volume and trigger actions
+    #
+
+    def configure_note_on(self, s, note, prepare, start):
+        if s.note.fx & FX_SLIDE:
+            slide_update(s, s.note, note)
+            if s.pipeline & STATE_NOTE_STARTED:
+                return
+            prepare(s)
+        else:
+            s.note.cfg = note
+            s.note.data16 = note << 8
+            if s.note.fx & FX_LEGATO:
+                if s.pipeline & STATE_PLAYING:
+                    s.pipeline |= STATE_LOAD_NOTE
+                    return
+            else:
+                s.pipeline &= ~STATE_NOTE_STARTED
+                prepare(s)
+        s.pipeline |= start
+
+    def configure_vol(self, s, vol):
+        if s.vol.fx & FX_SLIDE:
+            slide_update(s, s.vol, vol)
+        else:
+            s.vol.cfg = vol
+            s.vol.data16 = vol << 8
+            s.pipeline |= STATE_LOAD_VOL
+
+    def note_on(self, s, note, configure):
+        if s.trigger_action & TRIGGER_DELAY:
+            s.trigger_note = note
+            s.trigger_action |= TRIGGER_LOAD_NOTE
+        else:
+            configure(s, note)
+
+    def vol(self, s, vol):
+        if s.trigger_action & TRIGGER_DELAY:
+            s.trigger_vol = vol
+            s.trigger_action |= TRIGGER_LOAD_VOL
+        else:
+            self.configure_vol(s, vol)
+
+    def cut(self, s, delay):
+        s.trigger_cur = delay + 1
+        s.trigger_action = TRIGGER_CUT
+        s.vol.fx |= FX_TRIGGER
+
+    def pitch(self, s, pitch):
+        s.detune = 2 * signed8((pitch - 0x80) & 0xff) & 0xffff
+
+    def eval_trigger_step(self, s, state, note_func, vol_func, stop_func):
+        if s.trigger_action & TRIGGER_RETRIGGER and self.count + 1 >= self.per_row:
+            # a retrigger stops at the end of the row
+            s.vol.fx &= ~FX_TRIGGER
+        s.trigger_cur = (s.trigger_cur - 1) & 0xff
+        if s.trigger_cur:
+            return
+        if s.trigger_action & TRIGGER_DELAY:
+            if s.trigger_action & TRIGGER_LOAD_NOTE:
+                note_func(s, s.trigger_note)
+            if s.trigger_action & TRIGGER_LOAD_VOL:
+                vol_func(s, s.trigger_vol)
+            s.trigger_action &= ~TRIGGER_DELAY
+            s.vol.fx &= ~FX_TRIGGER
+        elif s.trigger_action & TRIGGER_CUT:
+            stop_func(s, state)
+            s.trigger_action &= ~TRIGGER_DELAY
+            s.vol.fx &= ~FX_TRIGGER
+        elif s.trigger_action & TRIGGER_RETRIGGER:
+            note_func(s, s.trigger_note)
+            s.trigger_cur = s.trigger_arg
+
+    #
+    # FM (nullsound/nss-fm.s)
+    #
+
+    def fm_ctx_set_current(self, channel):
+        self.fm_channel = channel
+        self.fm_ym_channel = FM_YM2610_CHANNELS[channel]
+        self.fm_fnum2_reg = 0xa5 + (channel & 1)
+        self.fm_op_mask = 0xf0
+        self.fm_port = "a" if channel < 2 else "b"
+
+    def fm_ctx_op_set_current(self, offset):
+        self.fm_op = offset
+        self.fm_fnum2_reg = FM2_OP_FNUM2_REGS[offset]
+        self.fm_tl_reg = FM2_OP_TL_REGS[offset]
+        self.fm_op_mask = FM2_OP_MASKS[offset]
+
+    def fm_ctx(self, channel):
+        self.fm_ctx_set_current(channel)
+        self.ix = self.fm[channel]
+
+    def op_fm_ctx_1(self, op):
+        self.fm_ctx(0)
+
+    def op_fm_ctx_2(self, op):
+        self.fm_ctx(1)
+
+    def op_fm_ctx_3(self, op):
+        self.fm_ctx(2)
+
+    def op_fm_ctx_4(self, op):
+        self.fm_ctx(3)
+
+    def fm_stop_op_from_mask(self, s=None):
+        p = self.fm[self.fm_channel]
+        p.ops_enabled = ~self.fm_op_mask & 0xf0 & p.ops_enabled
+        self.write_a(0x28, (self.fm_ym_channel + p.ops_enabled) & 0xff)
+
+    def fm_configure_note_on(self, s, note):
+        self.configure_note_on(s, note, self.fm_stop_op_from_mask,
+                               STATE_PLAYING | STATE_EVAL_MACRO | STATE_LOAD_NOTE)
+
+    def fm_stop_playback(self, s, ops):
+        s.ops_enabled &= ops
+        self.write_a(0x28, self.fm_ym_channel | s.ops_enabled)
+        s.pipeline &= ~(STATE_PLAYING | STATE_NOTE_STARTED)
+
+    def fm_set_pan_ams_pms(self, reg, val):
+        pan = (self.fm_pan[self.fm_channel] & 0xc0) + (val & 0x37)
+        self.fm_pan[self.fm_channel] = pan
+        self.write_fm(reg, pan)
+        return pan
+
+    def fm_fnum(self, pos16):
+        c = OCTAVE_SEMITONE[pos16 >> 8]
+        block = (c & 0xf0) >> 1
+        semitone = c & 0xf
+        t = self.tables
+        dist = scale_int24(t.fm_dists[semitone], t.fm_deltas[(pos16 & 0xff) >> 1])
+        fnum = ((t.fm_fnums[semitone] + dist) & 0xffffff) >> 12
+        return ((fnum >> 8) | block) & 0xff, fnum & 0xff
+
+    def fm_out_level(self, level, vol, enabled):
+        if not enabled:
+            return level
+        a = (level + ((127 - vol) & 0xff)) & 0xff
+        # no global attenuation
+        return 127 if a & 0x80 else a
+
+    def op_fm_instr(self, op):
+        s = self.ix
+        if op.inst == s.instrument:
+            return
+        s.instrument = op.inst
+        self.write_a(0x28, self.fm_ym_channel)
+        data = fm_instrument_data(self.ins[op.inst])
+        o = self.fm_channel & 1
+        for i in range(4):
+            self.write_fm(0x31 + o + 4 * i, data[i])
+        for i in range(20):
+            self.write_fm(0x51 + o + 4 * i, data[8 + i])
+        self.write_fm(0xb1 + o, data[28])
+        self.fm_set_pan_ams_pms(0xb5 + o, data[29])
+        s.levels = data[30:34]
+        s.out_ops = FM_OUT_OPS[data[28] & 7]
+        s.pipeline |= STATE_LOAD_VOL
+        s.pipeline &= ~STATE_NOTE_STARTED
+        s.pipeline |= STATE_LOAD_NOTE
+
+    def op_fm_note(self, op):
+        self.note_on(self.ix, op.note, self.fm_configure_note_on)
+
+    op_fm_note_w = op_fm_note
+
+    def op_fm_stop(self, op):
+        self.fm_stop_playback(self.ix, 0x0f)
+
+    def op_fm_vol(self, op):
+        self.vol(self.ix, op.volume)
+
+    def op_op1_lvl(self, op):
+        self.ix.levels[0] = op.level
+        self.ix.pipeline |= STATE_LOAD_VOL
+
+    def op_op2_lvl(self, op):
+        self.ix.levels[2] = op.level
+        self.ix.pipeline |= STATE_LOAD_VOL
+
+    def op_op3_lvl(self, op):
+        self.ix.levels[1] = op.level
+        self.ix.pipeline |= STATE_LOAD_VOL
+
+    def op_op4_lvl(self, op):
+        self.ix.levels[3] = op.level
+        self.ix.pipeline |= STATE_LOAD_VOL
+
+    def op_fm_pitch(self, op):
+        self.pitch(self.ix, op.tune)
+
+    def op_fm_pan(self, op):
+        pan = ((self.fm_pan[self.fm_channel] & 0x37) + op.pan_mask) & 0xff
+        self.fm_pan[self.fm_channel] = pan
+        self.write_fm(0xb5 + (self.fm_channel & 1), pan)
+
+    def op_fm_delay(self, op):
+        self.fx_delay(self.ix, op.delay)
+
+    def op_fm_cut(self, op):
+        self.cut(self.ix, op.delay)
+
+    # extended FM2 opcodes
+
+    def fm2_op_instr(self, offset, op):
+        s = self.ix
+        self.fm_op = offset
+        self.fm_op_mask = FM2_OP_MASKS[offset]
+        self.fm_stop_op_from_mask()
+        data = fm_instrument_data(self.ins[op.inst])
+        self.write_fm(0xb2, (data[28] & 7) | self.fm2_fb)
+        pan = self.fm_set_pan_ams_pms(0xb6, data[29])
+        # the algorithm is read from the pan register, like nullsound
+        s.out_ops = FM_OUT_OPS[pan & 7]
+        for k in range(7):
+            self.write_fm(0x32 + 4 * offset + 16 * k, data[offset + 4 * k])
+        s.levels[offset] = data[4 + offset]
+        s.pipeline |= STATE_LOAD_VOL
+        s.pipeline &= ~STATE_NOTE_STARTED
+        s.pipeline |= STATE_LOAD_NOTE
+
+    def op_fm2_op1_instr(self, op):
+        self.fm2_op_instr(FM2_OP_OFFSETS[0], op)
+
+    def op_fm2_op2_instr(self, op):
+        self.fm2_op_instr(FM2_OP_OFFSETS[1], op)
+
+    def op_fm2_op3_instr(self, op):
+        self.fm2_op_instr(FM2_OP_OFFSETS[2], op)
+
+    def op_fm2_op4_instr(self, op):
+        self.fm2_op_instr(FM2_OP_OFFSETS[3], op)
+
+    def fm2_op_note_on(self, n, op):
+        self.fm_op_mask = 0x10 << n
+        self.note_on(self.fm2_ops[FM2_OP_OFFSETS[n]], op.note, self.fm_configure_note_on)
+
+    def op_fm2_op1_note_on(self, op):
+        self.fm2_op_note_on(0, op)
+
+    def op_fm2_op2_note_on(self, op):
+        self.fm2_op_note_on(1, op)
+
+    def op_fm2_op3_note_on(self, op):
+        self.fm2_op_note_on(2, op)
+
+    def op_fm2_op4_note_on(self, op):
+        self.fm2_op_note_on(3, op)
+
+    def op_fm2_op1_vol(self, op):
+        self.vol(self.fm2_ops[FM2_OP_OFFSETS[0]], op.vol)
+
+    def op_fm2_op2_vol(self, op):
+        self.vol(self.fm2_ops[FM2_OP_OFFSETS[1]], op.vol)
+
+    def op_fm2_op3_vol(self, op):
+        self.vol(self.fm2_ops[FM2_OP_OFFSETS[2]], op.vol)
+
+    def op_fm2_op4_vol(self, op):
+        self.vol(self.fm2_ops[FM2_OP_OFFSETS[3]], op.vol)
+
+    def op_fm2_ops_off(self, op):
+        for n in range(4):
+            if not op.ops & (0x10 << n):
+                self.fm2_ops[FM2_OP_OFFSETS[n]].pipeline &= ~STATE_PLAYING
+        self.fm_stop_playback(self.ix, op.ops)
+
+    def fm2_op(self, op):
+        return self.fm2_ops[op.op & 3]
+
+    def op_fm2_delay(self, op):
+        self.fx_delay(self.fm2_op(op), op.delay)
+
+    def op_fm2_vibrato(self, op):
+        self.fx_vibrato(self.fm2_op(op), op.speed_depth)
+
+    def op_fm2_vibrato_off(self, op):
+        self.fx_vibrato_off(self.fm2_op(op))
+
+    def op_fm2_note_porta(self, op):
+        self.fx_note_porta(self.fm2_op(op), op.speed)
+
+    def op_fm2_legato(self, op):
+        self.fx_legato(self.fm2_op(op))
+
+    def op_fm2_legato_off(self, op):
+        self.fx_legato_off(self.fm2_op(op))
+
+    def op_fm2_vol_slide_off(self, op):
+        self.fx_vol_slide_off(self.fm2_op(op))
+
+    def op_fm2_vol_slide_u(self, op):
+        self.fx_vol_slide(self.fm2_op(op), 0, op.increment)
+
+    def op_fm2_vol_slide_d(self, op):
+        self.fx_vol_slide(self.fm2_op(op), SLIDE_DIRECTION, op.increment)
+
+    def run_fm_channel_pipeline(self, s):
+        state = s.pipeline | s.vol.fx | s.note.fx
+        if not state:
+            return
+        if s.vol.fx & FX_TRIGGER:
+            self.eval_trigger_step(s, state, self.fm_configure_note_on,
+                                   self.configure_vol, self.fm_stop_playback)
+        eval_fx(s)
+        if not s.pipeline & STATE_PLAYING:
+            s.pipeline &= ~STATE_LOAD_NOTE
+        if s.pipeline & STATE_LOAD_VOL:
+            s.pipeline &= ~STATE_LOAD_VOL
+            vol = s.vol.data16 >> 8
+            for i in range(4):
+                level = self.fm_out_level(s.levels[i], vol, s.out_ops >> i & 1)
+                self.write_fm(0x41 + (self.fm_channel & 1) + 4 * i, level)
+        if s.pipeline & STATE_LOAD_NOTE:
+            s.pipeline &= ~STATE_LOAD_NOTE
+            fnum2, fnum1 = self.fm_fnum(fixed_point_note(s))
+            self.write_fm(self.fm_fnum2_reg, fnum2)
+            self.write_fm(self.fm_fnum2_reg - 4, fnum1)
+            if not s.pipeline & STATE_NOTE_STARTED:
+                self.write_a(0x28, self.fm_ym_channel | 0xf0)
+                s.pipeline |= STATE_NOTE_STARTED
+
+    def run_fm2_op_pipeline(self, s, fm2):
+        state = s.pipeline | s.vol.fx | s.note.fx
+        if not state:
+            return
+        if s.vol.fx & FX_TRIGGER:
+            self.eval_trigger_step(s, state, self.fm_configure_note_on,
+                                   self.configure_vol, self.fm_stop_playback)
+        eval_fx(s)
+        if not s.pipeline & STATE_PLAYING:
+            s.pipeline &= ~STATE_LOAD_NOTE
+        if s.pipeline & STATE_LOAD_VOL:
+            s.pipeline &= ~STATE_LOAD_VOL
+            level = self.fm_out_level(fm2.levels[self.fm_op], s.vol.data16 >> 8, True)
+            self.write_fm(self.fm_tl_reg, level)
+        if s.pipeline & STATE_LOAD_NOTE:
+            s.pipeline &= ~STATE_LOAD_NOTE
+            s.pipeline |= STATE_NOTE_STARTED
+            fnum2, fnum1 = self.fm_fnum(fixed_point_note(s))
+            self.write_fm(self.fm_fnum2_reg, fnum2)
+            self.write_fm(self.fm_fnum2_reg - 4, fnum1)
+            fm2.ops_enabled |= self.fm_op_mask
+            fm2.pipeline |= STATE_LOAD_NOTE
+
+    def run_fm_pipeline(self):
+        saved = self.fm_channel
+        self.fm_ctx_set_current(0)
+        self.run_fm_channel_pipeline(self.fm[0])
+        self.fm_ctx_set_current(1)
+        if self.timer_flags & TIMER_FLAGS_EXT_FM2:
+            fm2 = self.fm[1]
+            for offset in FM2_OP_OFFSETS:
+                self.fm_ctx_op_set_current(offset)
+                self.run_fm2_op_pipeline(self.fm2_ops[offset], fm2)
+            if fm2.pipeline & STATE_LOAD_NOTE:
+                self.write_a(0x28, fm2.ops_enabled | self.fm_ym_channel)
+                fm2.pipeline &= ~STATE_LOAD_NOTE
+        else:
+            self.run_fm_channel_pipeline(self.fm[1])
+        for channel in (2, 3):
+            self.fm_ctx_set_current(channel)
+            self.run_fm_channel_pipeline(self.fm[channel])
+        self.fm_ctx_set_current(saved)
+
+    #
+    # SSG (nullsound/nss-ssg.s)
+    #
+
+    def ssg_ctx(self, channel):
+        self.ssg_channel = channel
+        self.ix = self.ssg[channel]
+
+    def op_s_ctx_1(self, op):
+        self.ssg_ctx(0)
+
+    def op_s_ctx_2(self, op):
+        self.ssg_ctx(1)
+
+    def op_s_ctx_3(self, op):
+        self.ssg_ctx(2)
+
+    def ssg_reset_macro(self, s):
+        s.macro_pos = 0
+
+    def ssg_configure_note_on(self, s, note):
+        self.configure_note_on(s, note, self.ssg_reset_macro,
+                               STATE_PLAYING | STATE_EVAL_MACRO | STATE_LOAD_NOTE)
+
+    def ssg_stop_playback(self, s, state=0):
+        self.ssg_enabled |= rotl8(0x09, self.ssg_channel)
+        self.write_a(0x07, self.ssg_enabled)
+        self.write_a(0x08 + self.ssg_channel, 0)
+        s.pipeline &= ~(STATE_PLAYING | STATE_EVAL_MACRO | STATE_NOTE_STARTED)
+
+    def op_s_macro(self, op):
+        s = self.ix
+        if op.inst not in self.macros:
+            self.macros[op.inst] = macro_steps(self.ins[op.inst])
+        mac = self.ins[op.inst]
+        s.props[5] = 0
+        s.macro = self.macros[op.inst]
+        s.macro_keys = mac.keys
+        s.macro_loop = mac.loop if mac.loop != 255 else None
+        s.macro_pos = 0
+        s.pipeline |= STATE_EVAL_MACRO
+        s.pipeline &= ~STATE_NOTE_STARTED
+        s.pipeline |= STATE_LOAD_NOTE
+
+    def op_s_note(self, op):
+        self.note_on(self.ix, op.note, self.ssg_configure_note_on)
+
+    op_s_note_w = op_s_note
+
+    def op_s_stop(self, op):
+        self.ssg_stop_playback(self.ix)
+
+    def op_s_vol(self, op):
+        self.vol(self.ix, op.volume)
+
+    def op_s_env(self, op):
+        self.write_a(0x0b, op.fine)
+        self.write_a(0x0c, op.coarse)
+
+    def op_s_pitch(self, op):
+        self.pitch(self.ix, op.pitch)
+
+    def op_s_delay(self, op):
+        self.fx_delay(self.ix, op.delay)
+
+    def op_s_cut(self, op):
+        self.cut(self.ix, op.delay)
+
+    def eval_macro_step(self, s):
+        if s.macro is None or s.macro_pos is None:
+            return
+        props, bits = s.macro[s.macro_pos]
+        idx = 0
+        for offset, val in props:
+            idx += offset
+            s.props[idx] = val
+            idx += 1
+        s.pipeline |= bits
+        s.macro_pos += 1
+        if s.macro_pos == len(s.macro):
+            s.macro_pos = s.macro_loop
+
+    def ssg_load_regs(self, s):
+        for key in s.macro_keys:
+            if key == 1:
+                self.write_a(0x0b, s.props[1])
+            elif key == 2:
+                self.write_a(0x0c, s.props[2])
+            elif key == 3:
+                # the generated load function sets LOAD_REGS back
+                s.pipeline |= STATE_LOAD_REGS
+
+    def ssg_tune(self, pos16):
+        c = OCTAVE_SEMITONE[pos16 >> 8] & 0x7f
+        t = self.tables
+        dist = scale_int24(t.ssg_dists[c], t.ssg_deltas[(pos16 & 0xff) >> 1])
+        return ((t.ssg_tunes[c] - dist) & 0xffffff) >> 12
+
+    def run_ssg_pipeline(self):
+        saved = self.ssg_channel
+        for channel, s in enumerate(self.ssg):
+            self.ssg_channel = channel
+            if not s.pipeline | s.vol.fx | s.note.fx:
+                continue
+            if s.pipeline & STATE_EVAL_MACRO:
+                s.pipeline &= ~STATE_EVAL_MACRO
+                self.eval_macro_step(s)
+            if s.vol.fx & FX_TRIGGER:
+                self.eval_trigger_step(s, 0, self.ssg_configure_note_on,
+                                       self.configure_vol, self.ssg_stop_playback)
+            eval_fx(s)
+            if not s.pipeline & STATE_PLAYING:
+                s.pipeline &= ~STATE_LOAD_NOTE
+            if s.pipeline & STATE_LOAD_NOTE:
+                s.pipeline &= ~STATE_LOAD_NOTE
+                pos16 = fixed_point_note(s, s.props[5])
+                tune = self.ssg_tune(pos16)
+                self.write_a(2 * channel, tune & 0xff)
+                self.write_a(2 * channel + 1, tune >> 8)
+            if s.pipeline & STATE_LOAD_REGS:
+                s.pipeline &= ~STATE_LOAD_REGS
+                self.ssg_load_regs(s)
+            if s.pipeline & STATE_LOAD_VOL:
+                s.pipeline &= ~STATE_LOAD_VOL
+                # no global attenuation
+                out = ((s.vol.data16 >> 8) - 15 + s.props[3]) & 0xff
+                self.write_a(0x08 + channel, 0 if out & 0x80 else out)
+            if s.pipeline & STATE_LOAD_WAVEFORM:
+                s.pipeline &= ~(STATE_LOAD_WAVEFORM | STATE_NOTE_STARTED)
+                waveform = rotl8(s.props[4], channel)
+                mask = rotl8(0xf6, channel)
+                self.ssg_enabled = (self.ssg_enabled & mask) | waveform
+                self.write_a(0x07, self.ssg_enabled)
+                s.pipeline |= STATE_NOTE_STARTED
+        self.ssg_channel = saved
+
+    #
+    # ADPCM-A (nullsound/nss-adpcm-a.s)
+    #
+
+    def a_ctx(self, channel):
+        self.a_channel = channel
+        self.ix = self.adpcm_a[channel]
+
+    def op_a_ctx_1(self, op):
+        self.a_ctx(0)
+
+    def op_a_ctx_2(self, op):
+        self.a_ctx(1)
+
+    def op_a_ctx_3(self, op):
+        self.a_ctx(2)
+
+    def op_a_ctx_4(self, op):
+        self.a_ctx(3)
+
+    def op_a_ctx_5(self, op):
+        self.a_ctx(4)
+
+    def op_a_ctx_6(self, op):
+        self.a_ctx(5)
+
+    def a_configure_on(self, s, note=0):
+        s.pipeline |= STATE_PLAYING | STATE_START_NOTE
+
+    def a_stop_playback(self, s=None, state=0):
+        self.write_b(0x00, (0x80 | (1 << self.a_channel)) & 0xff)
+
+    def op_a_instr(self, op):
+        s = self.ix
+        ins = self.ins[op.inst]
+        smp = self.samples[ins.sample.name]
+        addresses = [smp.start_lsb, smp.start_msb, smp.stop_lsb, smp.stop_msb]
+        for i, addr in enumerate(addresses):
+            self.write_b(0x10 + 8 * i + self.a_channel, addr)
+        if ins.volume != s.instr_vol:
+            s.instr_vol = ins.volume
+            s.pipeline |= STATE_LOAD_VOL
+
+    def op_a_start(self, op):
+        self.note_on(self.ix, 0, self.a_configure_on)
+        self.a_channel += 1
+
+    op_a_start_w = op_a_start
+
+    def op_a_stop(self, op):
+        self.a_stop_playback()
+        self.a_channel += 1
+
+    def op_a_vol(self, op):
+        self.vol(self.ix, op.volume)
+
+    def op_a_pan(self, op):
+        self.ix.pan = op.pan_mask
+        self.ix.pipeline |= STATE_LOAD_PAN
+
+    def op_a_delay(self, op):
+        self.fx_delay(self.ix, op.delay)
+
+    def op_a_cut(self, op):
+        self.cut(self.ix, op.delay)
+
+    def op_a_retrigger(self, op):
+        s = self.ix
+        s.trigger_arg = s.trigger_cur = op.delay
+        s.trigger_action = TRIGGER_RETRIGGER
+        s.vol.fx |= FX_TRIGGER
+
+    def run_adpcm_a_pipeline(self):
+        saved = self.a_channel
+        for channel, s in enumerate(self.adpcm_a):
+            self.a_channel = channel
+            state = s.pipeline | s.vol.fx
+            if not state:
+                continue
+            if s.vol.fx & FX_TRIGGER:
+                self.eval_trigger_step(s, state, self.a_configure_on,
+                                       self.configure_vol, self.a_stop_playback)
+            if s.vol.fx & FX_SLIDE:
+                eval_slide_step(s.vol)
+                s.pipeline |= STATE_LOAD_VOL
+            if not s.pipeline & STATE_PLAYING:
+                s.pipeline &= ~STATE_START_NOTE
+            if s.pipeline & STATE_LOAD_VOL:
+                # no global attenuation
+                out = (s.instr_vol - 0x1f + (s.vol.data16 >> 8)) & 0xff
+                s.out_vol = 0 if out & 0x80 else out
+            if s.pipeline & (STATE_LOAD_VOL | STATE_LOAD_PAN):
+                s.pipeline &= ~(STATE_LOAD_VOL | STATE_LOAD_PAN)
+                self.write_b(0x08 + channel, (s.out_vol + s.pan) & 0xff)
+            if s.pipeline & STATE_START_NOTE:
+                s.pipeline &= ~STATE_START_NOTE
+                self.write_b(0x00, 1 << channel)
+        self.a_channel = saved
+
+    #
+    # ADPCM-B (nullsound/nss-adpcm-b.s)
+    #
+
+    def op_b_ctx(self, op):
+        self.ix = self.adpcm_b
+
+    def b_note_off(self, s, state=0):
+        self.write_a(0x10, 0x01)
+        s.pipeline &= ~STATE_NOTE_STARTED
+
+    def b_reset(self, s):
+        self.write_a(0x10, 0x01)
+
+    def b_configure_note_on(self, s, note):
+        self.configure_note_on(s, note, self.b_reset, STATE_PLAYING | STATE_LOAD_NOTE)
+
+    def op_b_instr(self, op):
+        s = self.ix
+        if op.inst == s.instrument:
+            return
+        s.instrument = op.inst
+        ins = self.ins[op.inst]
+        smp = self.samples[ins.sample.name]
+        addresses = [smp.start_lsb, smp.start_msb, smp.stop_lsb, smp.stop_msb]
+        for i, addr in enumerate(addresses):
+            self.write_a(0x12 + i, addr)
+        s.start_cmd = 0x80 | (0x10 if ins.loop else 0)
+        s.base_octave = ins.base_octave
+        s.delta_ns = list(ins.base_delta_ns) + [0] * 4
+        self.write_a(0x11, 0xc0)
+        s.pipeline &= ~STATE_NOTE_STARTED
+        s.pipeline |= STATE_LOAD_NOTE
+
+    def op_b_note(self, op):
+        self.note_on(self.ix, op.note, self.b_configure_note_on)
+
+    def op_b_stop(self, op):
+        self.b_note_off(self.ix)
+
+    def op_b_vol(self, op):
+        self.vol(self.ix, op.volume)
+
+    def op_b_pan(self, op):
+        self.ix.pan = op.pan_mask
+        self.ix.pipeline |= STATE_LOAD_PAN
+
+    def op_b_delay(self, op):
+        self.fx_delay(self.ix, op.delay)
+
+    def op_b_cut(self, op):
+        self.cut(self.ix, op.delay)
+
+    def adpcm_b_delta_n(self, s, pos16):
+        c = OCTAVE_SEMITONE[pos16 >> 8]
+        semitone = c & 0xf
+        base = s.delta_ns[semitone]
+        dist = (s.delta_ns[semitone + 1] - base) & 0xffffff
+        delta_n = ((base + scale_int24(dist, self.tables.ssg_deltas[(pos16 & 0xff) >> 1])) >> 8) & 0xffff
+        octave = c >> 4
+        if s.base_octave > octave:
+            delta_n >>= s.base_octave - octave
+        elif s.base_octave < octave:
+            delta_n = (delta_n << (octave - s.base_octave)) & 0xffff
+        return delta_n
+
+    def run_adpcm_b_pipeline(self):
+        s = self.adpcm_b
+        state = s.pipeline | s.vol.fx | s.note.fx
+        if not state:
+            return
+        if s.vol.fx & FX_TRIGGER:
+            self.eval_trigger_step(s, state, self.b_configure_note_on,
+                                   self.configure_vol, self.b_note_off)
+        eval_fx(s)
+        if not s.pipeline & STATE_PLAYING:
+            s.pipeline &= ~STATE_LOAD_NOTE
+        if s.pipeline & STATE_LOAD_VOL:
+            s.pipeline &= ~STATE_LOAD_VOL
+            # no global attenuation
+            self.write_a(0x1b, ((((s.vol.data16 >> 8) << 2) * 64) & 0xffff) >> 8)
+        if s.pipeline & STATE_LOAD_PAN:
+            s.pipeline &= ~STATE_LOAD_PAN
+            self.write_a(0x11, s.pan)
+        if s.pipeline & STATE_LOAD_NOTE:
+            s.pipeline &= ~STATE_LOAD_NOTE
+            delta_n = self.adpcm_b_delta_n(s, fixed_point_note(s))
+            self.write_a(0x19, delta_n & 0xff)
+            self.write_a(0x1a, delta_n >> 8)
+            if not s.pipeline & STATE_NOTE_STARTED:
+                self.write_a(0x10, s.start_cmd)
+                s.pipeline |= STATE_NOTE_STARTED
+
+
+def module_samples(modname, ins, vrom_size):
+    """ADPCM samples of a module, allocated in VROM like vromtool does"""
+    if not any(type(i) in [adpcm_a_instrument, adpcm_b_instrument] for i in ins):
+        return {}
+    smp = samples_from_module(modname)
+    allocate_samples(smp, vrom_size, "X")
+    return {s.name: s for s in smp}
+
+
+def main():
+    global VERBOSE
+    parser = argparse.ArgumentParser(
+        description="Play the NSS streams of a Furnace module like nullsound, "
+        "and log the YM2610 register writes")
+
+    parser.add_argument("FILE", help="Furnace module")
+    parser.add_argument("-o", "--output", help="Output file name")
+    parser.add_argument("-c", "--channels", help="Process specific channels. One hex digit per channel",
+                        default='0123456789abcd')
+    parser.add_argument("-t", "--ticks", type=int,
+                        help="Stop playback after a number of ticks")
+    parser.add_argument("--seconds", type=float,
+                        help="Stop playback after a number of seconds")
+    parser.add_argument("-l", "--loop", action="store_true",
+                        help="Keep playing when the song loops (requires --ticks or --seconds)")
+    parser.add_argument("-s", "--size", type=lambda x: int(x, 0), default=0x400000,
+                        help="VROM size used to allocate ADPCM samples (as vromtool -s)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes used to compile channels in parallel")
+    parser.add_argument("-f", "--factor", action="store_true",
+                        help="Factor repeated opcode sequences into called blocks (as nsstool -f)")
+    parser.add_argument("--no-fused-passes", dest="fuse", action="store_false",
+                        help="Run every optimization pass in its own traversal "
+                        "of the stream (as nsstool --no-fused-passes)")
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true",
+                        default=False, help="print details of processing")
+
+    arguments = parser.parse_args()
+    VERBOSE = arguments.verbose
+    nsstool.VERBOSE = arguments.verbose
+    # play the streams compiled with the same passes as nsstool
+    nsstool.FUSE_PASSES = arguments.fuse
+    nsstool.FACTOR_SEQUENCES = arguments.factor
+
+    if arguments.loop and arguments.ticks is None and arguments.seconds is None:
+        error("looping playback requires --ticks or --seconds")
+
+    dbg("Loading Furnace module %s" % arguments.FILE)
+    parsed = parsed_module(arguments.FILE)
+    if parsed:
+        m, ins, p = parsed.song, parsed.instruments, parsed.patterns
+    else:
+        module = fur_module_index(arguments.FILE)
+        m = module.song
+        ins = list(module.instruments)
+        p = read_all_patterns(m, module.bs)
+    samples = module_samples(arguments.FILE, ins, arguments.size)
+
+    channels, nss_streams = compile_compact_nss(m, p, ins, arguments.channels, arguments.jobs)
+    blob = nss_to_blob(m, channels, nss_streams, "nss")
+    data = blob.link()
+    cursors = [(c, nss_stream_cursor(data, blob.symbols[stream_name("nss", c)])) for c in channels]
+    dbg("Playing streams: %s" % ", ".join([channel_name(c) for c in channels]))
+
+    outfd = open(arguments.output, "w") if arguments.output else sys.__stdout__
+
+    def log(time, tick, port, reg, val):
+        print("%.6f %d %s %02x %02x" % (time, tick, port, reg, val), file=outfd)
+
+    print("# YM2610 register writes - generated by nssplay.py (ngdevkit)", file=outfd)
+    print("# time(s) tick port register value", file=outfd)
+    player = nss_player(ins, samples, m.clock, m.frequency, m.speeds, log)
+    player.play(cursors, arguments.ticks, arguments.seconds, arguments.loop)
+
+
+if __name__ == "__main__":
+    main()
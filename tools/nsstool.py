@@ -19,15 +19,24 @@
 
 import argparse
 import base64
+import os
 import re
 import sys
+import time
 import zlib
-from dataclasses import dataclass, field, astuple, make_dataclass
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, astuple, make_dataclass, replace
+from functools import wraps
 from struct import pack, unpack_from
-from furtool import binstream, load_module, read_module, read_samples, read_instruments, module_id_from_path
+from furtool import fur_module_index, parsed_module, fur_pattern, fur_row
+from furtool import check_for_unused_samples, generate_instruments, generate_sample_map
+import furtool
 from furtool import fm_instrument, ssg_macro, adpcm_a_instrument, adpcm_b_instrument
 
 VERBOSE = False
+FUSE_PASSES = True
+FACTOR_SEQUENCES = False
 
 
 def error(s):
@@ -39,24 +48,6 @@ def dbg(s):
 
 
 
-@dataclass
-class fur_pattern:
-    """Notes and effects for one channel of a particular pattern in the song"""
-    channel: int = 0
-    index: int = 0
-    fxcols: int = 1
-    rows: list = field(default_factory=list, repr=False)
-
-@dataclass
-class fur_row:
-    """A single note with common attributes and effects"""
-    note: int = -1
-    ins: int = -1
-    vol: int = -1
-    fx: list[int, int] = field(default_factory=list)
-
-
-
 #
 # Helper functions
 #
@@ -227,6 +218,9 @@ def read_all_patterns(m, bs):
 # NSS opcodes
 #
 
+# opcode classes, by opcode number in the NSS stream
+nss_opcode_classes = {}
+
 def register_nss_ops():
     nss_opcodes = (
         # 0x00
@@ -362,7 +356,9 @@ def register_nss_ops():
             cid=("_opcode",int,field(default=opcode,repr=False))
             args=op[1] if len(op)>1 else []
             fields=[(x, int) for x in args]+[cid]
-            globals()[cname]=make_dataclass(cname, fields)
+            # opcodes are module classes, so that they can be pickled
+            globals()[cname]=make_dataclass(cname, fields, namespace={"__module__": __name__})
+            nss_opcode_classes[opcode]=globals()[cname]
 
 
 #
@@ -1115,10 +1111,148 @@ def check_instruments_before_first_note(nss, module, fur_pattern, ins):
 #
 
 
-def stream_from_label(stream, label):
-    label = next((i for i, v in enumerate(stream) if isinstance(v,nss_label) and v.pat==label))
-    ret = next((i for i, v in enumerate(stream[label:]) if isinstance(v,nss_ret)))
-    return stream[label:label+ret+1]
+class indexed_stream:
+    """NSS stream with the position of its labels and `ret` opcodes"""
+    def __init__(self, nss):
+        self.ops = nss
+        self.labels = {}
+        self.rets = []
+        for i, op in enumerate(nss):
+            if isinstance(op, nss_label):
+                self.labels.setdefault(op.pat, []).append(i)
+            elif isinstance(op, nss_ret):
+                self.rets.append(i)
+
+    def block(self, label, pos):
+        """bounds of the first block `label` located after `pos`"""
+        labels = self.labels[label]
+        start = labels[bisect_left(labels, pos)]
+        end = self.rets[bisect_left(self.rets, start)]
+        return start, end+1
+
+
+class control_flow_stage:
+    """a control flow pass, fed one opcode at a time during a traversal"""
+    def __init__(self, pass_function, prev):
+        self.pass_function = pass_function
+        # the previous stage in a fused traversal, and the next one
+        self.prev = prev
+        self.next = None
+        self.out_main = []
+        self.blocks = {}
+        # current stream to push output opcodes to
+        self.out = self.out_main
+        # the pass function outputs to the stream directly, unless
+        # its opcodes must be forwarded to the next stage
+        self.sink = self.out
+        # evaluating a block that was already output
+        self.replay = False
+        self.done = False
+        # label of a block whose opcodes are not fed yet
+        self.skip_to = None
+        self.flow_ops = {call: "call", call_entry: "call", nss_ret: "ret",
+                         jmp: "end", nss_end: "end"}
+
+    def output(self):
+        out = list(self.out_main)
+        for b in self.blocks.values():
+            out.extend(b)
+        return out
+
+    def set_output(self, out, replay):
+        self.out = out
+        self.replay = replay
+        self.sink = self if self.next and not replay else out
+
+    def append(self, op):
+        self.out.append(op)
+        self.next.feed(op)
+
+    def forward(self, op):
+        self.out.append(op)
+        if self.next and not self.replay:
+            self.next.feed(op)
+
+    def replay_block(self, block):
+        flow_ops = self.flow_ops
+        pass_function = self.pass_function
+        out = self.out
+        for op in block:
+            if flow_ops.get(type(op)) is None:
+                pass_function(op, out)
+            else:
+                self.feed(op)
+
+    def feed(self, op):
+        if self.skip_to is not None:
+            if not (isinstance(op, nss_label) and op.pat == self.skip_to):
+                return
+            self.skip_to = None
+        flow = self.flow_ops.get(type(op))
+        if flow is None:
+            self.pass_function(op, self.sink)
+        elif self.done:
+            return
+        elif flow == "call":
+            self.forward(op)
+            if op.pat not in self.blocks:
+                self.blocks[op.pat] = []
+                self.set_output(self.blocks[op.pat], False)
+                if self.prev:
+                    # the block starts at its label, like when a pass
+                    # looks it up in the output of the previous pass
+                    self.skip_to = op.pat
+            else:
+                # evaluate this block to keep context up to date
+                # but do not keep the generated opcodes. Like when passes
+                # are run one after the other, the evaluated block is the
+                # one output by the previous pass
+                self.set_output([], True)
+                if self.prev:
+                    block = self.prev.blocks[op.pat]
+                    start = next((i for i, x in enumerate(block)
+                                  if isinstance(x, nss_label) and x.pat == op.pat))
+                    self.replay_block(block[start:])
+        elif flow == "ret":
+            self.forward(op)
+            self.set_output(self.out_main, False)
+        else:
+            self.forward(op)
+            self.done = True
+
+
+def run_control_flow_stages(pass_functions, nss):
+    # same traversal as run_control_flow_pass, but every pass function
+    # is a stage that processes the output of the previous one, so that
+    # all passes run in a single traversal of the stream
+    stages = []
+    for f in pass_functions:
+        stages.append(control_flow_stage(f, stages[-1] if stages else None))
+        if len(stages) > 1:
+            stages[-2].next = stages[-1]
+            stages[-2].set_output(stages[-2].out, False)
+    first = stages[0]
+    # a stream can use call/ret opcodes, with a stack that is one call deep.
+    # the stream is traversed with a cursor, blocks are looked up by index
+    stream = indexed_stream(nss)
+    ops = stream.ops
+    ret_pos, ret_end = 0, 0
+    pos, end = 0, len(ops)
+
+    feed = first.feed
+    flow_ops = first.flow_ops
+    while pos < end and not first.done:
+        op = ops[pos]
+        pos += 1
+        feed(op)
+        flow = flow_ops.get(type(op))
+        if flow == "call":
+            ret_pos, ret_end = pos, end
+            pos, end = stream.block(op.pat, pos)
+        elif flow == "ret":
+            pos, end = ret_pos, ret_end
+
+    return stages
 
 
 def run_control_flow_pass(pass_function, nss):
@@ -1132,11 +1266,15 @@ def run_control_flow_pass(pass_function, nss):
     # current stream to push output opcodes to
     out = out_main
     # a stream can use call/ret opcodes, with a stack that is one call deep.
-    prev_stream = []
-    stream = list(nss)
-
-    while stream:
-        op = stream.pop(0)
+    # the stream is traversed with a cursor, blocks are looked up by index
+    stream = indexed_stream(nss)
+    ops = stream.ops
+    ret_pos, ret_end = 0, 0
+    pos, end = 0, len(ops)
+
+    while pos < end:
+        op = ops[pos]
+        pos += 1
         if type(op) in [call, call_entry]:
             out.append(op)
             if op.pat not in seen_blocks:
@@ -1146,12 +1284,12 @@ def run_control_flow_pass(pass_function, nss):
                 # evaluate this block to keep context up to date
                 # but do not keep the generated opcodes
                 out = []
-            prev_stream = stream
-            stream = stream_from_label(stream, op.pat)
+            ret_pos, ret_end = pos, end
+            pos, end = stream.block(op.pat, pos)
         elif type(op) == nss_ret:
             out.append(op)
             out = out_main
-            stream = prev_stream
+            pos, end = ret_pos, ret_end
         elif type(op) in [jmp, nss_end]:
             out.append(op)
             break
@@ -1161,38 +1299,103 @@ def run_control_flow_pass(pass_function, nss):
     return out_main + out_blocks
 
 
-tempo_injected=False
-ext_fm2_injected=False
-def compact_nss_stream(nss, m, ins, channel):
+def control_flow_pass(make_pass):
+    """build a stream pass out of a function that returns a per-opcode pass"""
+    @wraps(make_pass)
+    def stream_pass(nss, **kwargs):
+        return run_control_flow_pass(make_pass(**kwargs), nss)
+    stream_pass.op_pass = make_pass
+    stream_pass.fusion = "control_flow"
+    return stream_pass
+
+
+def filter_pass(make_filter):
+    """build a stream pass out of a function that returns an opcode filter"""
+    def make_pass(**kwargs):
+        keep = make_filter(**kwargs)
+        def filter_op(op, out):
+            if keep(op):
+                out.append(op)
+        return filter_op
+    @wraps(make_filter)
+    def stream_pass(nss, **kwargs):
+        keep = make_filter(**kwargs)
+        return [op for op in nss if keep(op)]
+    stream_pass.op_pass = make_pass
+    stream_pass.fusion = "filter"
+    return stream_pass
+
+
+class pass_manager:
+    """run a sequence of stream passes, in order
+
+    consecutive control flow passes are fused into a single traversal
+    of the stream. filter passes can be fused after them, as a control
+    flow pass only outputs the opcodes reachable from the main sequence.
+    """
+    def __init__(self, passes, fuse=True):
+        self.passes = passes
+        self.fuse = fuse
+
+    def groups(self):
+        groups = []
+        for p in self.passes:
+            fusion = getattr(p, "fusion", None)
+            prev = getattr(groups[-1][0], "fusion", None) if groups else None
+            if self.fuse and prev == "control_flow" and fusion in ["control_flow", "filter"]:
+                groups[-1].append(p)
+            else:
+                groups.append([p])
+        return groups
+
+    def run(self, nss, **kwargs):
+        size = stream_size_in_bytes(nss) if VERBOSE else 0
+        for group in self.groups():
+            start = time.perf_counter()
+            if len(group) == 1:
+                outs = [group[0](nss, **kwargs)]
+            else:
+                stages = run_control_flow_stages([p.op_pass(**kwargs) for p in group], nss)
+                outs = [s.output() for s in stages] if VERBOSE else [stages[-1].output()]
+            elapsed = time.perf_counter() - start
+            for i, p in enumerate(group):
+                new_size = stream_size_in_bytes(outs[i]) if VERBOSE else 0
+                if i == 0:
+                    dbg(" - %s [%.2fms, %d -> %d bytes]"%(p.__doc__, elapsed*1000, size, new_size))
+                else:
+                    dbg(" - %s [fused, %d -> %d bytes]"%(p.__doc__, size, new_size))
+                size = new_size
+            nss = outs[-1]
+        return nss
+
+
+def compact_nss_stream(nss, m, ins, channel, first_stream=False):
     # insert a tempo opcode on the first track that is used in the Furnace module
-    global tempo_injected
-    if not tempo_injected and stream_size_in_effective_opcodes(nss)>0:
+    if first_stream:
         tb = round(256 - (4000000 / (1152 * m.frequency)))
         nss.insert(0, tempo(tb))
-        tempo_injected = True
-
-    global ext_fm2_injected
-    if ext_fm2 and not ext_fm2_injected and stream_size_in_effective_opcodes(nss)>0:
-        nss.insert(0, set_2ch())
-        ext_fm2_injected = True
+        if ext_fm2:
+            nss.insert(0, set_2ch())
 
     nss.insert(0, nss_label("_start"))
 
     dbg("Transformation passes for channel %s:"%channel_name(channel).upper())
 
-    for fun in (remove_locations,
-                remove_unreferenced_labels,
-                merge_adjacent_waits,
-                compact_instr,
-                insert_missing_vol,
-                compact_wait_n_last,
-                fuse_note_wait_last,
-                compact_calls,
-                tune_adpcm_b_notes,
-                remove_ctx,
-                resolve_jmp_and_call_opcodes):
-        dbg(" - %s"%fun.__doc__)
-        nss = fun(nss, ins=ins)
+    passes = [remove_locations,
+              remove_unreferenced_labels,
+              merge_adjacent_waits,
+              compact_instr,
+              insert_missing_vol,
+              compact_wait_n_last,
+              fuse_note_wait_last,
+              tune_adpcm_b_notes,
+              remove_ctx,
+              factor_repeated_sequences,
+              compact_calls,
+              resolve_jmp_and_call_opcodes]
+    if not FACTOR_SEQUENCES:
+        passes.remove(factor_repeated_sequences)
+    nss = pass_manager(passes, fuse=FUSE_PASSES).run(nss, ins=ins)
     # for n in nss:
     #     print(n)
     # sys.exit(0)
@@ -1200,9 +1403,10 @@ def compact_nss_stream(nss, m, ins, channel):
     return nss
 
 
-def remove_locations(nss, **kwargs):
+@filter_pass
+def remove_locations(**kwargs):
     """Remove `location` opcodes from the stream"""
-    return [op for op in nss if not isinstance(op, nss_loc)]
+    return lambda op: not isinstance(op, nss_loc)
 
 
 def remove_unreferenced_labels(nss, **kwargs):
@@ -1244,7 +1448,8 @@ def merge_adjacent_waits(nss, **kwargs):
     return compact
 
 
-def compact_instr(nss, **kwargs):
+@control_flow_pass
+def compact_instr(**kwargs):
     """Remove `instrument` opcode if it does not change the current intrument"""
     fm2_op_map = {fm2_op1_instr: 0, fm2_op2_instr: 1, fm2_op3_instr: 2, fm2_op4_instr: 3}
     fm_ctx_map = {fm_ctx_1: 0, fm_ctx_2: 1, fm_ctx_3: 2, fm_ctx_4: 3}
@@ -1310,11 +1515,11 @@ def compact_instr(nss, **kwargs):
         else:
             out.append(op)
 
-    out = run_control_flow_pass(compact_instr_pass, nss)
-    return out
+    return compact_instr_pass
 
 
-def insert_missing_vol(nss, **kwargs):
+@control_flow_pass
+def insert_missing_vol(**kwargs):
     """insert a `volume` opcode before the first note in the stream if it is missing"""
     fm_ctx_map = {fm_ctx_1: 0, fm_ctx_2: 1, fm_ctx_3: 2, fm_ctx_4: 3}
     fm_ctx = 0
@@ -1380,11 +1585,11 @@ def insert_missing_vol(nss, **kwargs):
         else:
             out.append(op)
 
-    out = run_control_flow_pass(insert_missing_vol_pass, nss)
-    return out
+    return insert_missing_vol_pass
 
 
-def compact_wait_n_last(nss, **kwargs):
+@control_flow_pass
+def compact_wait_n_last(**kwargs):
     """Replace `wait_n` opcode by shorter `wait_last` if possible"""
     last_rows = -1
 
@@ -1402,11 +1607,11 @@ def compact_wait_n_last(nss, **kwargs):
         else:
             out.append(op)
 
-    out = run_control_flow_pass(compact_wait_n_last_pass, nss)
-    return out
+    return compact_wait_n_last_pass
 
 
-def fuse_note_wait_last(nss, **kwargs):
+@control_flow_pass
+def fuse_note_wait_last(**kwargs):
     """replace `note` + `wait` sequence with `note_and_wait_last` if possible"""
     fuse_map = {fm_note: fm_note_w,
                 s_note: s_note_w,
@@ -1444,7 +1649,224 @@ def fuse_note_wait_last(nss, **kwargs):
                 start_stop_op = False
             out.append(op)
 
-    out = run_control_flow_pass(fuse_note_wait_last_pass, nss)
+    return fuse_note_wait_last_pass
+
+
+def suffix_array(seq):
+    """Suffix array of a sequence of non-negative integers (prefix doubling)"""
+    n = len(seq)
+    sa = list(range(n))
+    rank = list(seq)
+    k = 1
+    while n:
+        key = lambda i: (rank[i], rank[i+k] if i+k < n else -1)
+        sa.sort(key=key)
+        tmp = [0] * n
+        for j in range(1, n):
+            tmp[sa[j]] = tmp[sa[j-1]] + (key(sa[j-1]) != key(sa[j]))
+        rank = tmp
+        if rank[sa[-1]] == n-1:
+            break
+        k *= 2
+    return sa
+
+
+def lcp_array(seq, sa):
+    """Longest common prefix of every suffix with the previous one in `sa`"""
+    n = len(seq)
+    rank = [0] * n
+    for i, x in enumerate(sa):
+        rank[x] = i
+    lcp = [0] * n
+    h = 0
+    for i in range(n):
+        if rank[i] > 0:
+            j = sa[rank[i]-1]
+            while i+h < n and j+h < n and seq[i+h] == seq[j+h]:
+                h += 1
+            lcp[rank[i]] = h
+            if h > 0:
+                h -= 1
+        else:
+            h = 0
+    return lcp
+
+
+def repeated_sequences(seq, sa, lcp):
+    """Yield (length, first, count) for every sequence repeated in seq,
+    i.e. every LCP interval of the suffix array"""
+    stack = [(0, 0)]
+    for i in range(1, len(sa)+1):
+        cur = lcp[i] if i < len(sa) else 0
+        left = i-1
+        while stack[-1][0] > cur:
+            h, left = stack.pop()
+            yield h, sa[left], i-left
+        if stack[-1][0] < cur:
+            stack.append((cur, left))
+
+
+# first character used to encode opcodes as strings
+FACTOR_BASE = 0x100
+# number of candidate sequences considered in a factoring round
+FACTOR_CANDIDATES = 512
+# the call table addresses up to 256 blocks in a stream
+FACTOR_MAX_BLOCKS = 256
+
+def factor_repeated_sequences(nss, **kwargs):
+    """Factor repeated opcode sequences into blocks called from the main sequence"""
+    # A block is only called from the main sequence, as NSS has a call
+    # stack that is one call deep. So a repeated sequence is factored
+    # by splitting every block that contains it into smaller blocks,
+    # which are called one after the other from the main sequence.
+    # This plays the same opcodes in the same order, at the cost of
+    # one call table entry per block called.
+    end = next(i for i, op in enumerate(nss) if type(op) in [jmp, nss_end]) + 1
+    main = nss[:end]
+    blocks = {}
+    for op in nss[end:]:
+        if isinstance(op, nss_label):
+            label = op.pat
+            blocks[label] = []
+        elif not isinstance(op, nss_ret):
+            blocks[label].append(op)
+
+    # blocks are encoded as strings, one character per distinct opcode
+    keys = {}
+    sizes = []
+    def encode(ops):
+        chars = []
+        for op in ops:
+            k = (type(op).__name__,) + astuple(op)
+            if k not in keys:
+                keys[k] = chr(FACTOR_BASE + len(keys))
+                sizes.append(stream_size_in_bytes([op]))
+            chars.append(keys[k])
+        return "".join(chars)
+    def nbytes(s):
+        return sum([sizes[ord(c)-FACTOR_BASE] for c in s])
+
+    # block name -> (encoded opcodes, opcodes)
+    pieces = {label: (encode(ops), ops) for label, ops in blocks.items()}
+    by_content = {}
+    for label, (s, _) in pieces.items():
+        by_content.setdefault(s, label)
+    # number of call table entries for each block
+    uses = {label: 0 for label in pieces}
+    for op in main:
+        if type(op) == call:
+            uses[op.pat] += 1
+    # blocks that got split, and the blocks that replace them
+    expand = {}
+    repeats = 0
+
+    def factor_gain(r):
+        # bytes saved by factoring r, w.r.t the current blocks. A block
+        # costs a `ret` opcode and an entry in the call table offsets
+        hosts = [n for n, (s, _) in pieces.items() if r in s and s != r]
+        added = set()
+        calls = 0
+        removed = 0
+        for n in hosts:
+            s = pieces[n][0]
+            segs = s.split(r)
+            parts = [x for x in segs if x]
+            calls += uses[n] * (len(segs) - 1 + len(parts) - 1)
+            removed += nbytes(s) + 3
+            added.update([x for x in parts if x not in by_content])
+        if r not in by_content:
+            added.add(r)
+        gain = removed - sum([nbytes(x) + 3 for x in added]) - calls
+        return gain, hosts, len(added) - len(hosts)
+
+    def new_piece(name, s, ops):
+        if s not in by_content:
+            pieces[name] = (s, ops)
+            by_content[s] = name
+            uses[name] = 0
+        return by_content[s]
+
+    def factor(r, hosts):
+        nonlocal repeats
+        rname = None
+        for n in hosts:
+            s, ops = pieces.pop(n)
+            if by_content.get(s) == n:
+                del by_content[s]
+            # split the block around the non-overlapping occurrences of r
+            parts = []
+            pos = 0
+            i = s.find(r)
+            while i != -1:
+                if i > pos:
+                    parts.append(new_piece("%s_%d"%(n, len(parts)), s[pos:i], ops[pos:i]))
+                if not rname:
+                    rname = new_piece("rep_%02x"%repeats, r, ops[i:i+len(r)])
+                    repeats += 1
+                parts.append(rname)
+                pos = i + len(r)
+                i = s.find(r, pos)
+            if pos < len(s):
+                parts.append(new_piece("%s_%d"%(n, len(parts)), s[pos:], ops[pos:]))
+            expand[n] = parts
+            for x in parts:
+                uses[x] += uses[n]
+            del uses[n]
+
+    saved = 0
+    while True:
+        # all pieces, separated by unique symbols
+        seq = []
+        text = []
+        for s, _ in pieces.values():
+            seq.extend([ord(c)-FACTOR_BASE for c in s] + [len(keys) + len(text)])
+            text.append(s)
+        text = "\0".join(text)
+        sa = suffix_array(seq)
+        lcp = lcp_array(seq, sa)
+        prefix = [0]
+        for x in seq:
+            prefix.append(prefix[-1] + (sizes[x] if x < len(sizes) else 0))
+        candidates = []
+        for length, first, count in repeated_sequences(seq, sa, lcp):
+            size = prefix[first+length] - prefix[first]
+            estimate = (count-1) * size - 3 - count
+            if estimate > 0:
+                candidates.append((estimate, text[first:first+length]))
+        candidates.sort(key=lambda x: (-x[0], x[1]))
+        factored = False
+        for _, r in candidates[:FACTOR_CANDIDATES]:
+            gain, hosts, new_blocks = factor_gain(r)
+            if gain > 0 and len(pieces) + new_blocks <= FACTOR_MAX_BLOCKS:
+                factor(r, hosts)
+                saved += gain
+                factored = True
+        if not factored:
+            break
+
+    if not expand:
+        return nss
+    dbg("   %d repeated sequences factored, %d bytes saved"%(repeats, saved))
+
+    def flatten(n):
+        if n not in expand:
+            return [n]
+        return [x for p in expand[n] for x in flatten(p)]
+    out = []
+    order = {}
+    for op in main:
+        if type(op) == call:
+            for n in flatten(op.pat):
+                c = call(-1, -1)
+                c.pat = n
+                out.append(c)
+                order.setdefault(n, True)
+        else:
+            out.append(op)
+    for n in order:
+        out.append(nss_label(n))
+        out.extend(pieces[n][1])
+        out.append(nss_ret())
     return out
 
 
@@ -1467,17 +1889,18 @@ def compact_calls(nss, **kwargs):
         entries.append(op)
 
     for op in nss:
+        # a call table holds up to 255 entries
+        if entries and (type(op) != call or len(entries) == 255):
+            compact.append(call_tbl(len(entries)))
+            for e in entries:
+                entry = call_entry(offset[e.pat])
+                entry.pat = e.pat
+                entry.desc = "for %s"%e.pat
+                compact.append(entry)
+            entries = []
         if type(op) == call:
             add_call(op)
         else:
-            if entries:
-                compact.append(call_tbl(len(entries)))
-                for e in entries:
-                    entry = call_entry(offset[e.pat])
-                    entry.pat = e.pat
-                    entry.desc = "for %s"%e.pat
-                    compact.append(entry)
-                entries = []
             compact.append(op)
     offsets = []
     for v, k in sorted([(v,k) for k,v in offset.items()]):
@@ -1490,7 +1913,8 @@ def compact_calls(nss, **kwargs):
 
 
 
-def tune_adpcm_b_notes(nss, **kwargs):
+@control_flow_pass
+def tune_adpcm_b_notes(**kwargs):
     """Tune ADPCM-B notes based on instrument's sample speed"""
     ins = kwargs["ins"]
     # current instrument for ADPCM-B
@@ -1515,20 +1939,21 @@ def tune_adpcm_b_notes(nss, **kwargs):
         else:
             out.append(op)
 
-    out = run_control_flow_pass(tune_adpcm_b_pass, nss)
-    return out
+    return tune_adpcm_b_pass
 
 
-def remove_ctx(nss, **kwargs):
+@filter_pass
+def remove_ctx(**kwargs):
     """remove `context` opcodes from compact stream"""
     ctxs = [fm_ctx_1, fm_ctx_2, fm_ctx_3, fm_ctx_4,
             s_ctx_1, s_ctx_2, s_ctx_3,
             a_ctx_1, a_ctx_2, a_ctx_3, a_ctx_4, a_ctx_5, a_ctx_6]
-    out = [x for x in nss if type(x) not in ctxs]
-    return out
+    return lambda op: type(op) not in ctxs
 
 
-def compact_ctx(nss):
+@control_flow_pass
+def compact_ctx(**kwargs):
+    """Remove `context` opcodes that do not change the current context"""
     fm_ctx_map = {fm_ctx_1: 0, fm_ctx_2: 1, fm_ctx_3: 2, fm_ctx_4: 3}
     s_ctx_map = {s_ctx_1: 0, s_ctx_2: 1, s_ctx_3: 2}
     a_ctx_map = {a_ctx_1: 0, a_ctx_2: 1, a_ctx_3: 2, a_ctx_4: 3, a_ctx_5: 4, a_ctx_6: 5}
@@ -1564,8 +1989,7 @@ def compact_ctx(nss):
             else: a_ctx = val
         out.append(op)
 
-    out = run_control_flow_pass(compact_ctx_pass, nss)
-    return out
+    return compact_ctx_pass
 
 
 def resolve_jmp_and_call_opcodes(nss, **kwargs):
@@ -1668,6 +2092,16 @@ def nss_footer(name, fd):
     print("%s_end::" % name, file=fd)
 
 
+def op_bytes(op):
+    """Encoding of a NSS opcode and its arguments"""
+    op_data = []
+    # if op._count_op or op._opcode > 0:
+    if op._opcode > 0:
+        op_data.append(op._opcode)
+    op_data.extend(astuple(op)[:-1])
+    return bytes([x&0xff for x in op_data])
+
+
 def nss_to_asm(nss, m, name, fd):
     def asm_slice(nss):
         for op in nss:
@@ -1681,12 +2115,7 @@ def nss_to_asm(nss, m, name, fd):
                 elif "jmp" not in op.pat:
                     print("        ;; pattern %s"%(op.pat,), file=fd)
                 continue
-            op_data = []
-            # if op._count_op or op._opcode > 0:
-            if op._opcode > 0:
-                op_data.append(op._opcode)
-            op_data.extend(astuple(op)[:-1])
-            hexdata = ", ".join(["0x%02x"%(x&0xff,) for x in op_data])
+            hexdata = ", ".join(["0x%02x"%x for x in op_bytes(op)])
             comment = " ; %s"%type(op).__name__.upper()
             if "desc" in dir(op):
                 comment+=" "+op.desc
@@ -1705,6 +2134,93 @@ def nss_to_asm(nss, m, name, fd):
     asm_slice(stream_ops)
 
 
+class nss_blob:
+    """NSS streams assembled as a relocatable binary. References to
+    symbols are stored as offsets from the start of the binary, and
+    are only resolved once the load address of the binary is known"""
+    def __init__(self):
+        self.data = bytearray()
+        self.symbols = {}
+        self.patterns = []
+        self.relocations = []
+
+    def symbol(self, name):
+        if name:
+            self.symbols[name] = len(self.data)
+
+    def word_ref(self, name):
+        self.relocations.append((len(self.data), name))
+        self.data.extend(b"\x00\x00")
+
+    def link(self, base=0):
+        data = bytearray(self.data)
+        for offset, name in self.relocations:
+            data[offset:offset+2] = pack("<H", (base + self.symbols[name]) & 0xffff)
+        return data
+
+
+def nss_compact_header_bin(mod, channels, name, blob):
+    bitfield, _ = channels_bitfield(channels)
+    blob.symbol(name)
+    blob.data.append(len(channels))
+    blob.data.extend(pack("<H", bitfield))
+    blob.data.append(len(mod.speeds))
+    blob.data.extend(mod.speeds)
+    for c in channels:
+        blob.word_ref(stream_name(name, c))
+
+
+def nss_to_bin(nss, name, blob):
+    start = next(i for i,v in enumerate(nss) if isinstance(v, nss_label) and v.pat == '_start')
+    # call entries are located before the stream's entry point
+    for op in nss[:start]:
+        if not isinstance(op, (nss_label, nss_loc)):
+            blob.data.extend(op_bytes(op))
+    blob.symbol(name)
+    entry = len(blob.data)
+    for op in nss[start:]:
+        if isinstance(op, nss_loc):
+            continue
+        if isinstance(op, nss_label):
+            # pattern offsets are relative to the stream's entry point
+            if op.pat != "_start" and "call_" not in op.pat and "jmp" not in op.pat:
+                blob.patterns.append((name, op.pat, len(blob.data) - entry))
+            continue
+        blob.data.extend(op_bytes(op))
+
+
+def nss_symbols(m, blob, uri, bank, base, fd):
+    print("# NSS binary symbols - generated by nsstool.py (ngdevkit)", file=fd)
+    print("# ---", file=fd)
+    print("# Song title: %s" % m.name, file=fd)
+    print("# Song author: %s" % m.author, file=fd)
+    print("#", file=fd)
+    print("uri: file://%s" % uri, file=fd)
+    print("size: %d" % len(blob.data), file=fd)
+    if bank != None:
+        print("bank: %d" % bank, file=fd)
+    print("# load address the relocations are resolved for in the binary", file=fd)
+    print("base: %d" % base, file=fd)
+    print("# offsets from the start of the binary", file=fd)
+    print("symbols:", file=fd)
+    for name, offset in blob.symbols.items():
+        print("  %s: %d" % (name, offset), file=fd)
+    print("# 16-bit little-endian words holding the address of a symbol", file=fd)
+    print("relocations:", file=fd)
+    for offset, name in blob.relocations:
+        print("  - offset: %d" % offset, file=fd)
+        print("    symbol: %s" % name, file=fd)
+    print("# offsets from the entry point of each stream", file=fd)
+    print("patterns:", file=fd)
+    streams = {}
+    for stream, pat, offset in blob.patterns:
+        streams.setdefault(stream, []).append((pat, offset))
+    for stream, pats in streams.items():
+        print("  %s:" % stream, file=fd)
+        for pat, offset in pats:
+            print("    %s: %d" % (pat, offset), file=fd)
+
+
 def stream_size_in_effective_opcodes(stream):
     def control_flow(op):
         return type(op) in [nss_loc, jmp, call, pat_offset, call_tbl, call_entry, nss_ret, nss_label, nss_end, wait_n, wait_last]
@@ -1733,60 +2249,354 @@ def channels_bitfield(channels):
 
 
 
-def main():
-    global VERBOSE, ext_fm2
-
-    parser = argparse.ArgumentParser(
-        description="Convert Furnace module patterns to NSS stream")
-
-    parser.add_argument("FILE", help="Furnace module")
-    parser.add_argument("-o", "--output", help="Output file name")
-
-    parser.add_argument("-b", "--bank", type=int,
-                       help="generate data for a bank-switched Z80 memory area")
+#
+# NSS streams cost analysis
+#
 
-    parser.add_argument("-n", "--name",
-                        help="Name of the ASM label for the NSS data. Empty name skips label.")
+# Z80 clock of the Neo Geo sound CPU
+Z80_CLOCK = 4000000
+
+# Z80 T-states spent by the stream tracker (stream.s) around opcode handlers
+NSS_ROW_CYCLES = 495           # per row: wait rows update, streams loop setup, next row ticks
+NSS_STREAM_WAIT_CYCLES = 314   # per stream that waits during a row
+NSS_STREAM_RUN_CYCLES = 583    # per stream that processes opcodes during a row
+NSS_DISPATCH_CYCLES = 161      # per opcode: process function and jump table
+NSS_ENTRY_DISPATCH_CYCLES = 41 # per call entry: process function only
+
+# Worst-case T-states of the opcode handlers in nullsound: longest path
+# through the handler and the functions it calls, loops counted once,
+# YM2610 writes included. Keep in sync when handlers change.
+NSS_OPCODE_CYCLES = {
+    "jmp": 165, "nss_end": 5874, "tempo": 1416, "wait_n": 700,
+    "call": 209, "nss_ret": 204, "nop": 17, "speed": 192,
+    "groove": 167, "wait_last": 697, "call_tbl": 120, "call_entry": 340,
+    # FM
+    "fm_ctx_1": 349, "fm_ctx_2": 349, "fm_ctx_3": 349, "fm_ctx_4": 349,
+    "fm_instr": 2391, "fm_note": 938, "fm_stop": 449, "fm_note_w": 1679,
+    "op1_lvl": 72, "op2_lvl": 72, "op3_lvl": 72, "op4_lvl": 72,
+    "fm_pitch": 207, "fm_vol": 443, "fm_pan": 422, "fm_delay": 134,
+    "fm_cut": 134, "set_2ch": 44, "fm2_ops_off": 810,
+    "fm2_op1_vol": 513, "fm2_op2_vol": 513, "fm2_op3_vol": 513, "fm2_op4_vol": 513,
+    "fm2_op1_instr": 2187, "fm2_op2_instr": 2187, "fm2_op3_instr": 2187, "fm2_op4_instr": 2187,
+    "fm2_op1_note_on": 1028, "fm2_op2_note_on": 1028, "fm2_op3_note_on": 1028, "fm2_op4_note_on": 1028,
+    # FM2 FX: OP context switch followed by the regular FX handler
+    "fm2_delay": 346, "fm2_vibrato": 478, "fm2_vibrato_off": 275,
+    "fm2_note_porta": 648, "fm2_legato": 252, "fm2_legato_off": 252,
+    "fm2_vol_slide_off": 360, "fm2_vol_slide_u": 758, "fm2_vol_slide_d": 758,
+    # SSG
+    "s_ctx_1": 179, "s_ctx_2": 179, "s_ctx_3": 179, "s_macro": 420,
+    "s_note": 610, "s_stop": 833, "s_note_w": 1351, "s_vol": 443,
+    "s_env": 589, "s_delay": 134, "s_pitch": 207, "s_cut": 134,
+    # ADPCM-A
+    "a_ctx_1": 202, "a_ctx_2": 202, "a_ctx_3": 202, "a_ctx_4": 202,
+    "a_ctx_5": 202, "a_ctx_6": 202, "a_instr": 615, "a_start": 151,
+    "a_stop": 437, "a_start_w": 892, "a_vol": 443, "a_delay": 134,
+    "a_cut": 134, "a_retrigger": 149, "a_pan": 72,
+    # ADPCM-B
+    "b_ctx": 31, "b_instr": 960, "b_note": 803, "b_stop": 332,
+    "b_vol": 443, "b_delay": 134, "b_cut": 134, "b_pan": 72,
+    # FX
+    "arpeggio": 235, "arpeggio_speed": 49, "arpeggio_off": 82,
+    "quick_legato_u": 213, "quick_legato_d": 213,
+    "vol_slide_off": 148, "vol_slide_u": 546, "vol_slide_d": 546,
+    "note_slide_off": 148, "note_slide_u": 671, "note_slide_d": 671,
+    "note_pitch_slide_u": 538, "note_pitch_slide_d": 538,
+    "note_porta": 436, "vibrato": 266, "vibrato_off": 63,
+    "legato": 40, "legato_off": 40,
+}
+
+
+# Z80 T-states of the pipelines, which run at every tick after the stream
+# tracker, whether opcodes were processed or not. Longest paths, like for
+# the opcode handlers.
+NSS_TICK_CYCLES = 256          # per tick: stream tracker checks, pipeline calls
+NSS_PIPELINE_CYCLES = 5940     # per tick: FM, SSG, ADPCM-A and ADPCM-B pipelines, all channels idle
+NSS_FM2_OPS_PIPELINE_CYCLES = 1692  # per tick: extra cost of extended FM2 pipelines
+
+# per tick and per active channel, without FX. Channels that have a
+# stream are considered active for the whole song.
+NSS_CHANNEL_PIPELINE_CYCLES = {"fm": 3001, "fm2_op": 2678, "ssg": 3302,
+                               "adpcm_a": 1128, "adpcm_b": 3270}
+
+# per tick and per FX enabled on an active channel
+NSS_FX_CYCLES = {"vol_slide": 409, "note_slide": 409, "vibrato": 486,
+                 "arpeggio": 268, "quick_legato": 237}
+
+# opcodes that enable or disable a FX. nullsound stops a slide once it
+# reaches its target, but that is not tracked here, so slides are
+# counted until they are disabled explicitly.
+NSS_FX_START = {
+    "vol_slide_u": "vol_slide", "vol_slide_d": "vol_slide",
+    "fm2_vol_slide_u": "vol_slide", "fm2_vol_slide_d": "vol_slide",
+    "note_slide_u": "note_slide", "note_slide_d": "note_slide",
+    "note_pitch_slide_u": "note_slide", "note_pitch_slide_d": "note_slide",
+    "note_porta": "note_slide", "fm2_note_porta": "note_slide",
+    "vibrato": "vibrato", "fm2_vibrato": "vibrato", "arpeggio": "arpeggio",
+    "quick_legato_u": "quick_legato", "quick_legato_d": "quick_legato",
+}
+NSS_FX_STOP = {
+    "vol_slide_off": "vol_slide", "fm2_vol_slide_off": "vol_slide",
+    "note_slide_off": "note_slide", "vibrato_off": "vibrato",
+    "fm2_vibrato_off": "vibrato", "arpeggio_off": "arpeggio",
+}
+# a quick legato stops by itself, it is counted for the row that starts it
+NSS_FX_ONE_ROW = {"quick_legato"}
+
+
+def op_cycles(op):
+    name = type(op).__name__
+    dispatch = NSS_ENTRY_DISPATCH_CYCLES if name == "call_entry" else NSS_DISPATCH_CYCLES
+    return dispatch + NSS_OPCODE_CYCLES[name]
+
+
+def ctx_op_name(channel):
+    """Name of the context opcode that the stream tracker runs before
+    processing the opcodes of a channel"""
+    if channel < 4:
+        return "fm_ctx_%d" % (channel + 1)
+    elif channel < 7:
+        return "s_ctx_%d" % (channel - 3)
+    elif channel < 13:
+        return "a_ctx_%d" % (channel - 6)
+    else:
+        return "b_ctx"
+
+
+def channel_pipeline(channel):
+    """Kind of pipeline that runs for a channel at every tick"""
+    if ext_fm2 and channel in [1, 14, 15, 16]:
+        return "fm2_op"
+    elif channel < 4 or channel > 13:
+        return "fm"
+    elif channel < 7:
+        return "ssg"
+    elif channel < 13:
+        return "adpcm_a"
+    else:
+        return "adpcm_b"
+
+
+def update_fx_state(fx, ops):
+    """Update the FX enabled on a channel with the opcodes of a row"""
+    fx -= NSS_FX_ONE_ROW
+    for op in ops:
+        name = type(op).__name__
+        if name in NSS_FX_START:
+            fx.add(NSS_FX_START[name])
+        elif name in NSS_FX_STOP:
+            fx.discard(NSS_FX_STOP[name])
+
+
+class nss_stream_cursor:
+    """Follow the control flow of a compiled NSS stream the way the
+    stream tracker does, and decode the opcodes processed at every row"""
+    def __init__(self, data, start):
+        self.data = data
+        self.start = start
+        self.pos = start
+        self.saved = start
+        self.entries = 0
+        self.table_entry = False
+        self.last_wait = 1
+        # rows to wait until the stream gets processed, like the tracker
+        # which starts all streams with a wait of 1
+        self.wait = 1
+        self.ended = False
+        self.looped = False
+
+    def offset(self, lsb, msb):
+        return self.start + (lsb | msb << 8)
+
+    def next_op(self):
+        """Decode the next opcode and follow its control flow.
+        Returns the opcode and whether the stream yields afterwards"""
+        if self.table_entry:
+            # call entries index the pattern offsets located before the stream
+            entry = self.data[self.pos]
+            self.pos += 1
+            self.saved = self.pos
+            loc = self.start + 2 * (entry - 0x100)
+            self.pos = self.offset(self.data[loc], self.data[loc + 1])
+            self.entries -= 1
+            self.table_entry = False
+            return call_entry(entry), False
+        opcode = self.data[self.pos]
+        if opcode not in nss_opcode_classes:
+            error("unknown NSS opcode 0x%02x at offset %d" % (opcode, self.pos))
+        cls = nss_opcode_classes[opcode]
+        nargs = len(cls.__dataclass_fields__) - 1
+        op = cls(*self.data[self.pos + 1:self.pos + 1 + nargs])
+        self.pos += 1 + nargs
+        yields = False
+        if isinstance(op, jmp):
+            target = self.offset(op.lsb, op.msb)
+            # the only jump back in a NSS stream is the loop of the song
+            self.looped |= target < self.pos
+            self.pos = target
+        elif isinstance(op, call):
+            self.saved = self.pos
+            self.pos = self.offset(op.lsb, op.msb)
+        elif isinstance(op, call_tbl):
+            self.entries = op.calls
+            self.table_entry = True
+        elif isinstance(op, nss_ret):
+            self.pos = self.saved
+            self.table_entry = self.entries != 0
+        elif isinstance(op, wait_n):
+            self.last_wait = self.wait = op.rows
+            yields = True
+        elif type(op) in [wait_last, fm_note_w, s_note_w, a_start_w]:
+            self.wait = self.last_wait
+            yields = True
+        elif isinstance(op, nss_end):
+            self.ended = True
+            yields = True
+        return op, yields
+
+    def row(self):
+        """Opcodes processed until the stream yields"""
+        ops = []
+        looped = self.looped
+        while True:
+            op, yields = self.next_op()
+            ops.append(op)
+            if yields:
+                return ops
+            if looped and isinstance(op, jmp):
+                error("NSS stream at offset %d loops without waiting" % self.start)
+            looped = self.looped
+
+
+def analyze_nss_cycles(m, channels, nss_streams, budget, fd):
+    """Walk the compiled streams of all channels tick by tick and report
+    the Z80 cycles spent by the stream tracker and the pipelines"""
+    blob = nss_to_blob(m, channels, nss_streams, "nss")
+    data = blob.link()
+    cursors = [nss_stream_cursor(data, blob.symbols[stream_name("nss", c)]) for c in channels]
+    if not budget:
+        budget = round(Z80_CLOCK / m.frequency)
+
+    # the pipelines of all channels run at every tick
+    base_pipeline_cycles = NSS_TICK_CYCLES + NSS_PIPELINE_CYCLES
+    if ext_fm2:
+        base_pipeline_cycles += NSS_FM2_OPS_PIPELINE_CYCLES
+    base_pipeline_cycles += sum([NSS_CHANNEL_PIPELINE_CYCLES[channel_pipeline(c)] for c in channels])
+    fx = [set() for c in channels]
+
+    # the streams are processed on the first tick of every row,
+    # the other ticks of the row only run the pipelines
+    ticks = list(m.speeds)
+    row, tick = 0, 0
+    total = 0
+    worst = (0, 0, 0)
+    over_budget = []
+    stream_cycles = [0] * len(channels)
+    stream_worst = [0] * len(channels)
+    pipeline_total = 0
+    pipeline_worst = 0
+    while True:
+        cycles = NSS_ROW_CYCLES
+        for i, (c, cursor) in enumerate(zip(channels, cursors)):
+            cursor.wait -= 1
+            if cursor.wait > 0:
+                cycles += NSS_STREAM_WAIT_CYCLES
+                continue
+            ops = cursor.row()
+            for op in ops:
+                if isinstance(op, speed):
+                    ticks[-1] = op.ticks
+                elif isinstance(op, groove):
+                    ticks[0] = op.ticks
+            update_fx_state(fx[i], ops)
+            c_cycles = (NSS_STREAM_RUN_CYCLES + NSS_OPCODE_CYCLES[ctx_op_name(c)] +
+                        sum([op_cycles(op) for op in ops]))
+            stream_cycles[i] += c_cycles
+            stream_worst[i] = max(stream_worst[i], c_cycles)
+            cycles += c_cycles
+        # the FX state only changes when opcodes are processed, so
+        # the pipelines cost the same at every tick of the row, and
+        # the first tick of the row is the most expensive one
+        pipeline = base_pipeline_cycles + sum([NSS_FX_CYCLES[f] for s in fx for f in s])
+        row_ticks = max(ticks[row % len(ticks)], 1)
+        pipeline_total += pipeline * row_ticks
+        pipeline_worst = max(pipeline_worst, pipeline)
+        cycles += pipeline
+        total += cycles + pipeline * (row_ticks - 1)
+        if cycles > worst[0]:
+            worst = (cycles, row, tick)
+        if cycles > budget:
+            over_budget.append((cycles, row, tick))
+        row += 1
+        tick += row_ticks
+        if any(c.ended or c.looped for c in cursors):
+            break
 
-    parser.add_argument("-c", "--channels", help="Process specific channels. One hex digit per channel",
-                        default='0123456789abcd')
-    parser.add_argument("-z", "--compact", help="Generate compact NSS stream", action="store_true")
+    print("NSS stream and pipeline processing cost in Z80 T-states", file=fd)
+    print("  budget per tick: %d" % budget, file=fd)
+    print("  rows: %d, ticks: %d" % (row, tick), file=fd)
+    print("  worst-case tick: %d (row %d, tick %d)" % worst, file=fd)
+    print("  average per tick: %d" % round(total / tick), file=fd)
+    print("  average per row: %d" % round(total / row), file=fd)
+    for c, t, w in zip(channels, stream_cycles, stream_worst):
+        print("  stream %s: average per row %d, worst-case %d" %
+              (channel_name(c), round(t / row), w), file=fd)
+    print("  pipelines: average per tick %d, worst-case %d" %
+          (round(pipeline_total / tick), pipeline_worst), file=fd)
+    print("  rows over budget: %d" % len(over_budget), file=fd)
+    for cycles, r, t in over_budget:
+        print("   - row %d (tick %d): %d" % (r, t, cycles), file=fd)
+    return len(over_budget) == 0
+
+
+
+# module, patterns and instruments in a channel worker process
+channel_context = None
+
+def init_channel_worker(m, p, ins, ext_fm2_mode, verbose, fuse_passes, factor_sequences):
+    global channel_context, ext_fm2, VERBOSE, FUSE_PASSES, FACTOR_SEQUENCES
+    register_nss_ops()
+    channel_context = (m, p, ins)
+    ext_fm2 = ext_fm2_mode
+    VERBOSE = verbose
+    FUSE_PASSES = fuse_passes
+    FACTOR_SEQUENCES = factor_sequences
 
-    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true",
-                        default=False, help="print details of processing")
 
-    arguments = parser.parse_args()
-    VERBOSE = arguments.verbose
+def compile_channel(nss, channel, first_stream):
+    m, p, ins = channel_context
+    if not sanity_check_nss_stream(nss, m, p, ins, channel):
+        return None
+    return compact_nss_stream(nss, m, ins, channel, first_stream)
 
-    if arguments.name != None:
-        name = arguments.name
-    else:
-        name = "nss_stream"
 
-    bank = arguments.bank
+def compile_channels_in_pool(m, p, ins, channels, raw_streams, first, jobs):
+    """Check and compact the NSS stream of every channel in a process pool"""
+    # instruments may load their sample lazily from the module, which
+    # cannot be sent to worker processes. Compilation does not need it.
+    ins = [replace(i, load=None) if hasattr(i, "load") else i for i in ins]
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_channel_worker,
+                             initargs=(m, p, ins, ext_fm2, VERBOSE, FUSE_PASSES,
+                                       FACTOR_SEQUENCES)) as pool:
+        return list(pool.map(compile_channel, raw_streams, channels,
+                             [ch == first for ch in channels]))
 
-    # FIXME: only compact representation works right now
-    arguments.compact = True
 
-    dbg("Loading Furnace module %s"%arguments.FILE)
-    bs = load_module(arguments.FILE)
-    m = read_module(bs)
-    smp = read_samples(module_id_from_path(arguments.FILE), m.samples, bs)
-    ins = read_instruments(m, m.instruments, smp, bs)
-    p = read_all_patterns(m, bs)
+def compile_compact_nss(m, p, ins, channel_filter, jobs=1):
+    """Compile the selected channels of a module into compact NSS streams"""
+    global ext_fm2
 
     # configure the furnace parser based on the loaded module
     register_nss_ops()
     register_nss_factories(m)
 
     # validate channel filtering option
-    channels = arguments.channels.lower()
+    channels = channel_filter.lower()
     ext_fm2 = len(m.orders[0]) == 17
     allowed_channels = '0123456789abcdwxyz' if ext_fm2 else '0123456789abcd'
-    if not all([c in allowed_channels for c in arguments.channels.lower()]):
+    if not all([c in allowed_channels for c in channel_filter.lower()]):
         error("invalid channel filter")
     # ext_fm2: consider all OPs if channel 1 is selected
-    if ext_fm2 and '1' in arguments.channels:
+    if ext_fm2 and '1' in channel_filter:
         channels = ''.join(sorted(set(channels+'wxyz')))
     # convert channels to direct offsets for use during parsing below
     channels = channels.translate(str.maketrans('wxyz','1efg'))
@@ -1812,49 +2622,186 @@ def main():
     dbg("Build unoptimized NSS streams out of all NSS patterns")
     raw_streams = [raw_nss_stream(nss_orders, nss_patterns, ch) for ch in channels]
 
-    # ensure that the streams follows NSS semantics
-    # (e.g. correct instrument type for track, no default instrument...)
-    checks = [sanity_check_nss_stream(nss, m, p, ins, ch) for ch, nss in zip(channels, raw_streams)]
-    if len([c for c in checks if c == False]):
-        sys.exit(1)
-
-    # generate the output
-    if arguments.compact:
-        nss_streams = [compact_nss_stream(nss, m, ins, ch) for ch, nss in zip(channels, raw_streams)]
-        channels, nss_streams = non_empty_nss_streams(channels, nss_streams)
+    # the tempo and the extended FM2 mode are configured by
+    # the first stream that plays something in the module
+    first = next((ch for ch, nss in zip(channels, raw_streams)
+                  if stream_size_in_effective_opcodes(nss)>0), None)
 
-        if arguments.output:
-            outfd = open(arguments.output, "w")
-        else:
-            outfd = sys.__stdout__
-
-        # NSS compact header (number of streams, channels bitfield, stream pointers)
-        size = (1 +                  # number of streams
-                2 +                  # channels bitfield
-                1 + len(m.speeds) +  # speeds
-                (2 * len(nss_streams)))  # stream pointers
-        # all streams sizes
-        size += sum([stream_size_in_bytes(s) for s in nss_streams])
-        asm_header(nss_streams, m, name, bank, size, outfd)
-        nss_compact_header(m, channels, nss_streams, name, outfd)
-        for i, ch, stream in zip(range(len(channels)), channels, nss_streams):
-            nss_to_asm(stream, m, stream_name(name, ch), outfd)
+    if jobs > 1:
+        nss_streams = compile_channels_in_pool(m, p, ins, channels, raw_streams, first, jobs)
+        if None in nss_streams:
+            sys.exit(1)
     else:
-        checkok, stream = generate_nss_stream(m, p, bs, ins, channels, -1)
-        if not checkok:
+        # ensure that the streams follows NSS semantics
+        # (e.g. correct instrument type for track, no default instrument...)
+        checks = [sanity_check_nss_stream(nss, m, p, ins, ch) for ch, nss in zip(channels, raw_streams)]
+        if len([c for c in checks if c == False]):
             sys.exit(1)
-        if arguments.output:
-            outfd = open(arguments.output, "w")
-        else:
-            outfd = sys.__stdout__
-        # NSS inline marker + channels bitfield, stream size
-        size = 1 + 2 + stream_size_in_bytes(stream)
-        asm_header(stream, m, name, bank, size, outfd)
-        nss_inline_header(channels, name, outfd)
-        nss_to_asm(stream, m, False, outfd)
+
+        nss_streams = [compact_nss_stream(nss, m, ins, ch, ch == first) for ch, nss in zip(channels, raw_streams)]
+    return non_empty_nss_streams(channels, nss_streams)
+
+
+def nss_to_blob(m, channels, nss_streams, name):
+    blob = nss_blob()
+    nss_compact_header_bin(m, channels, name, blob)
+    for ch, stream in zip(channels, nss_streams):
+        nss_to_bin(stream, stream_name(name, ch), blob)
+    blob.symbol("%s_end" % name)
+    return blob
+
+
+def generate_compact_nss(m, p, ins, channel_filter, name, bank, outfd, jobs=1,
+                         symfd=None, base=0):
+    """Compile the selected channels of a module into compact NSS streams.
+    If symfd is set, the streams are written as a relocatable binary in
+    outfd, and their symbols and relocations are written in symfd"""
+    channels, nss_streams = compile_compact_nss(m, p, ins, channel_filter, jobs)
+
+    # NSS compact header (number of streams, channels bitfield, stream pointers)
+    size = (1 +                  # number of streams
+            2 +                  # channels bitfield
+            1 + len(m.speeds) +  # speeds
+            (2 * len(nss_streams)))  # stream pointers
+    # all streams sizes
+    size += sum([stream_size_in_bytes(s) for s in nss_streams])
+    if symfd:
+        blob = nss_to_blob(m, channels, nss_streams, name)
+        assert len(blob.data) == size
+        outfd.write(blob.link(base))
+        nss_symbols(m, blob, outfd.name, bank, base, symfd)
+        return
+    asm_header(nss_streams, m, name, bank, size, outfd)
+    nss_compact_header(m, channels, nss_streams, name, outfd)
+    for i, ch, stream in zip(range(len(channels)), channels, nss_streams):
+        nss_to_asm(stream, m, stream_name(name, ch), outfd)
     nss_footer(name, outfd)
 
 
+def main():
+    global VERBOSE, FUSE_PASSES, FACTOR_SEQUENCES
+
+    parser = argparse.ArgumentParser(
+        description="Convert Furnace module patterns to NSS stream")
+
+    parser.add_argument("FILE", help="Furnace module")
+    parser.add_argument("-o", "--output", help="Output file name")
+
+    parser.add_argument("-b", "--bank", type=int,
+                       help="generate data for a bank-switched Z80 memory area")
+
+    parser.add_argument("-n", "--name",
+                        help="Name of the ASM label for the NSS data. Empty name skips label.")
+
+    parser.add_argument("-c", "--channels", help="Process specific channels. One hex digit per channel",
+                        default='0123456789abcd')
+    parser.add_argument("-z", "--compact", help="Generate compact NSS stream", action="store_true")
+
+    pcompile = parser.add_argument_group("compile module",
+                                         "also extract instruments and samples from "
+                                         "the module, in the same run")
+    pcompile.add_argument("-i", "--instruments", metavar="OUTPUT",
+                          help="output file for the instruments ASM (as furtool -i)")
+    pcompile.add_argument("-s", "--samples", metavar="OUTPUT",
+                          help="output file for the ADPCM sample map (as furtool -s)")
+    pcompile.add_argument("-d", "--sample-data", metavar="FILE",
+                          help="store the sample data in a binary file rather "
+                          "than in the sample map (as furtool -d)")
+    pcompile.add_argument("--instruments-name", default="nss_instruments",
+                          help="Name of the generated instrument table")
+    pcompile.add_argument("-m", "--map", default="samples.inc",
+                          help="Name of the ADPCM sample map file to include")
+
+    parser.add_argument("-O", "--format", choices=["asm", "bin"], default="asm",
+                        help="Output format: ASM source, or relocatable binary and symbol file")
+    parser.add_argument("--symbols", metavar="FILE",
+                        help="Symbol and relocation file for binary output "
+                        "(default: output file name with a .yaml extension)")
+    parser.add_argument("--base", type=lambda x: int(x, 0), default=0,
+                        help="Load address used to resolve relocations in binary output")
+
+    panalyze = parser.add_argument_group("analyze module",
+                                         "report the cost of the compiled streams "
+                                         "rather than generating them")
+    panalyze.add_argument("-a", "--analyze", action="store_true",
+                          help="Report the Z80 cycles spent processing the NSS streams "
+                          "and running the pipelines, tick by tick")
+    panalyze.add_argument("--budget", type=int, metavar="CYCLES",
+                          help="Z80 cycles available per tick (default: duration of a tick)")
+
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes used to compile channels in parallel")
+    parser.add_argument("-f", "--factor", action="store_true",
+                        help="Factor repeated opcode sequences into called blocks to save space")
+    parser.add_argument("--no-fused-passes", dest="fuse", action="store_false",
+                        help="Run every optimization pass in its own traversal of the stream")
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true",
+                        default=False, help="print details of processing")
+
+    arguments = parser.parse_args()
+    VERBOSE = arguments.verbose
+    FUSE_PASSES = arguments.fuse
+    FACTOR_SEQUENCES = arguments.factor
+
+    if arguments.name != None:
+        name = arguments.name
+    else:
+        name = "nss_stream"
+
+    bank = arguments.bank
+
+    # FIXME: only compact representation works right now
+    arguments.compact = True
+
+    dbg("Loading Furnace module %s"%arguments.FILE)
+    parsed = parsed_module(arguments.FILE)
+    if parsed:
+        m, ins, p = parsed.song, parsed.instruments, parsed.patterns
+        smp = parsed.samples
+    else:
+        module = fur_module_index(arguments.FILE)
+        m = module.song
+        ins = list(module.instruments)
+        p = read_all_patterns(m, module.bs)
+        smp = module.samples
+        if arguments.samples:
+            check_for_unused_samples(smp, module.bs)
+
+    # instruments and sample map, from the already loaded module
+    if arguments.instruments:
+        with open(arguments.instruments, "w") as insfd:
+            generate_instruments(m, arguments.map, arguments.instruments_name,
+                                 bank, ins, insfd)
+        # warn if SSG required volume tweak
+        if furtool.SSG_USED and furtool.HALF_SSG_VOL:
+            print("Volume of SSG channel is halved in Furnace, SSG macros were tweaked to compensate.\n"
+                  "To fix that, please set the SSG volume to 256 in Furnace in the 'Chip Manager' window.")
+    if arguments.samples:
+        with open(arguments.samples, "w") as smpfd:
+            generate_sample_map(m, smp, smpfd, arguments.sample_data)
+
+    # generate the output
+    if arguments.analyze:
+        outfd = open(arguments.output, "w") if arguments.output else sys.__stdout__
+        channels, nss_streams = compile_compact_nss(m, p, ins, arguments.channels, arguments.jobs)
+        if not analyze_nss_cycles(m, channels, nss_streams, arguments.budget, outfd):
+            sys.exit(1)
+        return
+    if arguments.format == "bin":
+        if not arguments.output:
+            error("binary output requires an output file name")
+        symbols = arguments.symbols or os.path.splitext(arguments.output)[0]+".yaml"
+        with open(arguments.output, "wb") as outfd, open(symbols, "w") as symfd:
+            generate_compact_nss(m, p, ins, arguments.channels, name, bank, outfd,
+                                 arguments.jobs, symfd, arguments.base)
+        return
+    if arguments.output:
+        outfd = open(arguments.output, "w")
+    else:
+        outfd = sys.__stdout__
+    generate_compact_nss(m, p, ins, arguments.channels, name, bank, outfd, arguments.jobs)
+
+
 
 if __name__ == "__main__":
     main()
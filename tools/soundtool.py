@@ -343,12 +343,64 @@ def dump_z80_commands(desc, f):
         print('', file=f)
 
 
-def dump_makefile(desc, f):
+def dump_shared_instruments(desc, sample_map, f):
+    from furtool import instruments_from_module, generate_shared_instruments
+    grouped_musics, _ = group_assets(desc)
+    songs = []
+    for group in sorted(iter(grouped_musics)):
+        for mod in grouped_musics[group]:
+            name=mod['furnace']['name']
+            path=mod['furnace']['uri'].split("://")[1]
+            dbg("Loading instruments from %s"%path)
+            songs.append(("instruments_%s"%name, group if group >= 0 else None,
+                          instruments_from_module(path)))
+    generate_shared_instruments(songs, sample_map, f)
+
+
+def dump_module_rule(path, filename, name, group, sample_map, f, instruments=True):
+    outputs = {"nss": "$(BUILDDIR_NSS)/nss-%s.s"%filename,
+               "instruments": "$(BUILDDIR_NSS)/instruments-%s.s"%filename,
+               "samples": "$(BUILDDIR_NSS)/samples-%s.yaml"%filename}
+    if not instruments:
+        del outputs["instruments"]
+    print("", file=f)
+    # flags must be set on all targets, as any of them can trigger the rule
+    if group >= 0:
+        for o in outputs.values():
+            print("%s: NSS_FLAGS=-b %d"%(o, group), file=f)
+    print("%s &: %s"%(" ".join(outputs.values()), path), file=f)
+    # labels must match the ones used by the z80 sound commands
+    cmd = "\t$(NSSTOOL) $(NSS_FLAGS) -z %s -n nss_%s -o %s"%(path, name, outputs["nss"])
+    if instruments:
+        cmd += " -i %s --instruments-name instruments_%s -m %s"%\
+            (outputs["instruments"], name, sample_map)
+    cmd += " -s %s"%outputs["samples"]
+    print(cmd, file=f)
+
+
+def dump_makefile(desc, f, grouped=False, shared=None, sample_map="samples.inc"):
     print("# dependencies for generated sound assets", file=f)
     print("# generated by soundtool.py (ngdevkit)", file=f)
 
     grouped_musics, _ = group_assets(desc)
 
+    if shared:
+        # instruments of all the modules are generated in a single file,
+        # where identical instruments are shared between modules
+        musics = [m for g in grouped_musics.values() for m in g]
+        paths = list(dict.fromkeys(m["furnace"]["uri"].split("://")[1] for m in musics))
+        print("\nSOUNDTOOL?=soundtool.py", file=f)
+        print("$(BUILDDIR_NSS)/instruments.s: %s"%" ".join(shared + paths), file=f)
+        print("\t$(SOUNDTOOL) --instruments -s %s -o $@"%" ".join(shared), file=f)
+        print("$(SOUND_DRIVER): $(BUILDDIR_NSS)/instruments.rel", file=f)
+        for group in sorted(g for g in grouped_musics if g >= 0):
+            print("$(SOUND_DRIVER_BANK%d): $(BUILDDIR_NSS)/instruments.rel"%group, file=f)
+
+    if grouped:
+        # all the assets of a module are generated by a single nsstool
+        # run, which requires grouped targets (GNU make 4.3 or later)
+        print("\nNSSTOOL?=nsstool.py", file=f)
+
     # Jump table macros
     groups = sorted(iter(grouped_musics))
     use_bank = any([g>=0 for g in groups])
@@ -377,11 +429,14 @@ def dump_makefile(desc, f):
             uri=mod['furnace']['uri']
             path=uri.split("://")[1]
             filename=os.path.splitext(os.path.basename(path))[0]
-            for ntype in ("instruments", "nss"):
+            if grouped:
+                dump_module_rule(path, filename, mod['furnace']['name'], group, sample_map, f, not shared)
+            for ntype in ("nss",) if shared else ("instruments", "nss"):
                 print("")
-                if group >= 0:
-                    print("$(BUILDDIR_NSS)/%s-%s.s: NSS_FLAGS=-b %d"%(ntype, filename, group), file=f)
-                print("$(BUILDDIR_NSS)/%s-%s.s: %s"%(ntype, filename, path), file=f)
+                if not grouped:
+                    if group >= 0:
+                        print("$(BUILDDIR_NSS)/%s-%s.s: NSS_FLAGS=-b %d"%(ntype, filename, group), file=f)
+                    print("$(BUILDDIR_NSS)/%s-%s.s: %s"%(ntype, filename, path), file=f)
                 print("$(%s): $(BUILDDIR_NSS)/%s-%s.rel"%(drv, ntype, filename), file=f)
                 if group >= 0:
                     print("$(%s): $(BUILDDIR_NSS)/%s-%s.rel"%(bank, ntype, filename), file=f)
@@ -404,6 +459,10 @@ def main():
     pmode.add_argument("-m", "--makefile", action="store_const",
                        const="makefile", dest="action",
                        help="output makefile dependencies for music assets")
+    pmode.add_argument("-i", "--instruments", action="store_const",
+                       const="instruments", dest="action",
+                       help="output instruments of all music modules, sharing "
+                       "identical instruments between modules of a Z80 memory area")
     pmode.add_argument("-g", "--generate", action="store_const",
                        const="generate", dest="action",
                        help="generate a template sound map to be customized by user")
@@ -416,13 +475,25 @@ def main():
     parser.add_argument("-o", "--output",
                         help="Output file path, contents depends on the action")
 
+    parser.add_argument("--grouped", action="store_true", default=False,
+                        help="with --makefile, generate rules that compile all the "
+                        "assets of a music module in a single nsstool run")
+
+    parser.add_argument("--shared-instruments", action="store_true", default=False,
+                        help="with --makefile, generate the instruments of all music "
+                        "modules in a single file with --instruments")
+
+    parser.add_argument("--map", default="samples.inc",
+                        help="with --instruments or --makefile --grouped, name of the "
+                        "ADPCM sample map file to include")
+
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true",
                         default=False, help="print details of processing")
 
     arguments = parser.parse_args()
     VERBOSE = arguments.verbose
 
-    if arguments.action in ['c-header', 'z80']:
+    if arguments.action in ['c-header', 'z80', 'instruments']:
         if not arguments.soundmap:
             error('option --soundmap is required for action --%s'%arguments.action)
 
@@ -464,7 +535,13 @@ def main():
 
     # generate m68k header
     if arguments.action == 'makefile':
-        dump_makefile(desc, output)
+        dump_makefile(desc, output, arguments.grouped,
+                      arguments.soundmap if arguments.shared_instruments else None,
+                      arguments.map)
+
+    # generate instruments shared by all musics
+    if arguments.action == 'instruments':
+        dump_shared_instruments(desc, arguments.map, output)
 
 
 if __name__ == "__main__":
@@ -19,13 +19,15 @@
 
 import argparse
 import base64
+import hashlib
+import mmap
 import os
 import sys
 from dataclasses import dataclass
 from furtool import samples_from_module
-from struct import pack, unpack, unpack_from
+from struct import pack, unpack_from
 import wave
-from adpcmtool import ym2610_adpcma, ym2610_adpcmb
+from adpcmtool import ym2610_adpcma, ym2610_adpcmb, encode_pcm_data
 
 # Special handling for YAML: try to import ruamel.yaml first,
 # because it's better at keeping comments in YAML files, and
@@ -83,6 +85,11 @@ def validate(s):
     assert all([x in val and isinstance(val[x], str) for x in ["name", "uri"]])
     assert val["uri"].startswith("file://") or \
            val["uri"].startswith("data:;base64,")
+    # sample stored in a binary file along with other samples
+    if "offset" in val:
+        assert val["uri"].startswith("file://")
+        assert all([x in val and isinstance(val[x], int) for x in ["offset", "length"]])
+        assert isinstance(val.get("sha256"), str)
 
 
 # Basic sample packing: allocate ADPCM samples in sequence
@@ -159,17 +166,21 @@ def convert_to_adpcm(sample, path):
     except Exception as e:
         error("Could not convert sample '%s' to ADPCM: %s"%(path, e))
 
-    if w.getsampwidth() == 1:
-        # WAV file format, 8bits is always unsigned
-        pcm8s = unpack('<%dB' % (len(data)), data)
-        adpcms=codec.encode_u8(pcm8s)
-    else:
-        # WAV file format, 16bits is always signed
-        pcm16s = unpack('<%dh' % (len(data)>>1), data)
-        adpcms=codec.encode_s16(pcm16s)
+    # WAV file format, 8bits is always unsigned, 16bits is always signed
+    fmt = 'u8' if w.getsampwidth() == 1 else 's16'
+    return encode_pcm_data(codec, data, fmt)
+
+def load_sample_data(path, offset, length, sha256, files):
+    # sample data files are memory-mapped once, and samples
+    # are views on the mapped file
+    if path not in files:
+        with open(path, "rb") as f:
+            files[path] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    data = files[path][offset:offset+length]
+    if len(data) != length or hashlib.sha256(data).hexdigest() != sha256:
+        error("sample data at offset %d in '%s' does not match its sample map"%(offset, path))
+    return data
 
-    adpcms_packed = [(adpcms[i] << 4 | adpcms[i+1]) for i in range(0, len(adpcms), 2)]
-    return bytes(adpcms_packed)
 
 def load_sample_map_file(filenames):
     # Allow multiple documents in the yaml file
@@ -185,6 +196,7 @@ def load_sample_map_file(filenames):
 
     # Create adpcm objects from input map and load sample data
     samples = []
+    data_files = {}
     mkmap = {"adpcm_a_sample": adpcm_a,
              "adpcm_b_sample": adpcm_b,
              "adpcm_a": adpcm_a,
@@ -205,7 +217,13 @@ def load_sample_map_file(filenames):
             # make a sample object from the input
             sample = mkmap[stype](y[stype]["name"], y[stype]["uri"])
             # load sample's data
-            if sample.uri.startswith("file://"):
+            if sample.uri.startswith("file://") and "offset" in y[stype]:
+                samplepath = sample.uri[7:]
+                sample.data = load_sample_data(samplepath, y[stype]["offset"],
+                                               y[stype]["length"], y[stype]["sha256"],
+                                               data_files)
+                dbg("  %s: loaded from '%s'" % (sample.name, samplepath))
+            elif sample.uri.startswith("file://"):
                 samplepath = sample.uri[7:]
                 if samplepath.endswith(".wav"):
                     sample.data = convert_to_adpcm(sample, samplepath)